@@ -0,0 +1,192 @@
+"""Process-local caches for values computed from nearly static database tables."""
+
+from collections import OrderedDict
+import threading
+import uuid
+import weakref
+
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.dispatch import receiver
+
+from . import replica
+
+
+_caches = []
+
+
+class LocalCache():
+    """Caches a value computed from the database in the memory of the current process.
+
+    The value is built on first use and rebuilt on the first use after :meth:`invalidate`. Use :meth:`connect` to
+    invalidate the value whenever the models it is built from are saved or deleted.
+
+    Other processes are told about an invalidation through a generation token stored with Django's cache framework.
+    When running more than one worker process, ``CACHES`` must be configured with a backend that the workers share.
+    The token is read at most once per request and thread, so an invalidation by another process is seen from the
+    next request on. Invalidations by this process are seen at once.
+
+    An invalidation inside a transaction might be rolled back. Until the transaction is committed, the thread that
+    made the change uses a value that is only visible to itself and is rebuilt after each further invalidation or
+    rolled back savepoint.
+
+    Args:
+        name: Unique name of the cache.
+        build: Function without arguments that computes the value from the database.
+    """
+
+    def __init__(self, name, build):
+        self.name = name
+        self.build = build
+        self._key = 'common.cache.LocalCache.' + name
+        self._value = None
+        self._valid = False
+        self._generation = None
+        self._local = threading.local()
+        _caches.append(self)
+
+
+    def get(self):
+        hooks = getattr(self._local, 'hooks', None)
+        if hooks:
+            pending = [h for h in hooks if h() is not None]
+            if len(pending) > 0:
+                if len(pending) < len(hooks): # A savepoint was rolled back
+                    self._local.hooks = pending
+                    self._local.valid = False
+                if not self._local.valid:
+                    with replica.primary():
+                        self._local.value = self.build()
+                    self._local.valid = True
+                return self._local.value
+            # The transaction was rolled back
+            self._local.hooks = []
+            self._local.value = None
+
+        if self._valid and getattr(self._local, 'checked', False):
+            return self._value
+        generation = cache.get(self._key)
+        self._local.checked = True
+        if not self._valid or generation != self._generation:
+            with replica.primary(): # Outlives the request, must not be built from an older snapshot
+                self._value = self.build()
+            self._generation = generation
+            self._valid = True
+        return self._value
+
+
+    def invalidate(self):
+        self._valid = False
+        self._value = None
+        if connection.in_atomic_block:
+            hook = _CommitHook(self._committed)
+            transaction.on_commit(hook)
+            self._local.hooks = getattr(self._local, 'hooks', []) + [weakref.ref(hook)]
+            self._local.valid = False
+            self._local.value = None
+        self._bump_generation()
+
+
+    def connect(self, *models, condition=None):
+        """Invalidate the cache when an instance of one of the models is saved or deleted.
+
+        Args:
+            models: The model classes.
+            condition (optional): Function that takes the saved or deleted instance and returns True if the cache
+                needs to be invalidated. By default, every change invalidates the cache.
+        """
+
+        def handler(sender, instance, **kwargs):
+            if condition is None or condition(instance):
+                self.invalidate()
+
+        for model in models:
+            uid = self._key + '.' + model._meta.label
+            post_save.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+            post_delete.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+
+
+    def _committed(self):
+        self._local.hooks = []
+        self._local.value = None
+        self._valid = False
+        self._value = None
+        self._bump_generation()
+
+
+    def _bump_generation(self):
+        # A new token rather than an increment so concurrent invalidations can't be lost.
+        cache.set(self._key, uuid.uuid4().hex, None)
+
+
+class _CommitHook():
+    """Calls `func` once the transaction is committed, see :func:`django.db.transaction.on_commit`.
+
+    Only Django keeps a reference to the hook. Rolling back the transaction or the savepoint it was registered in drops
+    the hook, so a weak reference to it tells whether the commit is still pending.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+
+    def __call__(self):
+        self.func()
+
+
+class LRUCache():
+    """Size limited mapping for memoizing values in the current process. The least recently used entries are dropped
+    first.
+
+    Unlike :class:`LocalCache`, nothing is invalidated. The keys must change when the value would change.
+
+    Args:
+        maxsize: Maximum number of entries.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+@receiver(request_started)
+def LocalCache_request_started(sender=None, **kwargs):
+    # Read the generation tokens again in this request
+    for c in _caches:
+        c._local.checked = False
+
+
+@receiver(post_migrate)
+def LocalCache_post_migrate(sender, **kwargs):
+    # Tables may have been flushed without sending delete signals.
+    for c in _caches:
+        c.invalidate()
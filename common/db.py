@@ -0,0 +1,54 @@
+"""Database helpers shared by the tournament apps."""
+
+from django.db import connections, router, transaction
+from django.db.models import Max
+
+
+def bulk_create_with_ids(model, objs, batch_size=None):
+    """Insert objects with ``bulk_create`` and make sure their primary keys are set.
+
+    ``QuerySet.bulk_create`` only populates the primary keys on backends that can return them from a bulk insert
+    (PostgreSQL). On the other backends (SQLite), the keys are allocated after the largest existing key before
+    inserting. On SQLite, keys of deleted rows are not reused either: allocation starts after the largest key the table
+    ever had, from ``sqlite_sequence`` like ``AUTOINCREMENT`` does. The allocation and the insert run in the same
+    transaction so concurrent writers can't claim the same keys.
+
+    Args:
+        model: The model class of the objects.
+        objs: Iterable of unsaved model instances.
+        batch_size (optional): Passed to ``bulk_create``.
+
+    Returns:
+        List of the created objects.
+    """
+
+    objs = list(objs)
+    if len(objs) == 0:
+        return objs
+
+    using = router.db_for_write(model)
+    if connections[using].features.can_return_ids_from_bulk_insert:
+        return model.objects.using(using).bulk_create(objs, batch_size=batch_size)
+
+    with transaction.atomic(using=using):
+        next_id = max(model.objects.using(using).aggregate(max_id=Max('pk'))['max_id'] or 0,
+            _get_sequence(using, model)) + 1
+        for obj in objs:
+            obj.pk = next_id
+            next_id += 1
+        return model.objects.using(using).bulk_create(objs, batch_size=batch_size)
+
+
+def _get_sequence(using, model):
+    """Returns the largest primary key the table of `model` ever had if the database tracks it, otherwise 0."""
+
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_sequence'")
+        if cursor.fetchone() is None: # No table with AUTOINCREMENT was ever created
+            return 0
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row is not None else 0
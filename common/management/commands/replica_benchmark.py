@@ -0,0 +1,107 @@
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from common import replica
+
+
+# Scans the schema once per row of the counter, holding a read lock on the database for the whole statement like a
+# large page does. A table must be read for SQLite to lock the file.
+READ_QUERY = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < ?) '
+    'SELECT COUNT(*) FROM c CROSS JOIN sqlite_master')
+
+
+class Command(BaseCommand):
+    help = ('Measure the latency of writes to a copy of the database while spectators read it, first with the '
+        'spectators reading the live database, then with them reading the replica. See common.replica.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4, help='Number of concurrent spectators.')
+        parser.add_argument('--writes', type=int, default=100, help='Number of writes to time.')
+        parser.add_argument('--read-size', type=int, default=2000, help='Length of each read, in schema scans.')
+        parser.add_argument('--interval', type=float, default=1, help='Seconds between snapshots of the replica.')
+
+    def handle(self, *args, **options):
+        if not replica.is_enabled():
+            raise CommandError('The default and replica databases must both be SQLite databases.')
+        if options['writes'] < 1:
+            raise CommandError('Need at least one write.')
+
+        # Never write to the real database
+        tmp = tempfile.mkdtemp()
+        try:
+            live = os.path.join(tmp, 'live.sqlite3')
+            copy = os.path.join(tmp, 'replica.sqlite3')
+            with connections[DEFAULT_DB_ALIAS].cursor():
+                pass # Creates the database if it doesn't exist yet
+            replica.snapshot(source=connections[DEFAULT_DB_ALIAS].settings_dict['NAME'], target=live)
+            replica.snapshot(source=live, target=copy)
+
+            for (label, target, interval) in (('Live database', live, None), ('Replica', copy, options['interval'])):
+                (latencies, n_read) = run(live, target, interval, options['readers'], options['writes'],
+                    options['read_size'])
+                ms = sorted(x * 1000 for x in latencies)
+                self.stdout.write('{}: {} reads, write latency (ms): min {:.1f}, median {:.1f}, 95% {:.1f}, '
+                    'max {:.1f}'.format(label, n_read, ms[0], statistics.median(ms), ms[int(0.95 * (len(ms) - 1))],
+                    ms[-1]))
+        finally:
+            shutil.rmtree(tmp)
+
+
+def run(live, target, interval, n_readers, n_writes, read_size):
+    """Time `n_writes` writes to `live` while `n_readers` threads read `target`.
+
+    Takes a snapshot of `live` into `target` every `interval` seconds unless `interval` is None.
+
+    Returns:
+        (latencies, number of reads) tuple.
+    """
+
+    done = threading.Event()
+    reads = []
+
+    def read():
+        while not done.is_set():
+            # A new connection for each page, like the app servers, to see the latest snapshot
+            db = sqlite3.connect(target, timeout=30)
+            try:
+                db.execute(READ_QUERY, [read_size]).fetchall()
+            finally:
+                db.close()
+            reads.append(1)
+
+    def take_snapshots():
+        while not done.wait(interval):
+            replica.snapshot(source=live, target=target)
+
+    threads = [threading.Thread(target=read) for _ in range(n_readers)]
+    if interval is not None:
+        threads.append(threading.Thread(target=take_snapshots))
+    for t in threads:
+        t.start()
+
+    latencies = []
+    db = sqlite3.connect(live, timeout=30)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS replica_benchmark (x INTEGER)')
+        db.commit()
+        for i in range(n_writes):
+            start = time.perf_counter()
+            db.execute('INSERT INTO replica_benchmark VALUES (?)', [i])
+            db.commit()
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.01) # Scorers don't write back to back
+    finally:
+        db.close()
+        done.set()
+        for t in threads:
+            t.join()
+
+    return (latencies, len(reads))
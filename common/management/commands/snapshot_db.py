@@ -0,0 +1,41 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common import replica
+
+
+class Command(BaseCommand):
+    help = ('Copy the database into the read-only replica for spectators every few seconds. See common.replica. '
+        'Run it next to the app servers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2,
+            help='Seconds between snapshots. Must be less than REPLICA_MAX_AGE.')
+        parser.add_argument('--once', action='store_true', help='Take a single snapshot and exit.')
+
+    def handle(self, *args, **options):
+        if not replica.is_enabled():
+            raise CommandError('The default and replica databases must both be SQLite databases.')
+        if not options['once'] and options['interval'] >= getattr(settings, 'REPLICA_MAX_AGE', 10):
+            raise CommandError('The interval must be less than REPLICA_MAX_AGE.')
+
+        if options['once']:
+            replica.snapshot()
+            self.stdout.write(self.style.SUCCESS('Wrote the replica.'))
+            return
+
+        self.stdout.write('Writing the replica every {} s. Stop with Ctrl-C.'.format(options['interval']))
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    replica.snapshot()
+                except Exception:
+                    # The pages go back to the live database once the replica is too old
+                    logging.getLogger(__name__).exception('Failed to write the replica.')
+                time.sleep(max(0, options['interval'] - (time.monotonic() - start)))
+        except KeyboardInterrupt:
+            pass
@@ -1,3 +1,65 @@
-from django.db import models
+class DirtyFieldsMixin():
+    """Model mixin that keeps track of the fields changed since the instance was loaded or saved.
 
-# Create your models here.
+    Saving an instance loaded from the database only writes the changed fields and skips the query entirely if nothing
+    changed. Fields with `auto_now` are written along with any change. Pass `update_fields` to :meth:`save` to override
+    this.
+
+    Must come before :class:`django.db.models.Model` in the bases.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._reset_dirty()
+        return instance
+
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._reset_dirty(fields)
+
+
+    def get_dirty_fields(self):
+        """Returns the names of the fields that differ from the database.
+
+        Every field is dirty if the instance hasn't been saved or loaded. A field deferred at load time is dirty once
+        it is assigned.
+        """
+
+        loaded = getattr(self, '_loaded_values', None)
+        fields = [f for f in self._meta.concrete_fields if not f.primary_key]
+        if loaded is None or self._state.adding:
+            return [f.name for f in fields]
+        # Read from __dict__ so a deferred field isn't loaded. Loading it through the attribute records its value.
+        return [f.name for f in fields if f.attname in self.__dict__
+            and (f.attname not in loaded or self.__dict__[f.attname] != loaded[f.attname])]
+
+
+    def has_changed(self, *fields):
+        """Returns True if any of the named fields differ from the database."""
+        dirty = self.get_dirty_fields()
+        return any(f in dirty for f in fields)
+
+
+    def save(self, *args, **kwargs):
+        if (len(args) == 0 and kwargs.get('update_fields') is None and not kwargs.get('force_insert', False)
+                and not self._state.adding and getattr(self, '_loaded_values', None) is not None):
+            # Saving with an empty list doesn't query the database
+            dirty = self.get_dirty_fields()
+            if len(dirty) > 0:
+                dirty += [f.name for f in self._meta.concrete_fields
+                    if getattr(f, 'auto_now', False) and f.name not in dirty]
+            kwargs['update_fields'] = dirty
+        super().save(*args, **kwargs)
+        self._reset_dirty(kwargs.get('update_fields'))
+
+
+    def _reset_dirty(self, fields=None):
+        if fields is None or getattr(self, '_loaded_values', None) is None:
+            self._loaded_values = {}
+            fields = [f.name for f in self._meta.concrete_fields]
+        for name in fields:
+            f = self._meta.get_field(name)
+            if not f.primary_key and f.attname in self.__dict__:
+                self._loaded_values[f.attname] = self.__dict__[f.attname]
@@ -0,0 +1,146 @@
+"""Read-only copy of the database for spectators.
+
+With SQLite, a long read, e.g. rendering a large bracket, holds a lock on the whole database file and the scorers'
+writes wait for it to finish. The ``replica`` database is a copy of the ``default`` database refreshed every few
+seconds by ``./manage.py snapshot_db`` with SQLite's online backup API. :class:`ReplicaRouter` sends the reads of the
+tournament apps to it inside :func:`reading`, e.g. for the views using :class:`common.views.ReplicaMixin`.
+
+The replica is only used while its last snapshot is at most ``REPLICA_MAX_AGE`` seconds old, so the pages fall back
+to the live database if the snapshots stop. Writes always go to the live database.
+"""
+
+from contextlib import contextmanager
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+REPLICA = 'replica'
+
+# Apps whose models are read from the replica. Users and sessions must be current.
+REPLICA_APPS = ('registration', 'kata', 'kumite')
+
+_state = threading.local()
+
+
+def is_enabled():
+    """Returns true if the replica is a SQLite database next to a SQLite default database."""
+    return (REPLICA in settings.DATABASES and connections[REPLICA].vendor == 'sqlite'
+        and connections[DEFAULT_DB_ALIAS].vendor == 'sqlite')
+
+
+def get_age():
+    """Returns the number of seconds since the last snapshot or None if there is none."""
+
+    if not is_enabled():
+        return None
+    try:
+        return time.time() - os.stat(connections[REPLICA].settings_dict['NAME']).st_mtime
+    except OSError:
+        return None
+
+
+def is_fresh():
+    """Returns true if the last snapshot is recent enough to be read."""
+    age = get_age()
+    return age is not None and age <= getattr(settings, 'REPLICA_MAX_AGE', 10)
+
+
+def snapshot(source=None, target=None):
+    """Copy the live database into the replica.
+
+    The copy is written to a temporary file and renamed, so connections to the replica keep reading the previous
+    snapshot until they are closed at the end of their request.
+
+    Args:
+        source (optional): Path of the database to copy. Defaults to the ``default`` database.
+        target (optional): Path of the copy. Defaults to the ``replica`` database.
+    """
+
+    source = source if source is not None else connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+    target = target if target is not None else connections[REPLICA].settings_dict['NAME']
+
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        src = sqlite3.connect(source, timeout=5, uri=source.startswith('file:')) # In-memory test databases
+        dst = sqlite3.connect(tmp)
+        try:
+            # All pages in a single step. Copying in several steps restarts whenever a writer commits in between.
+            src.backup(dst)
+            dst.execute('PRAGMA journal_mode = DELETE') # Readers of a WAL copy would need to write its index
+        finally:
+            dst.close()
+            src.close()
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, target)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+@contextmanager
+def reading():
+    """Read the tournament data from the replica inside the block if it is fresh.
+
+    The freshness is checked once on entry so all the queries of the block see the same snapshot.
+    """
+
+    previous = getattr(_state, 'replica', False)
+    _state.replica = is_fresh()
+    try:
+        yield _state.replica
+    finally:
+        _state.replica = previous
+
+
+@contextmanager
+def primary():
+    """Read from the live database inside the block, even inside :func:`reading`.
+
+    For data that outlives the request, e.g. :class:`common.cache.LocalCache`.
+    """
+
+    previous = getattr(_state, 'replica', False)
+    _state.replica = False
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+class ReplicaRouter():
+    """Database router sending the reads of :data:`REPLICA_APPS` inside :func:`reading` to the replica."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in REPLICA_APPS:
+            return None
+        # Explicit, otherwise the related objects of an instance loaded from the replica would be too
+        return REPLICA if getattr(_state, 'replica', False) else DEFAULT_DB_ALIAS
+
+
+    def db_for_write(self, model, **hints):
+        # Instances loaded from the replica are saved to the live database
+        return DEFAULT_DB_ALIAS
+
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # Same data in both
+
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA # Copied from the live database, never migrated
+
+
+@receiver(connection_created)
+def replica_connection_created(sender, connection, **kwargs):
+    if connection.alias == REPLICA and connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA query_only = ON')
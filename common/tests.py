@@ -1,3 +1,148 @@
+from io import StringIO
+import os
+import sqlite3
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import router, transaction
 from django.test import TestCase
 
+from registration.models import Division
+from . import replica
+from .cache import LocalCache, LRUCache, LocalCache_request_started
+
 # Create your tests here.
+class LocalCacheTestCase(TestCase):
+    
+    def setUp(self):
+        self.n_build = 0
+        def build():
+            self.n_build += 1
+            return self.n_build
+        self.cache = LocalCache('test-' + self.id(), build)
+    
+    
+    def test_cached(self):
+        self.assertEqual(self.cache.get(), 1)
+        self.assertEqual(self.cache.get(), 1)
+        
+        # Another process invalidated the value. The token is only read again in the next request.
+        self.cache._bump_generation()
+        with mock.patch('common.cache.cache.get') as cache_get:
+            self.assertEqual(self.cache.get(), 1)
+        self.assertEqual(cache_get.call_count, 0)
+        LocalCache_request_started()
+        self.assertEqual(self.cache.get(), 2)
+        self.assertEqual(self.cache.get(), 2)
+    
+    
+    def test_invalidate_in_transaction(self):
+        self.assertEqual(self.cache.get(), 1)
+        
+        # Test cases run in a transaction. The value is only cached for this thread until it is committed.
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get(), 2)
+        self.assertEqual(self.cache.get(), 2)
+        
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get(), 3)
+        self.assertEqual(self.cache._value, None)
+    
+    
+    def test_invalidate_rolled_back(self):
+        self.assertEqual(self.cache.get(), 1)
+        
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.cache.invalidate()
+                self.assertEqual(self.cache.get(), 2)
+                raise ValueError()
+        
+        # Back to the value shared by the threads
+        self.assertEqual(self.cache.get(), 3)
+        self.assertEqual(self.cache._value, 3)
+
+
+class LRUCacheTestCase(TestCase):
+    
+    def test_evict(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1) # b is now the least recently used
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        
+        cache.set('a', 4)
+        self.assertEqual(cache.get('a'), 4)
+        cache.clear()
+        self.assertEqual(cache.get('a', 5), 5)
+
+
+class ReplicaTestCase(TestCase):
+    
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'live.sqlite3')
+            target = os.path.join(tmp, 'replica.sqlite3')
+            db = sqlite3.connect(source)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('CREATE TABLE t (x INTEGER)')
+            db.execute('INSERT INTO t VALUES (1)')
+            db.commit()
+            
+            replica.snapshot(source=source, target=target)
+            db.execute('INSERT INTO t VALUES (2)')
+            db.commit()
+            db.close()
+            
+            copy = sqlite3.connect(target)
+            self.assertEqual(copy.execute('SELECT x FROM t').fetchall(), [(1,)])
+            self.assertEqual(copy.execute('PRAGMA journal_mode').fetchone(), ('delete',))
+            copy.close()
+            self.assertEqual(os.stat(target).st_mode & 0o777, 0o644)
+            self.assertEqual(sorted(os.listdir(tmp)), ['live.sqlite3', 'replica.sqlite3'])
+    
+    
+    def test_router(self):
+        # The test database has no snapshot
+        with replica.reading() as fresh:
+            self.assertFalse(fresh)
+            self.assertEqual(router.db_for_read(Division), 'default')
+        
+        with mock.patch.object(replica, 'is_fresh', return_value=True):
+            with replica.reading() as fresh:
+                self.assertTrue(fresh)
+                self.assertEqual(router.db_for_read(Division), 'replica')
+                self.assertEqual(router.db_for_read(User), 'default')
+                self.assertEqual(router.db_for_write(Division), 'default')
+                with replica.primary():
+                    self.assertEqual(router.db_for_read(Division), 'default')
+                self.assertEqual(router.db_for_read(Division), 'replica')
+        self.assertEqual(router.db_for_read(Division), 'default')
+        
+        # Instances read from the replica are written to the live database
+        division = Division()
+        division._state.db = 'replica'
+        self.assertEqual(router.db_for_write(Division, instance=division), 'default')
+        self.assertEqual(router.db_for_read(Division, instance=division), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'registration'))
+    
+    
+    def test_local_cache(self):
+        cache = LocalCache('test-' + self.id(), lambda: router.db_for_read(Division))
+        with mock.patch.object(replica, 'is_fresh', return_value=True):
+            with replica.reading():
+                self.assertEqual(cache.get(), 'default')
+    
+    
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('replica_benchmark', readers=1, writes=3, read_size=10, interval=0.01, stdout=out)
+        self.assertIn('Live database:', out.getvalue())
+        self.assertIn('Replica:', out.getvalue())
@@ -1,3 +1,82 @@
-from django.shortcuts import render
+import hashlib
 
-# Create your views here.
+from django.contrib.messages import get_messages
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+from . import replica
+from .cache import LRUCache
+
+
+# Stands in for the CSRF token in cached pages. The token of the request is inserted when a page is served.
+CSRF_PLACEHOLDER = 'csrf-token-placeholder'
+
+_pages = LRUCache(maxsize=500)
+
+
+class VersionedPageMixin():
+    """View mixin that serves GET requests from a version of the page instead of rendering it each time.
+
+    While :meth:`get_version` returns the same value, browsers revalidating with ``If-None-Match`` get an empty
+    ``304 Not Modified`` and other requests get a copy of the page rendered earlier. Pages are cached per user, path
+    and query string. Requests with pending messages are always rendered.
+
+    Must come before the view class in the bases. The view must return a
+    :class:`~django.template.response.TemplateResponse`.
+    """
+
+    def get_version(self):
+        """Returns a value that changes whenever the page would, or None to always render the page.
+
+        Called before the object of the view is loaded, so it should be cheap.
+        """
+        raise NotImplementedError
+
+
+    def get(self, request, *args, **kwargs):
+        version = self.get_version()
+        if version is None or len(get_messages(request)) > 0:
+            return super().get(request, *args, **kwargs)
+
+        key = (request.path, request.GET.urlencode(), request.user.pk, version)
+        etag = quote_etag(hashlib.sha1(repr(key).encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            content = _pages.get(key)
+            if content is None:
+                response = super().get(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                response.context_data['csrf_token'] = CSRF_PLACEHOLDER # Overrides the context processor
+                content = response.render().content
+                _pages.set(key, content)
+            else:
+                response = HttpResponse()
+            response.content = content.replace(CSRF_PLACEHOLDER.encode(), get_token(request).encode())
+
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True) # Always revalidate, pages change as matches are run
+        return response
+
+
+class ReplicaMixin():
+    """View mixin that reads GET requests from the replica database. See :mod:`common.replica`.
+
+    Users with :attr:`replica_exempt_permission` always read the live database since they are changing it. The
+    response is rendered before leaving the replica. Must come first in the bases.
+    """
+
+    replica_exempt_permission = 'accounts.edit'
+
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or request.user.has_perm(self.replica_exempt_permission):
+            return super().dispatch(request, *args, **kwargs)
+
+        with replica.reading():
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response = response.render()
+        return response
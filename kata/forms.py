@@ -1,15 +1,44 @@
 from django import forms
 
 from registration.models import EventLink
-from .models import KataMatch
+from .models import KataMatch, validate_score
 
 
-class KataMatchForm(forms.ModelForm):
+def check_scores(cleaned_data):
+    """Check that all or none of the scores are filled. Returns False if one of the scores didn't validate."""
+    
+    scores = [cleaned_data['score'+str(i)] if 'score'+str(i) in cleaned_data else -1 for i in range(1,5+1)]
+    if -1 in scores:
+        # one of the scores didn't validate
+        return False
+    elif scores.count(None) not in (0, 5):
+        raise forms.ValidationError("Set either all or none of the scores.")
+    return True
+
+
+class BaseKataMatchForm(forms.ModelForm):
+    """Scores of a match. Saving fails if the match changed since the form was shown, see :meth:`.KataMatch.save`."""
+    
+    version = forms.IntegerField(widget=forms.HiddenInput)
+    
     class Meta:
         model = KataMatch
         fields = ['score1', 'score2', 'score3', 'score4', 'score5']
     
     
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.fields['version'].initial = self.instance.version
+    
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('version') is not None:
+            self.instance.version = cleaned_data['version']
+        return cleaned_data
+
+
+class KataMatchForm(BaseKataMatchForm):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         
@@ -30,17 +59,66 @@ class KataMatchForm(forms.ModelForm):
         else:
             raise forms.ValidationError('Unexpected submit button.', code='done_missing')
         
-        # Check that they filled all or none of the scores
-        scores = [cleaned_data['score'+str(i)] if 'score'+str(i) in cleaned_data else -1 for i in range(1,5+1)]
-        if -1 in scores:
-            # one of the scores didn't validate
+        if not check_scores(cleaned_data):
             return
-        elif scores.count(None) not in (0, 5):
-            raise forms.ValidationError("Set either all or none of the scores.")
         
         return cleaned_data
 
 
+class KataRoundScoresMatchForm(BaseKataMatchForm):
+    """Scores of one match in :class:`KataRoundScoresFormSet`."""
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        check_scores(cleaned_data)
+        return cleaned_data
+
+
+class BaseKataRoundScoresFormSet(forms.BaseModelFormSet):
+    """Scores of every match of a round, saved together with :meth:`.KataRound.set_scores`."""
+    
+    def __init__(self, round=None, **kwargs):
+        if round is None:
+            raise ValueError('Round is required.')
+        self.round = round
+        kwargs['queryset'] = round.katamatch_set.select_related('eventlink__person').prefetch_related(
+            'eventlink__eventlink_set__person').order_by(*KataMatch._meta.ordering, 'id')
+        super().__init__(**kwargs)
+    
+    
+    def clean(self):
+        super().clean()
+        if self.round.locked:
+            raise forms.ValidationError("Round is locked.")
+        if any(form.has_changed() for form in self.extra_forms):
+            raise forms.ValidationError("Add participants to the round before scoring them.")
+    
+    
+    def save(self):
+        matches = super().save(commit=False) # Only the changed matches
+        self.round.set_scores(matches)
+        return matches
+
+
+KataRoundScoresFormSet = forms.modelformset_factory(KataMatch, form=KataRoundScoresMatchForm,
+    formset=BaseKataRoundScoresFormSet, extra=0)
+
+
+class KataJudgeScoreForm(forms.Form):
+    """Score of one judge for a match of a bracket."""
+    
+    match = forms.ModelChoiceField(queryset=KataMatch.objects.none(), widget=forms.HiddenInput)
+    score = forms.DecimalField(max_digits=3, decimal_places=1, validators=(validate_score,),
+        widget=forms.NumberInput(attrs={'step': '0.1', 'autofocus': 'autofocus'}))
+    
+    def __init__(self, bracket=None, **kwargs):
+        if bracket is None:
+            raise ValueError('Bracket is required.')
+        super().__init__(**kwargs)
+        self.fields['match'].queryset = KataMatch.objects.filter(round__bracket=bracket).select_related(
+            'eventlink__person')
+
+
 class KataBracketAddPersonForm(forms.ModelForm):
     class Meta:
         model = EventLink
@@ -64,7 +142,7 @@ class KataBracketAddPersonForm(forms.ModelForm):
         super().__init__(**kwargs)
         
         division = self.instance.division
-        people = division.eventlink_set.filter(katamatch=None)
+        people = division.eventlink_set.filter(katamatch=None).select_related('person', 'division__event')
         self.fields['existing_eventlink'].queryset = people
     
     
@@ -99,8 +177,10 @@ class KataBracketAddTeamForm(forms.ModelForm):
         super().__init__(**kwargs)
         
         division = self.instance.division
-        self.fields['existing_eventlink'].queryset = division.get_noshow_eventlinks()
-        self.fields['team'].queryset = division.get_team_eventlinks()
+        self.fields['existing_eventlink'].queryset = division.get_noshow_eventlinks().select_related(
+            'person', 'division__event')
+        self.fields['team'].queryset = division.get_team_eventlinks().select_related('division__event'
+            ).prefetch_related('eventlink_set__person')
     
     def clean(self):
         if not self.cleaned_data['manual_name'] and not self.cleaned_data['existing_eventlink']:
@@ -0,0 +1,55 @@
+from decimal import Decimal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from kata.models import KataBracket
+from registration.models import Event, EventLink
+
+
+class Command(BaseCommand):
+    help = ('Time KataBracket.get_winners on a finished bracket where everyone ties for several rounds. The bracket '
+        'is created in a transaction that is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--people', type=int, default=50, help='Number of competitors.')
+        parser.add_argument('--levels', type=int, default=3, help='Number of tie-break rounds.')
+        parser.add_argument('--repeat', type=int, default=100, help='Number of calls to time.')
+
+    def handle(self, *args, **options):
+        if options['people'] < 2 or options['people'] > 50 or options['repeat'] < 1:
+            raise CommandError('Need 2 to 50 people and at least one call.')
+
+        with transaction.atomic():
+            bracket = make_bracket(options['people'], options['levels'])
+
+            with CaptureQueriesContext(connection) as queries:
+                winners = bracket.get_winners()
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                bracket.get_winners()
+            ms = (time.perf_counter() - start) * 1000 / options['repeat']
+
+            self.stdout.write('Winners: {}'.format(', '.join('{}. {}'.format(r, p) for (r, p) in winners)))
+            self.stdout.write('get_winners with {} people and {} tie-break rounds: {} queries, {:.2f} ms'.format(
+                options['people'], options['levels'], len(queries), ms))
+            transaction.set_rollback(True)
+
+
+def make_bracket(n_people, n_levels):
+    """Returns a finished bracket where everyone ties in the first `n_levels` rounds."""
+
+    event = Event.objects.create(name="Standings benchmark", format=Event.EventFormat.kata)
+    people = [EventLink.objects.create(manual_name="Competitor {}".format(i + 1), event=event)
+        for i in range(n_people)]
+    bracket = KataBracket.objects.create()
+    bracket.build(people)
+
+    for level in range(n_levels + 1):
+        round = bracket.kataround_set.get(round=level)
+        for (i, m) in enumerate(round.katamatch_set.select_related('round').order_by('id')):
+            m.scores = [Decimal(8) if level < n_levels else Decimal(5) + Decimal('0.1') * i] * 5
+            m.save()
+    return bracket
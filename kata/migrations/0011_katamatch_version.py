@@ -0,0 +1,18 @@
+# Generated by Django 2.1.8 on 2026-10-18 16:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kata', '0010_auto_20190512_2051'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='katamatch',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
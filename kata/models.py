@@ -1,9 +1,12 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 
-from registration.models import EventLink
+from common.db import bulk_create_with_ids
+from registration.models import EventLink, Division, DivisionProgress
 
 from more_itertools import peekable
 # Create your models here.
@@ -25,6 +28,7 @@ class KataMatch(models.Model):
     score5 = models.DecimalField(max_digits=3, decimal_places=1, validators=(validate_score,), blank=True, null=True)
     combined_score = models.DecimalField(max_digits=3, decimal_places=1, editable=False, blank=True, null=True) # Will be populated by save()
     tie_score = models.DecimalField(max_digits=3, decimal_places=1, editable=False, blank=True, null=True) # Will be populated by save()
+    version = models.PositiveIntegerField(default=0, editable=False) # Incremented by every write, see set_judge_score()
     
     
     class Meta:
@@ -37,6 +41,14 @@ class KataMatch(models.Model):
         return s
     
     
+    def get_progress_display(self):
+        """Returns who is performing for the venue dashboard."""
+        
+        if self.round.round > 0:
+            return "Tie-break: " + self.eventlink.name
+        return self.eventlink.name
+    
+    
     @property
     def scores(self):
         return (self.score1, self.score2, self.score3, self.score4, self.score5)
@@ -46,11 +58,80 @@ class KataMatch(models.Model):
     def scores(self, value):
         (self.score1, self.score2, self.score3, self.score4, self.score5) = value
     
-    def save(self, *args, **kwargs):
+    
+    @staticmethod
+    def set_judge_score(match_id, judge, score, max_tries=10):
+        """Set the score of one judge.
+        
+        Judges send their scores at the same time from their phones, so the other scores are never locked. The score
+        is written with an update conditional on the version of the match read just before and retried if another
+        judge wrote in between. The fifth score saves the match, which computes the combined scores and updates the
+        tie-break rounds once.
+        
+        Args:
+            match_id: Id of the :class:`KataMatch`.
+            judge: Number of the judge, 1 to 5.
+            score: Score of the judge.
+            max_tries (optional): Number of attempts before giving up.
+        
+        Returns:
+            True if this was the last score of the match.
+        
+        Raises:
+            ValidationError: The match has all its scores or its round is locked.
+            KataMatch.DoesNotExist: There is no such match.
+            RuntimeError: Other judges kept writing the match for `max_tries` attempts.
+        """
+        
+        if judge not in range(1, 5+1):
+            raise ValueError("No judge {}.".format(judge))
+        validate_score(score)
+        field = 'score{}'.format(judge)
+        
+        for _ in range(max_tries):
+            m = KataMatch.objects.select_related('round__bracket').get(id=match_id)
+            if m.round.locked:
+                raise ValidationError("Can't modify match if round is locked.")
+            if m.done:
+                raise ValidationError("The match has all its scores.")
+            
+            setattr(m, field, score)
+            with transaction.atomic():
+                n_updated = KataMatch.objects.filter(id=match_id, version=m.version).update(
+                    **{field: score, 'version': models.F('version') + 1})
+                if n_updated == 1:
+                    if any(x is None for x in m.scores):
+                        # Saving the last score updates the division, a partial score only bumps its version
+                        if m.round.bracket.division_id is not None:
+                            Division.touch(pk=m.round.bracket.division_id)
+                        return False
+                    m.version += 1 # As written by the update
+                    m.save()
+                    return True
+        
+        raise RuntimeError("Match {} kept changing while setting the score of judge {}.".format(match_id, judge))
+    
+    
+    def save(self, *args, update_round=True, **kwargs):
+        """Save the match.
+        
+        The match is only overwritten if its `version` is still the one of this instance, otherwise a score written
+        in between, e.g. by :meth:`set_judge_score`, would be lost. Forms keep the version they were shown with.
+        
+        Args:
+            update_round (optional): Update the tie-break rounds and the state of the division. Pass False when
+                saving several matches of a round, then call :meth:`KataRound.match_callback` once. See
+                :meth:`KataRound.set_scores`.
+        
+        Raises:
+            ValidationError: The match changed since this instance was loaded.
+        """
         
         if self.round.locked:
             raise ValidationError("Can't modify match if round is locked.")
         
+        self._loaded_version = self.version
+        self.version += 1
         scores = self.scores
         self.done = all((x is not None for x in scores))
         if self.done:
@@ -60,9 +141,30 @@ class KataMatch(models.Model):
             self.combined_score = None
             self.tie_score = None
         
-        super().save(*args, **kwargs)
-        
-        self.round.match_callback(self)
+        try:
+            if not update_round:
+                super().save(*args, **kwargs)
+                return
+            
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                
+                self.round.match_callback(self)
+                self.round.update_division()
+        except ValidationError:
+            self.version = self._loaded_version
+            raise
+    
+    
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # Conditional UPDATE, see save()
+        if super()._do_update(base_qs.filter(version=self._loaded_version), using, pk_val, values, update_fields,
+                forced_update):
+            return True
+        if base_qs.filter(pk=pk_val).exists():
+            raise ValidationError("The scores of {} changed in the meantime, check them and save again.".format(
+                self.eventlink.name))
+        return False # Deleted, inserted again like any model
     
     
     def diff(self, other):
@@ -156,53 +258,112 @@ class KataRound(models.Model):
             return None
     
     
-    def match_callback(self, match=None):
-        # Match is none when adding or removing a person
+    def set_scores(self, matches):
+        """Save the scores of several matches of the round, then update the tie-break rounds once.
+        
+        Args:
+            matches: :class:`KataMatch`es of the round with their new scores.
+        """
         
         if self.locked:
             raise ValidationError("Can't modify round if locked.")
         
-        n_done = len(self.katamatch_set.filter(done=True))
-        n_not_started = len(self.katamatch_set.filter(done=False))
+        with transaction.atomic():
+            for m in matches:
+                if m.round_id != self.id:
+                    raise ValueError("Match {} isn't in round {}.".format(m.id, self.id))
+                m.round = self
+                m.save(update_round=False)
+            self.match_callback()
+            self.update_division()
+    
+    
+    def update_division(self):
+        bracket = self.bracket
+        if bracket.division is not None:
+            bracket.division.update_state(bracket)
+    
+    
+    def match_callback(self, match=None):
+        """Update the tie-break rounds after a match of the round changed.
         
-        # Lock predecessor rounds
-        if self.prev_round is not None:
-            old_locked = self.prev_round.locked
-            self.prev_round.locked = n_done > 0
-            if self.prev_round.locked != old_locked:
-                self.prev_round.save()
+        `match` is None when adding or removing a person, or after saving several matches. The tie-break rounds are
+        compared with the ties of the round, so only the ones that changed are replaced. Runs the same number of
+        queries whatever the size of the round.
+        """
         
-        # Clear child rounds. If any of them had started, we would be locked.
-        children = self.kataround_set.all()
-        if len(children) > 0:
-            children.delete()
+        if self.locked:
+            raise ValidationError("Can't modify round if locked.")
         
-        # Spawn child rounds
-        if self.done:
-            batch = []
-            n_winner = 0
-            order = 0
-            itr = peekable(self.katamatch_set.all())
-            for m in itr: # Sorted already
-                batch.append(m)
-                next_m = itr.peek(None)
-                if next_m is None or next_m < m:
-                    if len(batch) == 1:
-                        pass # Have winner. Don't actually care who they are.
-                    else:
-                        # Have tie
-                        round = KataRound(bracket=self.bracket, prev_round=self, round=self.round+1, order=order, 
-                            n_winner_needed=min(len(batch), self.n_winner_needed - n_winner))
-                        round.save()
-                        order -= 1
-                        for p in batch:
-                            m = KataMatch(eventlink=p.eventlink, round=round)
-                            m.save()
-                    n_winner += len(batch)
-                    del batch[:]
-                    
-                    if n_winner >= self.n_winner_needed:
+        with transaction.atomic():
+            matches = list(self.katamatch_set.all()) # Sorted already
+            n_done = sum(1 for m in matches if m.done)
+            
+            # Lock predecessor rounds
+            if self.prev_round_id is not None:
+                locked = n_done > 0
+                KataRound.objects.filter(id=self.prev_round_id).exclude(locked=locked).update(locked=locked)
+                if KataRound.prev_round.is_cached(self):
+                    self.prev_round.locked = locked
+            
+            ties = self._get_ties(matches) if n_done == len(matches) else []
+            
+            # Keep the child rounds of ties that haven't changed. If any of them had started, we would be locked.
+            children = list(self.kataround_set.all())
+            people = {}
+            for (round_id, eventlink_id) in KataMatch.objects.filter(round__in=children).values_list(
+                    'round_id', 'eventlink_id'):
+                people.setdefault(round_id, set()).add(eventlink_id)
+            
+            new_rounds = []
+            for (n, (eventlinks, n_winner_needed)) in enumerate(ties):
+                order = -n
+                for (i, child) in enumerate(children):
+                    if people.get(child.id, set()) == set(eventlinks) and child.n_winner_needed == n_winner_needed:
+                        del children[i]
+                        if child.order != order:
+                            KataRound.objects.filter(id=child.id).update(order=order)
                         break
+                else:
+                    new_rounds.append((KataRound(bracket_id=self.bracket_id, prev_round=self, round=self.round+1,
+                        order=order, n_winner_needed=n_winner_needed), eventlinks))
+            
+            if len(children) > 0:
+                KataRound.objects.filter(id__in=[r.id for r in children]).delete()
+            
+            # Saving each match would run this callback on the new rounds, which has nothing to do without scores
+            bulk_create_with_ids(KataRound, [r for (r, _) in new_rounds])
+            KataMatch.objects.bulk_create(
+                [KataMatch(eventlink_id=p, round=r) for (r, eventlinks) in new_rounds for p in eventlinks])
+    
+    
+    def _get_ties(self, matches):
+        """Returns the ties that need a tie-break round.
+        
+        Args:
+            matches: The completed matches of the round, sorted.
+        
+        Returns:
+            List of (eventlink ids, number of winners needed) tuples, best scores first.
+        """
+        
+        ties = []
+        batch = []
+        n_winner = 0
+        itr = peekable(matches)
+        for m in itr:
+            batch.append(m)
+            next_m = itr.peek(None)
+            if next_m is None or next_m < m:
+                if len(batch) > 1:
+                    ties.append(([p.eventlink_id for p in batch], min(len(batch), self.n_winner_needed - n_winner)))
+                # Else have winner. Don't actually care who they are.
+                n_winner += len(batch)
+                del batch[:]
+                
+                if n_winner >= self.n_winner_needed:
+                    break
+        return ties
 
 
 class KataBracket(models.Model):
@@ -234,6 +395,11 @@ class KataBracket(models.Model):
         return None
     
     
+    def is_done(self):
+        """Returns true if all the matches have been scored."""
+        return not KataMatch.objects.filter(round__bracket=self, done=False).exists()
+    
+    
     def build(self, people):
         
         round = KataRound(bracket=self, round=0, order=0, n_winner_needed=min(3, len(people)))
@@ -260,16 +426,115 @@ class KataBracket(models.Model):
     
     
     def get_winners(self):
-        n_round = self.n_round
-        points = {p: [0] * (2*n_round + 1) for p in self.get_people()}
+        winners = KataBracket._rank_winners(KataBracket._get_scores([self.id]).get(self.id, []))
+        people = EventLink.objects.in_bulk([p for (_, p) in winners if p is not None])
+        return [(rank, people.get(p)) for (rank, p) in winners]
+    
+    
+    @staticmethod
+    def get_results(division_ids):
+        """Returns the brackets of several divisions and their winners with a fixed number of queries.
+        
+        Args:
+            division_ids: Ids of the :class:`.Division`s to look up.
+        
+        Returns:
+            List of (bracket, winners) tuples. `winners` matches :meth:`get_winners` if the bracket has no
+            matches left to run and is None otherwise.
+        """
+        
+        brackets = list(KataBracket.objects.filter(division__in=division_ids))
+        scores = KataBracket._get_scores([b.id for b in brackets])
+        
+        winners = {}
+        for b in brackets:
+            rows = scores.get(b.id, [])
+            if all(n == n_done for (_, _, _, _, n, n_done) in rows):
+                winners[b.id] = KataBracket._rank_winners(rows)
+        people = EventLink.objects.in_bulk([p for w in winners.values() for (_, p) in w if p is not None])
+        
+        results = []
+        for b in brackets:
+            if b.id in winners:
+                results.append((b, [(rank, people.get(p)) for (rank, p) in winners[b.id]]))
+            else:
+                results.append((b, None))
+        return results
+    
+    
+    @staticmethod
+    def get_progress(division_ids):
+        """Returns the brackets of several divisions, their next two matches and how many matches are done.
+        
+        Tie-break rounds add matches to a bracket once they are needed. See :meth:`.DivisionProgress.build`.
+        """
+        
+        brackets = list(KataBracket.objects.filter(division__in=division_ids))
+        counts = {x['round__bracket_id']: x for x in KataMatch.objects.filter(round__bracket__in=brackets).values(
+            'round__bracket_id').annotate(n=models.Count('id'), n_done=models.Count('id', filter=models.Q(done=True))
+            ).order_by()}
+        
+        # Same order as get_next_match()
+        pending = {}
+        for m in KataMatch.objects.filter(round__bracket__in=brackets, done=False).select_related(
+                'round', 'eventlink__person').order_by('round__round', 'round__order', *KataMatch._meta.ordering):
+            pending.setdefault(m.round.bracket_id, []).append(m)
+        
+        results = []
+        for b in brackets:
+            matches = pending.get(b.id, [])[:2]
+            count = counts.get(b.id, {'n': 0, 'n_done': 0})
+            results.append((b, matches, count['n_done'], count['n']))
+        
+        # Names of teams
+        teams = [m.eventlink for (_, matches, _, _) in results for m in matches if m.eventlink.is_team]
+        models.prefetch_related_objects(teams, 'eventlink_set__person')
+        
+        return results
+    
+    
+    @staticmethod
+    def _get_scores(bracket_ids):
+        """Returns the scores of several brackets summed per person and round with a single aggregate query.
+        
+        Returns:
+            Dict of bracket id to a list of (eventlink id, round, combined score, tie score, number of matches,
+            number of completed matches) tuples sorted by eventlink id and round. The scores are the sums over the
+            completed matches, None if there are none.
+        """
+        
+        scores = {}
+        for (bracket_id, *row) in KataMatch.objects.filter(round__bracket__in=bracket_ids).values_list(
+                'round__bracket_id', 'eventlink_id', 'round__round').annotate(
+                combined=models.Sum('combined_score'), tie=models.Sum('tie_score'), n=models.Count('id'),
+                n_done=models.Count('id', filter=models.Q(done=True))).order_by('eventlink_id', 'round__round'):
+            scores.setdefault(bracket_id, []).append(tuple(row))
+        return scores
+    
+    
+    @staticmethod
+    def _rank_winners(scores):
+        """Rank the people of a bracket.
+        
+        People are ranked on their scores in the first round, then in each tie-break round. People with the same
+        scores share a rank and are listed by eventlink id.
+        
+        Args:
+            scores: Scores of the bracket from :meth:`_get_scores`.
+        
+        Returns:
+            List of (rank, eventlink id) tuples. The eventlink id is None for ranks no one has reached yet.
+        """
+        
+        n_round = max((r for (_, r, _, _, _, _) in scores), default=-1) + 1
+        points = {p: [0] * (2*n_round + 1) for (p, r, _, _, _, _) in scores if r == 0} # Everyone is in the first round
         n_winner = min(len(points), 3)
-        matches = KataMatch.objects.filter(round__bracket=self, done=True)
         
-        for m in matches:
-            r = m.round.round
-            points[m.eventlink][2*r] += m.combined_score
-            points[m.eventlink][2*r+1] += m.tie_score
-            points[m.eventlink][2*n_round] += 1
+        for (p, r, combined, tie, _, n_done) in scores:
+            if n_done > 0:
+                points[p][2*r] += combined
+                points[p][2*r+1] += tie
+                points[p][2*n_round] += n_done
         points = [(p, score) for (p, score) in points.items() if score[-1] > 0]
         for (p, score) in points:
             del score[-1]
@@ -297,19 +562,63 @@ class KataBracket(models.Model):
         return winners
 
 
+class KataBracketSnapshot():
+    """All the rounds and matches of a kata bracket and their people, loaded at once.
+    
+    The matches are linked to their round and the rounds to their matches in memory, so rendering the bracket runs
+    the same number of queries whatever the number of people and tie-break rounds.
+    
+    Args:
+        bracket: A :class:`KataBracket`.
+    """
+    
+    def __init__(self, bracket):
+        self.bracket = bracket
+        self.rounds = list(bracket.kataround_set.prefetch_related(models.Prefetch('katamatch_set',
+            queryset=KataMatch.objects.select_related('eventlink__person'))))
+        for r in self.rounds:
+            r.bracket = bracket
+        self.matches = [m for r in self.rounds for m in r.katamatch_set.all()]
+        
+        # Names of teams
+        teams = [m.eventlink for m in self.matches if m.eventlink.is_team]
+        models.prefetch_related_objects(teams, 'eventlink_set__person')
+    
+    
+    def get_next_match(self):
+        """Same as :meth:`KataBracket.get_next_match`."""
+        for m in self.matches: # By round, then sorted
+            if not m.done:
+                return m
+        return None
+    
+    
+    def get_winners(self):
+        """Same as :meth:`KataBracket.get_winners`."""
+        
+        scores = {}
+        for m in self.matches:
+            (combined, tie, n, n_done) = scores.get((m.eventlink_id, m.round.round), (None, None, 0, 0))
+            if m.done:
+                combined = m.combined_score + (combined or 0)
+                tie = m.tie_score + (tie or 0)
+                n_done += 1
+            scores[(m.eventlink_id, m.round.round)] = (combined, tie, n + 1, n_done)
+        winners = KataBracket._rank_winners([key + value for (key, value) in sorted(scores.items())])
+        
+        people = {m.eventlink_id: m.eventlink for m in self.matches}
+        return [(rank, people.get(p)) for (rank, p) in winners]
 
 
+@receiver(post_save, sender=KataBracket)
+def kata_bracket_post_save(sender, instance, created, **kwargs):
+    if created:
+        Division.bracket_created(instance)
 
 
+@receiver(post_delete, sender=KataBracket)
+def kata_bracket_post_delete(sender, instance, **kwargs):
+    Division.bracket_deleted(instance.division_id)
 
 
-
-
-
-
-
-
-
-
-
-
+DivisionProgress.connect(KataMatch, KataRound)
@@ -1,9 +1,13 @@
+from decimal import Decimal
+from unittest import mock
+
 from django.urls import reverse
 from django.test import TestCase
 
 from django_webtest import WebTest
 
 from registration.models import Event, Division, Person, Rank, EventLink
+from .models import KataMatch, KataRound
 from .views import KataBracketDetails
 from accounts.models import RightsSupport
 
@@ -213,4 +217,158 @@ class KataDetailTestCase(WebTest):
         # Check totals
         self.assertEqual(tds[6].string, "9")
         self.assertEqual(tds[7].string, "15")
-        
\ No newline at end of file
+        
+        # A judge scores the match while the form is open
+        match = bracket.kataround_set.all()[0].katamatch_set.get(eventlink__person=p1)
+        resp = self.app.get(reverse('kata:bracket-match-edit', args=[bracket.id, match.id]))
+        KataMatch.set_judge_score(match.id, 1, 7)
+        for i in range(1,6):
+            resp.form['score{}'.format(i)] = 5
+        resp.form.submit("save").mustcontain("The scores of a changed in the meantime")
+        match.refresh_from_db()
+        self.assertEqual(match.scores, (7, None, None, None, None))
+            
+    
+    def test_score_round(self):
+        e = Event(name="Kata", format=Event.EventFormat.kata)
+        e.save()
+        d = Division(event=e, gender='MF', start_age=1, stop_age=99, start_rank=Rank.get_kyu(9),
+            stop_rank=Rank.get_dan(9))
+        d.save()
+        for name in ("a", "b", "c", "d"):
+            p = Person(first_name=name, last_name="", gender='M', age=1, rank=Rank.get_kyu(8), instructor="asdf",
+                confirmed=True)
+            p.save()
+            EventLink(person=p, event=e).save()
+        d.build_format()
+        bracket = d.get_format()
+        round = bracket.kataround_set.get()
+        
+        url = reverse('kata:bracket-round-scores', args=[bracket.id, round.id])
+        resp = self.app.get(bracket.get_absolute_url())
+        self.assertEqual(len(resp.html.find_all("form", action=url)), 1)
+        resp = self.app.get(url)
+        
+        def fill(form, scores):
+            for (i, match_form) in enumerate(resp.context['formset']):
+                name = match_form.instance.eventlink.name
+                for j in range(5):
+                    form['form-{}-score{}'.format(i, j + 1)] = scores[name][j] if name in scores else ""
+        
+        # All or none of the scores of a match
+        form = resp.forms['scores_form']
+        fill(form, {"a": [5, 5, 5, 5, 5], "b": [6, 6, 6, "", ""]})
+        resp = form.submit("save")
+        self.assertEqual(resp.status_code, 200)
+        resp.mustcontain("Set either all or none of the scores.")
+        self.assertFalse(round.katamatch_set.filter(done=True).exists())
+        
+        # A judge scores a match while the form is open, nothing is saved
+        resp = self.app.get(url)
+        form = resp.forms['scores_form']
+        fill(form, {"a": [5, 5, 5, 5, 5], "b": [6, 6, 6, 6, 6]})
+        KataMatch.set_judge_score(round.katamatch_set.get(eventlink__person__first_name="b").id, 1, 7)
+        form.submit("save").mustcontain("The scores of b changed in the meantime")
+        self.assertEqual([m.scores[0] for m in round.katamatch_set.order_by('eventlink__person__first_name')],
+            [None, 7, None, None])
+        
+        # b and c tie for second. The tie-break round is built once.
+        resp = self.app.get(url)
+        form = resp.forms['scores_form']
+        fill(form, {"a": [9] * 5, "b": [8] * 5, "c": [8] * 5, "d": [7, 7, 7, 7, 6]})
+        with mock.patch.object(KataRound, 'match_callback', autospec=True,
+                side_effect=KataRound.match_callback) as callback:
+            resp = form.submit("save")
+        self.assertEqual(callback.call_count, 1)
+        self.assertRedirects(resp, bracket.get_absolute_url())
+        
+        resp = resp.follow()
+        self.assertEqual([m.combined_score for m in round.katamatch_set.all()], [27, 24, 24, 21])
+        tie = bracket.kataround_set.get(round=1)
+        self.assertEqual(sorted(m.eventlink.name for m in tie.katamatch_set.all()), ["b", "c"])
+        d.refresh_from_db()
+        self.assertEqual(d.state, Division.State.running)
+        
+        # A locked round can't be scored
+        m = tie.katamatch_set.all()[0]
+        m.scores = [8] * 5
+        m.save()
+        resp = self.app.get(url)
+        resp.forms['scores_form'].submit("save").mustcontain("Round is locked.")
+        
+        self.app.get(reverse('kata:bracket-round-scores', args=[bracket.id + 1, round.id]), status=404)
+        self.app.get(url, user=RightsSupport.create_view_user(), status=403)
+    
+    
+    def test_judge(self):
+        e = Event(name="Kata", format=Event.EventFormat.kata)
+        e.save()
+        d = Division(event=e, gender='MF', start_age=1, stop_age=99, start_rank=Rank.get_kyu(9),
+            stop_rank=Rank.get_dan(9))
+        d.save()
+        for name in ("a", "b"):
+            p = Person(first_name=name, last_name="", gender='M', age=1, rank=Rank.get_kyu(8), instructor="asdf",
+                confirmed=True)
+            p.save()
+            EventLink(person=p, event=e).save()
+        d.build_format()
+        bracket = d.get_format()
+        match = bracket.get_next_match()
+        
+        # Every judge loads their page before anyone sends a score
+        urls = [reverse('kata:bracket-judge', args=[bracket.id, judge]) for judge in range(1, 6)]
+        forms = [self.app.get(url).forms[0] for url in urls]
+        self.assertEqual(forms[0]['match'].value, str(match.id))
+        
+        forms[0]['score'] = "11"
+        forms[0].submit().mustcontain("is not a number between 0 and 10.")
+        
+        for (judge, form) in enumerate(forms):
+            form['score'] = str(5 + judge)
+            resp = form.submit()
+            self.assertRedirects(resp, urls[judge])
+        match.refresh_from_db()
+        self.assertEqual(match.scores, (5, 6, 7, 8, 9))
+        self.assertEqual(match.combined_score, 21)
+        
+        # The match is done, the judges move on to the next one
+        resp = self.app.get(urls[0])
+        self.assertNotEqual(resp.forms[0]['match'].value, str(match.id))
+        forms[0]['score'] = "5"
+        forms[0].submit().mustcontain("The match has all its scores.")
+        self.app.get(urls[0], user=RightsSupport.create_view_user(), status=403)
+    
+    
+    def test_num_queries(self):
+        e = Event(name="Team kata", format=Event.EventFormat.kata, is_team=True)
+        e.save()
+        
+        def make_bracket(n, n_ties):
+            d = Division(event=e, gender='MF', start_age=1, stop_age=99, start_rank=Rank.get_kyu(9),
+                stop_rank=Rank.get_dan(9))
+            d.save()
+            teams = []
+            for i in range(n):
+                team = EventLink.objects.create(event=e, division=d, is_team=True)
+                for j in range(3):
+                    p = Person.objects.create(first_name="{}-{}".format(i, j), last_name="", gender='M', age=1,
+                        rank=Rank.get_kyu(8), instructor="asdf", confirmed=True)
+                    EventLink.objects.create(person=p, event=e, division=d, team=team)
+                teams.append(team)
+            EventLink.objects.create(manual_name="late", event=e, division=d)
+            bracket = d.build_format()
+            
+            # Everyone ties every round
+            for level in range(n_ties):
+                for m in bracket.kataround_set.get(round=level).katamatch_set.all():
+                    m.scores = [Decimal(8)] * 5
+                    m.save()
+            return bracket
+        
+        # At least two levels of ties, so the first round is locked and the page has no form to add a team
+        self.app.get(make_bracket(2, 2).get_absolute_url()) # Fills the caches
+        for (n, n_ties) in [(3, 2), (8, 2), (3, 5), (8, 5)]:
+            bracket = make_bracket(n, n_ties)
+            with self.assertNumQueries(12):
+                resp = self.app.get(bracket.get_absolute_url())
+            resp.mustcontain("Team {}-0, {}-1 and {}-2".format(n - 1, n - 1, n - 1), "Round {}".format(n_ties + 1))
@@ -1,7 +1,15 @@
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db.models import F
+from django.db.models.query import QuerySet
 from django.test import TestCase
 
 from registration.models import Event, Division, EventLink
-from .models import KataBracket
+from .models import KataBracket, KataBracketSnapshot, KataMatch, KataRound
 
 import math
 
@@ -502,10 +510,105 @@ class TestKataBracket(TestCase):
         m = b.get_next_match()
         self.assertEqual(m, None)
         self.assertEqual(b.get_winners(), [(1, get_person(b, "b")), (2, get_person(b, "a")), (3, get_person(b, "c"))])
+    
+    
+    def test_incremental_ties(self):
+        def get_ties(b):
+            self.assertEqual(KataBracketSnapshot(b).get_winners(), b.get_winners())
+            return sorted((r.n_winner_needed, sorted(m.eventlink.manual_name for m in r.katamatch_set.all()))
+                for r in b.kataround_set.filter(round=1))
+        
+        for n in [4, 20]:
+            # b and c tie for second
+            b = make_bracket(n)
+            matches = sorted(b.kataround_set.get(round=0).katamatch_set.select_related('eventlink'),
+                key=lambda m: m.eventlink.manual_name)
+            for (i, m) in enumerate(matches):
+                m.scores = [{0: 9, 1: 8, 2: 8}.get(i, Decimal(7) - Decimal('0.1') * i)] * 5
+                m.save()
+            self.assertEqual(get_ties(b), [(2, ["b", "c"])])
+            
+            # Changing a score that doesn't change the ties keeps the tie-break round
+            matches[-1].scores = [1] * 5
+            with self.assertNumQueries(8) as queries:
+                matches[-1].save()
+            self.assertEqual([q['sql'] for q in queries if 'kata_kataround' in q['sql'] and
+                not q['sql'].startswith('SELECT')], [])
+            
+            # a joins the tie, then leaves it
+            matches[0].scores = [8] * 5
+            matches[0].save()
+            self.assertEqual(get_ties(b), [(3, ["a", "b", "c"])])
+            matches[0].scores = [9] * 5
+            matches[0].save()
+            self.assertEqual(get_ties(b), [(2, ["b", "c"])])
+            
+            # Clearing a score removes the tie-break rounds
+            matches[-1].scores = [None] * 5
+            matches[-1].save()
+            self.assertEqual(get_ties(b), [])
+    
+    
+    def test_standings_benchmark(self):
+        out = StringIO()
+        call_command('kata_standings_benchmark', people=5, levels=2, repeat=1, stdout=out)
+        self.assertIn("Winners: 1. Competitor 5 - No division, 2. Competitor 4 - No division, 3. Competitor 3 -",
+            out.getvalue())
+        self.assertIn("get_winners with 5 people and 2 tie-break rounds: 2 queries", out.getvalue())
+        self.assertFalse(Event.objects.filter(name="Standings benchmark").exists())
 
 
 class TestKataMatch(TestCase):
     
+    def test_judge_scores(self):
+        b = make_bracket(2)
+        m = b.get_next_match()
+        
+        # The round is updated once, with the last score
+        with mock.patch.object(KataRound, 'match_callback', autospec=True,
+                side_effect=KataRound.match_callback) as callback:
+            for judge in range(1, 5):
+                self.assertFalse(KataMatch.set_judge_score(m.id, judge, Decimal(judge + 4)))
+            m.refresh_from_db()
+            self.assertEqual(m.scores, (5, 6, 7, 8, None))
+            self.assertFalse(m.done)
+            self.assertEqual(callback.call_count, 0)
+            
+            self.assertTrue(KataMatch.set_judge_score(m.id, 5, Decimal(9)))
+            self.assertEqual(callback.call_count, 1)
+        m.refresh_from_db()
+        self.assertTrue(m.done)
+        self.assertEqual(m.combined_score, 21)
+        self.assertEqual(m.tie_score, 35)
+        with self.assertRaises(ValidationError):
+            KataMatch.set_judge_score(m.id, 1, Decimal(5))
+        
+        # Other judges write between reading and writing the match
+        m = b.get_next_match()
+        get = QuerySet.get
+        gets = []
+        def get_and_write(qs, *args, **kwargs):
+            obj = get(qs, *args, **kwargs)
+            if qs.model == KataMatch and len(gets) < n_writes:
+                gets.append(obj)
+                KataMatch.objects.filter(id=m.id).update(score2=Decimal(len(gets)), version=F('version') + 1)
+            return obj
+        
+        n_writes = 1
+        with mock.patch.object(QuerySet, 'get', get_and_write):
+            self.assertFalse(KataMatch.set_judge_score(m.id, 1, Decimal(7)))
+        m.refresh_from_db()
+        self.assertEqual(m.scores, (7, 1, None, None, None))
+        
+        gets.clear()
+        n_writes = 10
+        with mock.patch.object(QuerySet, 'get', get_and_write):
+            with self.assertRaises(RuntimeError):
+                KataMatch.set_judge_score(m.id, 3, Decimal(7), max_tries=3)
+        m.refresh_from_db()
+        self.assertEqual(m.scores, (7, 3, None, None, None))
+    
+
     def test_cmp(self):
         """Test that comparisson works properly."""
         b = make_bracket(2)
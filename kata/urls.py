@@ -8,6 +8,9 @@ urlpatterns = [
 #    url(r'^$', views.IndexView.as_view(), name='index'),
     url(r'^(?P<pk>[0-9]+)/$', views.KataBracketDetails.as_view(), name='bracket'),
     url(r'^(?P<bracket>[0-9]+)/edit/(?P<pk>[0-9]+)/$', views.KataBracketEditMatch.as_view(), name='bracket-match-edit'),
+    url(r'^(?P<bracket>[0-9]+)/round/(?P<pk>[0-9]+)/scores/$', views.KataRoundEditScores.as_view(),
+        name='bracket-round-scores'),
+    url(r'^(?P<pk>[0-9]+)/judge/(?P<judge>[1-5])/$', views.KataJudgeScore.as_view(), name='bracket-judge'),
     url(r'^(?P<bracket>[0-9]+)/delete/(?P<pk>[0-9]+)/$', views.KataBracketDeleteMatch.as_view(), name='bracket-match-delete'),
     url(r'^(?P<pk>[0-9]+)/add/$', views.KataBracketAddMatch.as_view(), name='bracket-match-add'),
     url(r'^(?P<pk>[0-9]+)/addTeam/$', views.KataBracketAddTeamMatch.as_view(), name='bracket-team-match-add'),
@@ -1,26 +1,35 @@
+from django.contrib import messages
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.core.exceptions import ValidationError
 from django.views import generic
 from django.views.generic.edit import CreateView, UpdateView, DeleteView, ModelFormMixin, FormView
 from django.urls import reverse_lazy, reverse
 from django.http import Http404
+from django.db import transaction
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_POST
 
-from registration.models import EventLink
+from common.views import ReplicaMixin, VersionedPageMixin
+from registration.models import EventLink, Division
 
-from .models import KataBracket, KataRound, KataMatch
-from .forms import KataMatchForm, KataBracketAddPersonForm, KataBracketAddTeamForm
+from .models import KataBracket, KataBracketSnapshot, KataRound, KataMatch
+from .forms import KataMatchForm, KataRoundScoresFormSet, KataJudgeScoreForm, KataBracketAddPersonForm, KataBracketAddTeamForm
 
 # Create your views here.
 
-class KataBracketDetails(PermissionRequiredMixin, generic.DetailView):
+class KataBracketDetails(ReplicaMixin, VersionedPageMixin, PermissionRequiredMixin, generic.DetailView):
     model = KataBracket
     context_object_name = "bracket"
     permission_required = 'accounts.view'
     
     
+    def get_version(self):
+        return Division.get_version(KataBracket, self.kwargs['pk'])
+    
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['snapshot'] = KataBracketSnapshot(self.object)
         context['editing'] = False
         
         if self.object.division.event.is_team:
@@ -63,14 +72,142 @@ class KataBracketEditMatch(PermissionRequiredMixin, UpdateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['bracket'] = self.bracket
+        context['snapshot'] = KataBracketSnapshot(self.bracket)
         context['editing'] = True
         return context
     
     
+    def form_valid(self, form):
+        try:
+            return super().form_valid(form)
+        except ValidationError as e:
+            form.add_error(None, e)
+            return self.form_invalid(form)
+    
+    
     def get_success_url(self):
         return reverse('kata:bracket', args=[self.bracket.id]) + "?highlight={}".format(self.object.id)
 
 
+class KataRoundEditScores(PermissionRequiredMixin, generic.detail.SingleObjectMixin, FormView):
+    """Enter the scores of every match of a round in one form.
+    
+    The matches are saved in a single transaction and the tie-break rounds are updated once at the end.
+    """
+    
+    template_name = 'kata/katabracket_detail.html'
+    model = KataRound
+    form_class = KataRoundScoresFormSet
+    permission_required = 'accounts.edit'
+    
+    
+    def get_object(self, queryset=None):
+        
+        obj = super().get_object(queryset=queryset)
+        self.bracket = obj.bracket
+        if self.bracket.id != int(self.kwargs['bracket']):
+            raise Http404("No KataBrackets found matching the query")
+        return obj
+    
+    
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return super().get(request, *args, **kwargs)
+    
+    
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return super().post(request, *args, **kwargs)
+    
+    
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['round'] = self.object
+        return kwargs
+    
+    
+    def form_valid(self, form):
+        try:
+            form.save()
+        except ValidationError as e:
+            form.non_form_errors().extend(e.messages)
+            return self.form_invalid(form)
+        return super().form_valid(form)
+    
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['bracket'] = self.bracket
+        context['snapshot'] = KataBracketSnapshot(self.bracket)
+        context['editing'] = True
+        context['formset'] = context.pop('form')
+        return context
+    
+    
+    def get_success_url(self):
+        return reverse('kata:bracket', args=[self.bracket.id])
+
+
+class KataJudgeScore(PermissionRequiredMixin, generic.detail.SingleObjectMixin, FormView):
+    """Score entry of one judge, meant to stay open on their phone.
+    
+    Shows the next match of the bracket. The judges send their scores at the same time, see
+    :meth:`.KataMatch.set_judge_score`.
+    """
+    
+    template_name = 'kata/katamatch_judge.html'
+    model = KataBracket
+    context_object_name = 'bracket'
+    form_class = KataJudgeScoreForm
+    permission_required = 'accounts.edit'
+    
+    
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return super().get(request, *args, **kwargs)
+    
+    
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return super().post(request, *args, **kwargs)
+    
+    
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['bracket'] = self.object
+        return kwargs
+    
+    
+    def form_valid(self, form):
+        match = form.cleaned_data['match']
+        try:
+            KataMatch.set_judge_score(match.id, int(self.kwargs['judge']), form.cleaned_data['score'])
+        except (ValidationError, RuntimeError) as e:
+            form.add_error(None, e if isinstance(e, ValidationError) else str(e))
+            return self.form_invalid(form)
+        messages.success(self.request, "Sent {} for {}.".format(form.cleaned_data['score'], match.eventlink.name))
+        return super().form_valid(form)
+    
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form = context['form']
+        match = form.cleaned_data.get('match') if form.is_bound else None
+        if match is None:
+            match = self.object.get_next_match()
+        context['match'] = match
+        context['judge'] = int(self.kwargs['judge'])
+        if match is not None:
+            context['score'] = getattr(match, 'score{}'.format(context['judge']))
+            if not form.is_bound:
+                form.initial['match'] = match.id
+        return context
+    
+    
+    def get_success_url(self):
+        return self.request.path
+
+
 @method_decorator(require_POST, name='dispatch')
 class KataBracketDeleteMatch(PermissionRequiredMixin, DeleteView):
     template_name = 'kata/katabracket_detail.html'
@@ -84,6 +221,7 @@ class KataBracketDeleteMatch(PermissionRequiredMixin, DeleteView):
         return obj
     
     
+    @transaction.atomic
     def delete(self, request, *args, **kwargs):
         
         obj = self.get_object()
@@ -97,6 +235,8 @@ class KataBracketDeleteMatch(PermissionRequiredMixin, DeleteView):
         if p.is_manual or p.is_team:
             p.delete()
         round.match_callback(None)
+        if self.bracket.division is not None:
+            self.bracket.division.update_state(self.bracket)
         
         return ret
     
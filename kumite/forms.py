@@ -4,7 +4,7 @@ from django.core.exceptions import ValidationError
 
 from betterforms.multiform import MultiModelForm
 
-from .models import KumiteMatch, KumiteMatchPerson
+from .models import KumiteMatch, KumiteMatchPerson, BracketSnapshot
 
 
 class KumiteMatchPersonForm(forms.ModelForm):
@@ -71,11 +71,12 @@ class KumiteMatchPersonSwapForm(forms.Form):
     tgt = forms.ModelChoiceField(queryset=KumiteMatchPerson.objects.none(), widget=forms.HiddenInput())
     prefix = 'swap'
     
-    def __init__(self, bracket=None, **kwargs):
+    def __init__(self, bracket=None, snapshot=None, **kwargs):
         
         if bracket is None:
             raise ValueError('bracket is required.')
         self.bracket = bracket
+        self._snapshot = snapshot
         
         super().__init__(**kwargs)
         
@@ -84,24 +85,31 @@ class KumiteMatchPersonSwapForm(forms.Form):
         self.fields['tgt'].queryset = people
     
     
-    def clean_src(self):
-        # This should never actually get used because the get_swappable_match_people() queryset limits the choices.
-        value = self.cleaned_data['src']
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = BracketSnapshot(self.bracket)
+        return self._snapshot
+    
+    
+    def clean_swappable_person(self, value):
+        """Returns the person from the :class:`.BracketSnapshot` so their match is available without a query."""
+        
+        # This should never actually fail because the get_swappable_match_people() queryset limits the choices.
+        value = self.snapshot.people.get(value.id)
+        if value is None:
+            raise forms.ValidationError("Person not in bracket.")
         if not value.is_swappable():
             raise forms.ValidationError("Can't be swapped.")
-        if value.kumitematch.bracket != self.bracket:
-            raise forms.ValidationError("Person not in bracket.")
         return value
     
     
+    def clean_src(self):
+        return self.clean_swappable_person(self.cleaned_data['src'])
+    
+    
     def clean_tgt(self):
-        # This should never actually get used because the get_swappable_match_people() queryset limits the choices.
-        value = self.cleaned_data['tgt']
-        if not value.is_swappable():
-            raise forms.ValidationError("Can't be swapped.")
-        if value.kumitematch.bracket != self.bracket:
-            raise forms.ValidationError("Person not in bracket.")
-        return value
+        return self.clean_swappable_person(self.cleaned_data['tgt'])
     
     
     def clean(self):
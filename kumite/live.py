@@ -0,0 +1,301 @@
+"""Live scoreboard channels shared between devices.
+
+The scoreboard in ``kumitematch_form.html`` mirrors the scorer's page to the audience displays. ``BroadcastChannel``
+only reaches tabs of the same browser, so the scorer also POSTs each ``kumite-set-scores`` and ``kumite-set-time``
+message to the ``kumite:match-live`` URL of the match. Displays on other devices keep a GET on the same URL open and
+receive the messages as Server-Sent Events.
+
+Which match to show travels the same way. Each display, e.g. the TV of a ring, has a name and ``slave.html`` listens
+to the ``kumite:display-live`` URL of that name. The scorer's page sends the ``load-page`` message there when a match
+is opened or left. The display name of the scorer is remembered in their session, see :class:`.KumiteMatchUpdate`.
+
+Holding a connection open per display doesn't suit the WSGI server, so the channel is served by
+:class:`LiveApplication`, the ASGI application in ``tournament/asgi.py``, and ``nginx.conf`` sends the ``live`` URLs
+to it. The subscribers are kept in the memory of the process, so run a single ASGI worker.
+
+Use ``./manage.py live_benchmark`` to measure the delivery latency with many displays.
+"""
+
+import asyncio
+from http.cookies import SimpleCookie
+import json
+
+from django.urls import resolve, Resolver404
+
+
+# Messages that are passed on to the displays
+COMMANDS = ('kumite-set-scores', 'kumite-set-time')
+
+# Message sent by the scorer's page when it is left, e.g. once the match is done
+CLOSE = 'kumite-close'
+
+# Message telling a display which page to show. Its data is the path of the page.
+LOAD_PAGE = 'load-page'
+
+# Display of the scorers and TVs that didn't pick one
+DEFAULT_DISPLAY = 'main'
+
+
+def display_channel(name):
+    """Returns the :class:`MatchHub` channel of a display. Match channels are the ids of the matches."""
+    return ('display', name)
+
+
+class MatchHub():
+    """Fans out the messages of each channel, a match or a display, to its subscribers.
+    
+    Every subscriber has a queue. If a display can't keep up, its oldest messages are dropped since only the latest
+    scores and time matter. The last message of each command is replayed to new subscribers so a display that
+    connects mid-match starts with the current state. For a match, it is forgotten when the last subscriber leaves or
+    the match is closed.
+    
+    Only use from the thread running the event loop.
+    
+    Args:
+        queue_size (optional): Number of messages held for each subscriber.
+    """
+    
+    def __init__(self, queue_size=20):
+        self.queue_size = queue_size
+        self._subscribers = {} # channel -> set of queues
+        self._last = {} # channel -> {cmd: message}
+    
+    
+    def subscribe(self, channel):
+        """Returns a new :class:`asyncio.Queue` that receives the encoded messages of the channel."""
+        
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        for message in self._last.get(channel, {}).values():
+            queue.put_nowait(message)
+        self._subscribers.setdefault(channel, set()).add(queue)
+        return queue
+    
+    
+    def unsubscribe(self, channel, queue, forget=True):
+        """Stop sending the messages of the channel to the queue.
+        
+        Args:
+            forget (optional): Forget the last messages if this was the last subscriber. A display keeps the page to
+                show for when it reconnects.
+        """
+        
+        subscribers = self._subscribers.get(channel, set())
+        subscribers.discard(queue)
+        if len(subscribers) == 0:
+            self._subscribers.pop(channel, None)
+            if forget:
+                self._last.pop(channel, None)
+    
+    
+    def publish(self, channel, cmd, data):
+        """Send a message to every subscriber of the channel.
+        
+        Returns:
+            The number of subscribers.
+        """
+        
+        message = encode_event(cmd, data)
+        self._last.setdefault(channel, {})[cmd] = message
+        subscribers = self._subscribers.get(channel, ())
+        for queue in subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+        return len(subscribers)
+    
+    
+    def close(self, channel):
+        """Forget the last messages of the match, e.g. once it is done."""
+        self._last.pop(channel, None)
+    
+    
+    def count(self, channel):
+        """Returns the number of subscribers of the channel."""
+        return len(self._subscribers.get(channel, ()))
+
+
+def encode_event(cmd, data):
+    """Returns a message formatted as a Server-Sent Event."""
+    return "event: {}\ndata: {}\n\n".format(cmd, json.dumps(data, separators=(',', ':'))).encode()
+
+
+def has_perm(cookie_header, perm):
+    """Returns True if the user of the session in the cookies has the permission. Queries the database.
+    
+    Args:
+        cookie_header: Value of the Cookie header or None.
+        perm: Permission name, e.g. ``'accounts.edit'``.
+    """
+    
+    from importlib import import_module
+    from django.conf import settings
+    from django.contrib.auth import get_user
+    from django.db import close_old_connections
+    from django.http import HttpRequest
+    
+    cookies = SimpleCookie(cookie_header or "")
+    morsel = cookies.get(settings.SESSION_COOKIE_NAME)
+    request = HttpRequest()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(morsel.value if morsel else None)
+    try:
+        return get_user(request).has_perm(perm)
+    finally:
+        close_old_connections()
+
+
+class LiveApplication():
+    """ASGI application that serves the ``kumite:match-live`` and ``kumite:display-live`` channels and passes other
+    requests to `fallback`.
+    
+    ``GET`` streams the messages of the channel as Server-Sent Events and requires the ``accounts.view`` permission.
+    ``POST`` publishes a JSON message ``{"cmd": ..., "data": ...}`` and requires ``accounts.edit``. Requiring a JSON
+    body means browsers won't send it cross-site without a CORS preflight, which is never allowed. A :data:`CLOSE`
+    message closes the match in the hub instead. Displays only take :data:`LOAD_PAGE` messages with a path of the
+    site.
+    
+    Args:
+        fallback (optional): ASGI application for all other requests. They get a 404 if None.
+        hub (optional): The :class:`MatchHub`. A new one by default.
+        authorize (optional): Function taking the Cookie header and a permission name that returns True if access is
+            allowed. Called in a worker thread. Defaults to :func:`has_perm`.
+        keepalive (optional): Seconds between comments sent to idle displays so proxies don't close the connection.
+    """
+    
+    max_body = 4096
+    
+    
+    def __init__(self, fallback=None, hub=None, authorize=has_perm, keepalive=15):
+        self.fallback = fallback
+        self.hub = hub if hub is not None else MatchHub()
+        self.authorize = authorize
+        self.keepalive = keepalive
+    
+    
+    async def __call__(self, scope, receive, send):
+        
+        channel = None
+        if scope['type'] == 'http':
+            try:
+                match = resolve(scope['path'])
+                if match.view_name == 'kumite:match-live':
+                    channel = int(match.kwargs['pk'])
+                elif match.view_name == 'kumite:display-live':
+                    channel = display_channel(match.kwargs['name'])
+            except Resolver404:
+                pass
+        
+        if channel is None:
+            if self.fallback is not None:
+                return await self.fallback(scope, receive, send)
+            if scope['type'] == 'lifespan':
+                return await self._lifespan(receive, send)
+            return await self._respond(send, 404)
+        
+        headers = dict((k.decode('latin-1').lower(), v.decode('latin-1')) for (k, v) in scope.get('headers', []))
+        method = scope['method']
+        if method not in ('GET', 'POST'):
+            return await self._respond(send, 405)
+        perm = 'accounts.view' if method == 'GET' else 'accounts.edit'
+        loop = asyncio.get_event_loop()
+        if not await loop.run_in_executor(None, self.authorize, headers.get('cookie'), perm):
+            return await self._respond(send, 403)
+        
+        if method == 'GET':
+            await self._stream(channel, receive, send)
+        else:
+            await self._publish(channel, headers, receive, send)
+    
+    
+    async def _stream(self, channel, receive, send):
+        
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'), # Don't let nginx buffer the events
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b"retry: 1000\n\n", 'more_body': True})
+        
+        queue = self.hub.subscribe(channel)
+        disconnect = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            while True:
+                get = asyncio.ensure_future(queue.get())
+                (done, _) = await asyncio.wait((get, disconnect), timeout=self.keepalive,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if disconnect in done:
+                    get.cancel()
+                    break
+                if get in done:
+                    body = get.result()
+                    while not queue.empty(): # Send what has piled up in one write
+                        body += queue.get_nowait()
+                else:
+                    get.cancel()
+                    body = b": keepalive\n\n"
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        finally:
+            self.hub.unsubscribe(channel, queue, forget=not isinstance(channel, tuple))
+            disconnect.cancel()
+    
+    
+    async def _publish(self, channel, headers, receive, send):
+        
+        if headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+            return await self._respond(send, 415)
+        
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b"")
+            more_body = message.get('more_body', False)
+            if len(body) > self.max_body:
+                return await self._respond(send, 413)
+        
+        try:
+            message = json.loads(body.decode())
+            cmd = message['cmd']
+            data = message['data']
+        except (ValueError, KeyError, TypeError):
+            return await self._respond(send, 400)
+        if isinstance(channel, tuple):
+            # Displays open the page blindly, so only pages of this site
+            if cmd != LOAD_PAGE or not isinstance(data, str) or not data.startswith('/') or data.startswith('//'):
+                return await self._respond(send, 400)
+            self.hub.publish(channel, cmd, data)
+        elif cmd == CLOSE:
+            self.hub.close(channel)
+        elif cmd in COMMANDS:
+            self.hub.publish(channel, cmd, data)
+        else:
+            return await self._respond(send, 400)
+        await self._respond(send, 204)
+    
+    
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    
+    
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    
+    @staticmethod
+    async def _respond(send, status):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b""})
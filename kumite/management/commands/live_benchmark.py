@@ -0,0 +1,190 @@
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from kumite.live import LiveApplication
+
+
+class Command(BaseCommand):
+    help = ('Connect fake scoreboard displays to a live kumite match channel and measure the delivery latency. '
+        'Runs the ASGI application in this process unless --url is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--displays', type=int, default=50, help='Number of displays.')
+        parser.add_argument('--messages', type=int, default=100, help='Number of score updates to send.')
+        parser.add_argument('--interval', type=float, default=0.02, help='Seconds between score updates.')
+        parser.add_argument('--match', type=int, default=1, help='Id of the match.')
+        parser.add_argument('--url', help='Address of a running ASGI server, e.g. http://192.168.1.10:8001.')
+        parser.add_argument('--cookie', default='',
+            help='Cookie header with the session of a user with edit rights. Needed with --url.')
+
+    def handle(self, *args, **options):
+        if options['displays'] < 1 or options['messages'] < 1:
+            raise CommandError('Need at least one display and one message.')
+
+        path = reverse('kumite:match-live', args=[options['match']])
+        if options['url'] is None:
+            transport = InProcess(LiveApplication(authorize=lambda cookie, perm: True), path)
+        else:
+            transport = Network(options['url'], path, options['cookie'])
+
+        latencies = asyncio.get_event_loop().run_until_complete(
+            run(transport, options['displays'], options['messages'], options['interval']))
+
+        expected = options['displays'] * options['messages']
+        self.stdout.write('Delivered {} of {} messages to {} displays.'.format(
+            len(latencies), expected, options['displays']))
+        if len(latencies) > 0:
+            ms = sorted(x * 1000 for x in latencies)
+            self.stdout.write('Latency (ms): min {:.1f}, median {:.1f}, 95% {:.1f}, 99% {:.1f}, max {:.1f}'.format(
+                ms[0], statistics.median(ms), ms[int(0.95 * (len(ms) - 1))], ms[int(0.99 * (len(ms) - 1))], ms[-1]))
+        if len(latencies) < expected:
+            self.stdout.write(self.style.WARNING('Some messages were dropped.'))
+
+
+async def run(transport, n_displays, n_messages, interval):
+    """Connect the displays, send the updates and return the delivery latency of every received update."""
+
+    latencies = []
+    ready = [asyncio.get_event_loop().create_future() for _ in range(n_displays)]
+    stop = asyncio.Event()
+
+    def on_event(cmd, data):
+        if cmd == 'kumite-set-scores' and 'sent' in data:
+            latencies.append(time.perf_counter() - data['sent'])
+
+    displays = [asyncio.ensure_future(transport.display(r, stop, on_event)) for r in ready]
+    await asyncio.wait_for(asyncio.gather(*ready), 30)
+
+    for i in range(n_messages):
+        await transport.publish({'cmd': 'kumite-set-scores', 'data': {
+            'aka-points': i, 'aka-warnings': 0, 'aka-disqualified': False,
+            'shiro-points': 0, 'shiro-warnings': 0, 'shiro-disqualified': False,
+            'sent': time.perf_counter()}})
+        await asyncio.sleep(interval)
+
+    await asyncio.sleep(0.5) # Let the last updates arrive
+    stop.set()
+    await asyncio.gather(*displays)
+    return latencies
+
+
+class EventParser():
+    """Splits a Server-Sent Events stream into events."""
+
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.buffer = b""
+
+    def feed(self, data):
+        self.buffer += data
+        while b"\n\n" in self.buffer:
+            (block, self.buffer) = self.buffer.split(b"\n\n", 1)
+            fields = dict(line.split(": ", 1) for line in block.decode().split("\n") if ": " in line)
+            if 'event' in fields and 'data' in fields:
+                self.on_event(fields['event'], json.loads(fields['data']))
+
+
+class InProcess():
+    """Calls the ASGI application directly, measuring the channel without the network and HTTP server."""
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+
+    async def display(self, ready, stop, on_event):
+        parser = EventParser(on_event)
+
+        async def receive():
+            await stop.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                if not ready.done():
+                    ready.set_result(None)
+                parser.feed(message['body'])
+
+        scope = {'type': 'http', 'method': 'GET', 'path': self.path, 'headers': []}
+        await self.app(scope, receive, send)
+
+    async def publish(self, message):
+        body = json.dumps(message).encode()
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start' and message['status'] != 204:
+                raise CommandError('Publishing failed with status {}.'.format(message['status']))
+
+        scope = {'type': 'http', 'method': 'POST', 'path': self.path,
+            'headers': [(b'content-type', b'application/json')]}
+        await self.app(scope, receive, send)
+
+
+class Network():
+    """Connects to a running server over HTTP/1.1 like the browsers do."""
+
+    def __init__(self, url, path, cookie):
+        url = urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = path
+        self.cookie = cookie
+
+    async def request(self, method, body=b"", content_type=None):
+        (reader, writer) = await asyncio.open_connection(self.host, self.port)
+        headers = ["{} {} HTTP/1.1".format(method, self.path), "Host: {}:{}".format(self.host, self.port),
+            "Cookie: " + self.cookie, "Content-Length: {}".format(len(body)), "Connection: close"]
+        if content_type is not None:
+            headers.append("Content-Type: " + content_type)
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+
+        status = int((await reader.readline()).split()[1])
+        chunked = False
+        while True:
+            line = (await reader.readline()).strip().lower()
+            if line == b"":
+                break
+            if line == b"transfer-encoding: chunked":
+                chunked = True
+        return (status, chunked, reader, writer)
+
+    async def display(self, ready, stop, on_event):
+        (status, chunked, reader, writer) = await self.request('GET')
+        if status != 200:
+            raise CommandError('Display failed to connect with status {}.'.format(status))
+        parser = EventParser(on_event)
+
+        async def read():
+            while True:
+                if chunked:
+                    size = int((await reader.readline()).strip(), 16)
+                    if size == 0:
+                        return
+                    data = await reader.readexactly(size + 2)
+                    data = data[:-2]
+                else:
+                    data = await reader.read(4096)
+                    if len(data) == 0:
+                        return
+                if not ready.done():
+                    ready.set_result(None)
+                parser.feed(data)
+
+        reading = asyncio.ensure_future(read())
+        await asyncio.wait((reading, asyncio.ensure_future(stop.wait())), return_when=asyncio.FIRST_COMPLETED)
+        reading.cancel()
+        writer.close()
+
+    async def publish(self, message):
+        (status, _, _, writer) = await self.request('POST', json.dumps(message).encode(), 'application/json')
+        writer.close()
+        if status != 204:
+            raise CommandError('Publishing failed with status {}.'.format(status))
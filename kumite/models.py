@@ -1,12 +1,15 @@
 import math
 
-from django.db import models
-from django.db.models import Q, F
-from django.db.models.signals import post_delete
+from django.db import models, transaction
+from django.db.models import Q, F, Case, When, Value, Count
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.core.exceptions import MultipleObjectsReturned
 from django.urls import reverse, reverse_lazy
 
+from common.db import bulk_create_with_ids
+from registration.models import DivisionProgress
+
 # from registration.models import AbstractFormat
 
 # Create your models here.
@@ -30,6 +33,8 @@ class KumiteMatchPerson(models.Model):
     
     @property
     def kumitematch(self):
+        if hasattr(self, '_kumitematch'): # Set by BracketSnapshot
+            return self._kumitematch
         return KumiteMatch.objects.get(Q(aka=self.id) | Q(shiro=self.id))
     
     
@@ -104,6 +109,14 @@ class KumiteMatch(models.Model):
             name = "Round of {:.0f}, Match {}".format(math.pow(2,self.round + 1), self.order + 1)
         return name
     
+    def get_progress_display(self):
+        """Returns the name of the match and who is in it for the venue dashboard."""
+        
+        (aka, shiro) = (self.get_aka_display(), self.get_shiro_display())
+        return "{}: {} vs {}".format(self.get_display_short_name(), aka.name if aka is not None else "TBD",
+            shiro.name if shiro is not None else "TBD")
+    
+    
     @property
     def bracket_field(self):
         fields = ('bracket_elim1', 'bracket_rr', 'bracket_2people')
@@ -154,7 +167,7 @@ class KumiteMatch(models.Model):
             km = self.aka if self.aka_won else self.shiro
             if km.disqualified:
                 from registration.models import EventLink
-                return EventLink.get_disqualified_singleton(km.eventlink.event)
+                return EventLink.get_disqualified_singleton(km.eventlink.event_id)
             else:
                 return km.eventlink
         else:
@@ -173,7 +186,7 @@ class KumiteMatch(models.Model):
             km = self.shiro if self.aka_won else self.aka
             if km.disqualified:
                 from registration.models import EventLink
-                return EventLink.get_disqualified_singleton(km.eventlink.event)
+                return EventLink.get_disqualified_singleton(km.eventlink.event_id)
             else:
                 return km.eventlink
         else:
@@ -195,7 +208,7 @@ class KumiteMatch(models.Model):
     
     def is_editable(self):
         """Returns true if the match outcome can be changed without invalidating other completed matches."""
-        return (len(self.prev_matches.filter(done=False)) == 0
+        return (all(m.done for m in self.get_prev_matches())
             and (self.winner_match is None or not self.winner_match.done)
             and (self.consolation_match is None or not self.consolation_match.done))
     
@@ -204,9 +217,13 @@ class KumiteMatch(models.Model):
         if self.done and not self.is_editable():
             raise ValueError("Can't complete match if predecessor isn't complete.")
         
-        super(KumiteMatch, self).save(*args, **kwargs)
-        
-        self.bracket.match_callback(self)
+        with transaction.atomic():
+            super(KumiteMatch, self).save(*args, **kwargs)
+            
+            bracket = self.bracket
+            bracket.match_callback(self)
+            if bracket.division is not None:
+                bracket.division.update_state(bracket)
     
     
     @property
@@ -217,6 +234,13 @@ class KumiteMatch(models.Model):
                 bracket_2people__id=id_or_none(self.bracket_2people)
             ).filter(
                 Q(winner_match__id=self.id) | Q(consolation_match__id=self.id))
+    
+    
+    def get_prev_matches(self):
+        """Returns a list of :attr:`prev_matches`, without a query if the match was loaded by :class:`.BracketSnapshot`."""
+        if hasattr(self, '_prev_matches'):
+            return self._prev_matches
+        return list(self.prev_matches)
 
 
 @receiver(post_delete, sender=KumiteMatch)
@@ -227,6 +251,123 @@ def kumite_match_post_delete(sender, instance, **kwargs):
         instance.shiro.delete()
 
 
+class BracketSnapshot():
+    """All the matches of a kumite bracket and their people, loaded at once.
+    
+    The matches are linked to each other and to their people in memory, so walking the bracket, checking if
+    matches are editable and checking if people are swappable don't run any queries.
+    
+    Args:
+        bracket: A :class:`.KumiteElim1Bracket`, :class:`.KumiteRoundRobinBracket` or
+            :class:`.Kumite2PeopleBracket`.
+        match (optional): A match of the bracket to use instead of loading it from the database, e.g. because it is
+            being saved.
+    """
+    
+    def __init__(self, bracket, match=None):
+        self.bracket = bracket
+        field = bracket.kumite_match_bracket_field
+        
+        self.matches = list(KumiteMatch.objects.filter(**{field: bracket}).select_related(
+            'aka__eventlink__person', 'shiro__eventlink__person'))
+        if match is not None:
+            self.matches = [match if m.id == match.id else m for m in self.matches]
+        
+        self.by_id = {m.id: m for m in self.matches}
+        self.by_position = {(m.round, m.order): m for m in self.matches}
+        self.people = {}
+        for m in self.matches:
+            m._prev_matches = []
+        for m in self.matches:
+            setattr(m, field, bracket)
+            for f in ('winner_match', 'consolation_match'):
+                next_m = self.by_id.get(getattr(m, f + '_id'))
+                if next_m is not None:
+                    setattr(m, f, next_m)
+                    if m not in next_m._prev_matches:
+                        next_m._prev_matches.append(m)
+            for p in (m.aka, m.shiro):
+                if p is not None:
+                    p._kumitematch = m
+                    self.people[p.id] = p
+        
+        # Names of teams
+        teams = [p.eventlink for p in self.people.values() if p.eventlink.is_team]
+        models.prefetch_related_objects(teams, 'eventlink_set__person')
+    
+    
+    def get_match(self, round, order):
+        """Returns the match at the position or None if there isn't one."""
+        return self.by_position.get((round, order))
+    
+    
+    def get_next_match(self):
+        matches = self.get_pending_matches()
+        return matches[0] if len(matches) > 0 else None
+    
+    
+    def get_on_deck_match(self):
+        matches = self.get_pending_matches()
+        return matches[1] if len(matches) > 1 else None
+    
+    
+    def get_pending_matches(self):
+        """Returns the matches that aren't done in the order they will be run."""
+        return [m for m in self.matches if not m.done]
+
+
+def _get_progress(cls, division_ids):
+    """Returns the progress of the brackets of several divisions with a fixed number of queries.
+    
+    Args:
+        cls: The bracket class.
+        division_ids: Ids of the :class:`.Division`s to look up.
+    
+    Returns:
+        List of (bracket, pending, num_done, num_matches) tuples. `pending` holds the next two matches to run, in the
+        same order as :meth:`.BracketSnapshot.get_pending_matches`.
+    """
+    
+    field = cls.kumite_match_bracket_field
+    brackets = list(cls.objects.filter(division__in=division_ids))
+    ids = [b.id for b in brackets]
+    
+    counts = {x[field]: x for x in KumiteMatch.objects.filter(**{field + '__in': ids}).values(field).annotate(
+        n=Count('id'), n_done=Count('id', filter=Q(done=True))).order_by()}
+    
+    pending = {}
+    for m in KumiteMatch.objects.filter(**{field + '__in': ids, 'done': False}).select_related(
+            'aka__eventlink__person', 'shiro__eventlink__person'):
+        pending.setdefault(getattr(m, field + '_id'), []).append(m)
+    
+    results = []
+    for b in brackets:
+        matches = pending.get(b.id, [])[:2]
+        for m in matches:
+            setattr(m, field, b)
+        count = counts.get(b.id, {'n': 0, 'n_done': 0})
+        results.append((b, matches, count['n_done'], count['n']))
+    
+    # Names of teams
+    teams = [p.eventlink for (_, matches, _, _) in results for m in matches for p in (m.aka, m.shiro)
+        if p is not None and p.eventlink.is_team]
+    models.prefetch_related_objects(teams, 'eventlink_set__person')
+    
+    return results
+
+
+def _running_bracket_ids(field, bracket_ids):
+    """Returns the ids of the brackets that still have matches to run.
+    
+    Args:
+        field: Name of the :class:`.KumiteMatch` field that points to the bracket.
+        bracket_ids: Ids of the brackets to check.
+    """
+    
+    return set(KumiteMatch.objects.filter(**{field + '__in': bracket_ids, 'done': False}).values_list(
+        field + '_id', flat=True))
+
+
 class KumiteElim1Bracket(models.Model):
     
     name = models.CharField(max_length=250)
@@ -263,20 +404,23 @@ class KumiteElim1Bracket(models.Model):
             raise MultipleObjectsReturned('Multiple consolation matches.')
     
     
-    def get_next_match(self):
-        m = self.kumitematch_set.filter(done=False)
-        if len(m) == 0:
-            return None
-        m = m[0]
-        assert m.is_ready(), "Next match {} isn't ready.".format(m)
+    def get_next_match(self, snapshot=None):
+        if snapshot is None:
+            snapshot = BracketSnapshot(self)
+        m = snapshot.get_next_match()
+        assert m is None or m.is_ready(), "Next match {} isn't ready.".format(m)
         return m
     
     
-    def get_on_deck_match(self):
-        m = self.kumitematch_set.filter(done=False)
-        if len(m) < 2:
-            return None
-        return m[1]
+    def is_done(self):
+        """Returns true if all the matches have been run."""
+        return not self.kumitematch_set.filter(done=False).exists()
+    
+    
+    def get_on_deck_match(self, snapshot=None):
+        if snapshot is None:
+            snapshot = BracketSnapshot(self)
+        return snapshot.get_on_deck_match()
     
     
     def get_winners(self):
@@ -285,87 +429,134 @@ class KumiteElim1Bracket(models.Model):
             (3, self.consolation_match.winner()))
     
     
+    @staticmethod
+    def get_results(division_ids):
+        """Returns the brackets of several divisions and their winners with a fixed number of queries.
+        
+        Args:
+            division_ids: Ids of the :class:`.Division`s to look up.
+        
+        Returns:
+            List of (bracket, winners) tuples. `winners` matches :meth:`get_winners` if the bracket has no
+            matches left to run and is None otherwise.
+        """
+        
+        brackets = list(KumiteElim1Bracket.objects.filter(division__in=division_ids))
+        running = _running_bracket_ids('bracket_elim1', [b.id for b in brackets])
+        
+        finals = {}
+        for m in KumiteMatch.objects.filter(bracket_elim1__in=[b.id for b in brackets if b.id not in running],
+                round=0).select_related('aka__eventlink', 'shiro__eventlink'):
+            finals[(m.bracket_elim1_id, m.order)] = m
+        
+        results = []
+        for b in brackets:
+            if b.id in running:
+                winners = None
+            else:
+                final = finals[(b.id, 0)]
+                winners = ((1, final.winner()), (2, final.loser()), (3, finals[(b.id, -1)].winner()))
+            results.append((b, winners))
+        return results
+    
+    
+    @staticmethod
+    def get_progress(division_ids):
+        """Returns the brackets of several divisions, their next two matches and how many matches are done.
+        
+        See :meth:`.DivisionProgress.build`.
+        """
+        return _get_progress(KumiteElim1Bracket, division_ids)
+    
+    
     def get_absolute_url(self):
         return reverse('kumite:bracket-n', args=[self.id])
     
     
     def build(self, people):
+        """Create the matches of the bracket.
         
-        if len(self.kumitematch_set.all()) > 0:
+        The tree, seeding and byes are worked out in memory and written with a few bulk queries, so the number of
+        queries doesn't depend on the number of people. Match callbacks aren't run since nobody has competed yet.
+        
+        Args:
+            people: The :class:`.EventLink`s competing, in seed order.
+        """
+        
+        if self.kumitematch_set.exists():
             raise Exception("Bracket has already been built.")
         
+        n_person = len(people)
+        if n_person < 4:
+            raise ValueError("Minimum 4 competetors.")
+        self.rounds = math.ceil(math.log2(n_person))
+        
         # Consolation Match
-        consolation = KumiteMatch()
+        consolation = KumiteMatch(round=0, order=-1)
         consolation.bracket = self
-        consolation.str = "consolation"
-        consolation.round = 0
-        consolation.order = -1
-        consolation.save()
+        
+        matches = [consolation]
+        parents = {} # Index in matches => (winner match, consolation match)
+        match_people = [] # (match, 'aka' or 'shiro', KumiteMatchPerson)
         
         # Build tree recursively
-        def build_helper(bracket, round, match, parent, order):
+        def build_helper(round, match, parent, order):
+            
+            if len(order) > 2 or order[1] < n_person:
+                m = KumiteMatch(round=round, order=match)
+                m.bracket = self
+                parents[len(matches)] = (parent, consolation if round == 1 else None)
+                matches.append(m)
             
             if len(order) > 2:
                 # Add another round
-                m = KumiteMatch()
-                m.bracket = self
-                m.str = str(round)
-                m.round = round
-                m.order = match
-                m.winner_match = parent
-                m.save()
-                
                 split = len(order) // 2
-                build_helper(bracket, round + 1, 2 * match, m, order[:split])
-                build_helper(bracket, round + 1, 2 * match + 1, m, order[split:])
+                build_helper(round + 1, 2 * match, m, order[:split])
+                build_helper(round + 1, 2 * match + 1, m, order[split:])
                 
             elif len(order) == 2:
                 
-                if order[1] >= len(people):
+                if order[1] >= n_person:
                     # Competetor gets a buy
-                    m = KumiteMatchPerson(eventlink=people[order[0]], is_first_match=True)
-                    m.save()
-                    if match % 2 == 0:
-                        parent.aka = m
-                    else:
-                        parent.shiro = m
-                    parent.save()
-                    
-                else:
-                    m = KumiteMatch()
-                    m.bracket = self
-                    m.str = str(round)
-                    m.round = round
-                    m.order = match
-                    m.winner_match = parent
                     p = KumiteMatchPerson(eventlink=people[order[0]], is_first_match=True)
-                    p.save()
-                    m.aka = p
-                    p = KumiteMatchPerson(eventlink=people[order[1]], is_first_match=True)
-                    p.save()
-                    m.shiro = p
-                    m.save()
+                    match_people.append((parent, 'aka' if match % 2 == 0 else 'shiro', p))
+                else:
+                    match_people.append((m, 'aka', KumiteMatchPerson(eventlink=people[order[0]], is_first_match=True)))
+                    match_people.append((m, 'shiro', KumiteMatchPerson(eventlink=people[order[1]], is_first_match=True)))
                 
             else:
                 raise Exception("Bracket is too big for number of participants.")
-            
-            if round == 1:
-                # Connect consolation match
-                m.consolation_match = consolation
-                m.save()
-            
-            return m
-        
-        n_person = len(people)
-        if n_person < 4:
-            raise ValueError("Minimum 4 competetors.")
-        self.rounds = math.ceil(math.log2(n_person))
         
-        order = self.get_seed_order()
-        round = 0
-        m = build_helper(self, round, 0, None, order)
+        build_helper(0, 0, None, self.get_seed_order())
         
-        self.save()
+        with transaction.atomic():
+            self.save()
+            
+            bulk_create_with_ids(KumiteMatchPerson, [p for (m, attr, p) in match_people])
+            for (m, attr, p) in match_people:
+                setattr(m, attr, p)
+            bulk_create_with_ids(KumiteMatch, matches)
+            
+            # Link the matches now that they have ids.
+            winner = []
+            loser = []
+            for (i, (parent, consolation_match)) in parents.items():
+                m = matches[i]
+                if parent is not None:
+                    m.winner_match = parent
+                    winner.append(When(id=m.id, then=Value(parent.id)))
+                if consolation_match is not None:
+                    m.consolation_match = consolation_match
+                    loser.append(When(id=m.id, then=Value(consolation_match.id)))
+            
+            batch = 400 # Stay below the SQLite limit on the number of query parameters
+            for i in range(0, max(len(winner), len(loser)), batch):
+                updates = {}
+                if len(winner[i:i+batch]) > 0:
+                    updates['winner_match'] = Case(*winner[i:i+batch], default=F('winner_match'))
+                if len(loser[i:i+batch]) > 0:
+                    updates['consolation_match'] = Case(*loser[i:i+batch], default=F('consolation_match'))
+                self.kumitematch_set.update(**updates)
     
     
     def get_swappable_match_people(self):
@@ -468,15 +659,22 @@ class KumiteElim1Bracket(models.Model):
     
     def match_callback(self, match):
         
-        if match.winner_match:
-            self.claim_people(match.winner_match)
+        # Reload after each claim since claiming saves matches, which can change the rest of the bracket.
+        if match.winner_match_id is not None:
+            self.claim_people(BracketSnapshot(self, match).by_id[match.winner_match_id])
         
-        if match.consolation_match:
-            self.claim_people(match.consolation_match)
+        if match.consolation_match_id is not None:
+            self.claim_people(BracketSnapshot(self, match).by_id[match.consolation_match_id])
     
     
     def claim_people(self, match):
-        curr_ids = [x.id for x in match.people() if x is not None]
+        """Put the winners or losers of the previous matches into `match`.
+        
+        Args:
+            match: A match loaded by :class:`.BracketSnapshot` so the previous matches are available without queries.
+                Other matches work too but are slower.
+        """
+        
         attr_name = 'aka'
         for m in [self.prev_match_aka(match), self.prev_match_shiro(match)]:
             if m is not None:
@@ -512,7 +710,7 @@ class KumiteElim1Bracket(models.Model):
     
     def prev_match_aka(self, match):
         # m = self.prev_matches.annotate(ordermod2=F('order') % 2).filter(ordermod2=0)
-        m = [m for m in match.prev_matches if m.order % 2 == 0]
+        m = [m for m in match.get_prev_matches() if m.order % 2 == 0]
         if len(m) == 0:
             return None
         elif len(m) == 1:
@@ -527,7 +725,7 @@ class KumiteElim1Bracket(models.Model):
     
     def prev_match_shiro(self, match):
         # m = self.prev_matches.annotate(ordermod2=F('order') % 2).filter(ordermod2=1)
-        m = [m for m in match.prev_matches if m.order % 2 == 1]
+        m = [m for m in match.get_prev_matches() if m.order % 2 == 1]
         if len(m) == 0:
             return None
         elif len(m) == 1:
@@ -555,11 +753,29 @@ class Kumite2PeopleBracket(models.Model):
         return ((1, self.winner), (2, self.loser))
     
     
+    @staticmethod
+    def get_results(division_ids):
+        """See :meth:`KumiteElim1Bracket.get_results`."""
+        
+        brackets = list(Kumite2PeopleBracket.objects.filter(division__in=division_ids).select_related(
+            'winner', 'loser'))
+        running = _running_bracket_ids('bracket_2people', [b.id for b in brackets])
+        return [(b, None if b.id in running else b.get_winners()) for b in brackets]
+    
+    
+    @staticmethod
+    def get_progress(division_ids):
+        """See :meth:`KumiteElim1Bracket.get_progress`."""
+        return _get_progress(Kumite2PeopleBracket, division_ids)
+    
+    
     def get_absolute_url(self):
         return reverse('kumite:bracket-2', args=[self.id,])
     
     
-    def get_next_match(self):
+    def get_next_match(self, snapshot=None):
+        if snapshot is not None:
+            return snapshot.get_next_match()
         m = self.kumitematch_set.filter(done=False)
         if len(m) == 0:
             return None
@@ -567,6 +783,11 @@ class Kumite2PeopleBracket(models.Model):
             return m[0]
     
     
+    def is_done(self):
+        """Returns true if all the matches have been run."""
+        return not self.kumitematch_set.filter(done=False).exists()
+    
+    
     def build(self, people):
         
         if len(people) != 2:
@@ -645,10 +866,10 @@ class Kumite2PeopleBracket(models.Model):
                 
                 from registration.models import EventLink
                 if disqualifieds[winner] > 0:
-                    winner = EventLink.get_disqualified_singleton(winner.event)
+                    winner = EventLink.get_disqualified_singleton(winner.event_id)
                 loser  = p2 if winner == p1 else p1
                 if disqualifieds[loser] > 0:
-                    loser = EventLink.get_disqualified_singleton(loser.event)
+                    loser = EventLink.get_disqualified_singleton(loser.event_id)
                 
                 for id in range(im+1, len(matches)):
                     matches[id].delete()
@@ -720,11 +941,29 @@ class KumiteRoundRobinBracket(models.Model):
         return ((1, self.gold), (2, self.silver), (3, self.bronze))
     
     
+    @staticmethod
+    def get_results(division_ids):
+        """See :meth:`KumiteElim1Bracket.get_results`."""
+        
+        brackets = list(KumiteRoundRobinBracket.objects.filter(division__in=division_ids).select_related(
+            'gold', 'silver', 'bronze'))
+        running = _running_bracket_ids('bracket_rr', [b.id for b in brackets])
+        return [(b, None if b.id in running else b.get_winners()) for b in brackets]
+    
+    
+    @staticmethod
+    def get_progress(division_ids):
+        """See :meth:`KumiteElim1Bracket.get_progress`."""
+        return _get_progress(KumiteRoundRobinBracket, division_ids)
+    
+    
     def get_absolute_url(self):
         return reverse('kumite:bracket-rr', args=[self.id])
     
     
-    def get_next_match(self):
+    def get_next_match(self, snapshot=None):
+        if snapshot is not None:
+            return snapshot.get_next_match()
         m = self.kumitematch_set.filter(done=False)
         if len(m) == 0:
             return None
@@ -732,7 +971,14 @@ class KumiteRoundRobinBracket(models.Model):
             return m[0]
     
     
-    def get_on_deck_match(self):
+    def is_done(self):
+        """Returns true if all the matches have been run."""
+        return not self.kumitematch_set.filter(done=False).exists()
+    
+    
+    def get_on_deck_match(self, snapshot=None):
+        if snapshot is not None:
+            return snapshot.get_on_deck_match()
         m = self.kumitematch_set.filter(done=False)
         if len(m) < 2:
             return None
@@ -782,7 +1028,7 @@ class KumiteRoundRobinBracket(models.Model):
                 other_match = other_match[0]
                 disqualified = match.aka.disqualified and match.done
                 if disqualified:
-                    el = EventLink.get_disqualified_singleton(match.aka.eventlink.event)
+                    el = EventLink.get_disqualified_singleton(match.aka.eventlink.event_id)
                 else:
                     el = match.aka.eventlink
                 
@@ -801,7 +1047,7 @@ class KumiteRoundRobinBracket(models.Model):
                 other_match = other_match[0]
                 disqualified = match.shiro.disqualified and match.done
                 if disqualified:
-                    el = EventLink.get_disqualified_singleton(match.shiro.eventlink.event)
+                    el = EventLink.get_disqualified_singleton(match.shiro.eventlink.event_id)
                 else:
                     el = match.shiro.eventlink
                 
@@ -865,7 +1111,7 @@ class KumiteRoundRobinBracket(models.Model):
                 if point[DISQUALIFIED] == 0:
                     prev_person = p
                 else:
-                    prev_person = EventLink.get_disqualified_singleton(p.event)
+                    prev_person = EventLink.get_disqualified_singleton(p.event_id)
             
             setattr(self, ranks.__next__(), prev_person)
             self.save()
@@ -912,5 +1158,23 @@ class KumiteRoundRobinBracket(models.Model):
         if round != 0:
             raise ValueError("Only 1 round")
         return self.kumitematch_set.get(order=match_i)
-    
-    
\ No newline at end of file
+
+
+@receiver(post_save, sender=KumiteElim1Bracket)
+@receiver(post_save, sender=Kumite2PeopleBracket)
+@receiver(post_save, sender=KumiteRoundRobinBracket)
+def bracket_post_save(sender, instance, created, **kwargs):
+    if created:
+        from registration.models import Division
+        Division.bracket_created(instance)
+
+
+@receiver(post_delete, sender=KumiteElim1Bracket)
+@receiver(post_delete, sender=Kumite2PeopleBracket)
+@receiver(post_delete, sender=KumiteRoundRobinBracket)
+def bracket_post_delete(sender, instance, **kwargs):
+    from registration.models import Division
+    Division.bracket_deleted(instance.division_id)
+
+
+DivisionProgress.connect(KumiteMatch, KumiteMatchPerson)
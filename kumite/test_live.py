@@ -0,0 +1,216 @@
+import asyncio
+from io import StringIO
+import json
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from accounts.models import RightsSupport
+from .live import LiveApplication, MatchHub, display_channel, encode_event, has_perm
+from .test_models import make_bracket
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+async def request(app, method, path, body=b"", headers=None, disconnect=None):
+    """Calls the ASGI application and returns the status and the body chunks."""
+
+    sent = []
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if len(received) > 0:
+            return received.pop()
+        if disconnect is not None:
+            await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': headers or []}
+    await app(scope, receive, send)
+    return (sent[0]['status'], [m['body'] for m in sent[1:]])
+
+
+JSON = [(b'content-type', b'application/json')]
+
+
+class MatchHubTestCase(TestCase):
+
+    def test_publish(self):
+        async def test():
+            hub = MatchHub(queue_size=2)
+            a = hub.subscribe(1)
+            b = hub.subscribe(1)
+            other = hub.subscribe(2)
+            self.assertEqual(hub.count(1), 2)
+
+            self.assertEqual(hub.publish(1, 'kumite-set-time', {'time': 1}), 2)
+            self.assertEqual(a.get_nowait(), encode_event('kumite-set-time', {'time': 1}))
+            self.assertEqual(b.get_nowait(), encode_event('kumite-set-time', {'time': 1}))
+            self.assertTrue(other.empty())
+
+            # Slow subscribers lose the oldest messages
+            for t in range(2, 5):
+                hub.publish(1, 'kumite-set-time', {'time': t})
+            self.assertEqual(a.get_nowait(), encode_event('kumite-set-time', {'time': 3}))
+            self.assertEqual(a.get_nowait(), encode_event('kumite-set-time', {'time': 4}))
+
+            # New subscribers get the last message of each command
+            hub.publish(1, 'kumite-set-scores', {'aka-points': 1})
+            c = hub.subscribe(1)
+            self.assertEqual(set([c.get_nowait(), c.get_nowait()]), set([
+                encode_event('kumite-set-time', {'time': 4}), encode_event('kumite-set-scores', {'aka-points': 1})]))
+
+            hub.unsubscribe(1, a)
+            hub.unsubscribe(1, b)
+            hub.unsubscribe(1, c)
+            self.assertEqual(hub.count(1), 0)
+            self.assertTrue(hub.subscribe(1).empty()) # Forgotten with the last subscriber
+
+            # Closing the match forgets its last messages too
+            hub.publish(2, 'kumite-set-time', {'time': 1})
+            hub.close(2)
+            self.assertTrue(hub.subscribe(2).empty())
+            self.assertEqual(other.get_nowait(), encode_event('kumite-set-time', {'time': 1}))
+        run(test())
+
+
+class LiveApplicationTestCase(TestCase):
+
+    def setUp(self):
+        self.path = reverse('kumite:match-live', args=[3])
+
+    def test_stream(self):
+        app = LiveApplication(authorize=lambda cookie, perm: True)
+
+        async def test():
+            disconnect = asyncio.Event()
+            display = asyncio.ensure_future(request(app, 'GET', self.path, disconnect=disconnect))
+            while app.hub.count(3) == 0:
+                await asyncio.sleep(0.01)
+
+            message = {'cmd': 'kumite-set-scores', 'data': {'aka-points': 2}}
+            self.assertEqual(await request(app, 'POST', self.path, json.dumps(message).encode(), JSON), (204, [b""]))
+            await asyncio.sleep(0.05)
+            disconnect.set()
+
+            (status, chunks) = await display
+            self.assertEqual(status, 200)
+            self.assertEqual(b"".join(chunks), b"retry: 1000\n\n" + encode_event('kumite-set-scores', {'aka-points': 2}))
+            self.assertEqual(app.hub.count(3), 0)
+
+            # The scorer leaves the match
+            self.assertEqual(await request(app, 'POST', self.path, json.dumps(message).encode(), JSON), (204, [b""]))
+            self.assertIn(3, app.hub._last)
+            message = {'cmd': 'kumite-close', 'data': None}
+            self.assertEqual(await request(app, 'POST', self.path, json.dumps(message).encode(), JSON), (204, [b""]))
+            self.assertEqual(app.hub._last, {})
+        run(test())
+
+    def test_display(self):
+        """A display subscribed to its channel is told to open the match the scorer opens."""
+
+        m = make_bracket(2).get_next_match()
+        page = m.get_absolute_url() + "?slave=true"
+
+        # The TV and the scorer's tablet pick the same display, each in their own session
+        tv = Client()
+        tv.force_login(RightsSupport.create_view_user())
+        resp = tv.get(reverse('kumite:slave') + "?display=ring2")
+        path = resp.context['display_live_url']
+        self.assertEqual(path, reverse('kumite:display-live', args=['ring2']))
+        self.assertContains(resp, 'new EventSource("{}")'.format(path))
+
+        scorer = Client()
+        scorer.force_login(RightsSupport.create_edit_user())
+        scorer.get(m.get_absolute_url() + "?display=ring2")
+        resp = scorer.get(m.get_absolute_url())
+        self.assertEqual(resp.context['display_live_url'], path)
+        self.assertContains(resp, "send_message('load-page', \"{}\")".format(page))
+        self.assertContains(resp, 'send_live("{}", cmd, data)'.format(path))
+
+        app = LiveApplication(authorize=lambda cookie, perm: True)
+
+        async def test():
+            disconnect = asyncio.Event()
+            display = asyncio.ensure_future(request(app, 'GET', path, disconnect=disconnect))
+            while app.hub.count(display_channel('ring2')) == 0:
+                await asyncio.sleep(0.01)
+
+            # What the scorer's page sends when it is opened
+            message = {'cmd': 'load-page', 'data': page}
+            self.assertEqual(await request(app, 'POST', path, json.dumps(message).encode(), JSON), (204, [b""]))
+            await asyncio.sleep(0.05)
+            disconnect.set()
+
+            (status, chunks) = await display
+            self.assertEqual(status, 200)
+            self.assertIn(encode_event('load-page', page), b"".join(chunks))
+
+            # The TV is told again when it reconnects
+            self.assertEqual(app.hub.subscribe(display_channel('ring2')).get_nowait(), encode_event('load-page', page))
+
+            # Displays only open pages of the site
+            for message in ({'cmd': 'kumite-set-time', 'data': []}, {'cmd': 'load-page', 'data': "//example.com/"},
+                    {'cmd': 'load-page', 'data': "https://example.com/"}):
+                self.assertEqual((await request(app, 'POST', path, json.dumps(message).encode(), JSON))[0], 400)
+        run(test())
+
+    def test_keepalive(self):
+        app = LiveApplication(authorize=lambda cookie, perm: True, keepalive=0.01)
+
+        async def test():
+            disconnect = asyncio.Event()
+            display = asyncio.ensure_future(request(app, 'GET', self.path, disconnect=disconnect))
+            await asyncio.sleep(0.1)
+            disconnect.set()
+            (status, chunks) = await display
+            self.assertIn(b": keepalive\n\n", chunks)
+        run(test())
+
+    def test_errors(self):
+        perms = []
+
+        def authorize(cookie, perm):
+            perms.append((cookie, perm))
+            return perm == 'accounts.view'
+
+        app = LiveApplication(authorize=authorize)
+        message = json.dumps({'cmd': 'kumite-set-time', 'data': {}}).encode()
+        self.assertEqual(run(request(app, 'POST', self.path, message, JSON + [(b'cookie', b'a=b')]))[0], 403)
+        self.assertEqual(perms, [('a=b', 'accounts.edit')])
+        self.assertEqual(run(request(app, 'PUT', self.path, message, JSON))[0], 405)
+        self.assertEqual(run(request(app, 'GET', '/nothing/'))[0], 404)
+
+        app = LiveApplication(authorize=lambda cookie, perm: True)
+        self.assertEqual(run(request(app, 'POST', self.path, message))[0], 415)
+        self.assertEqual(run(request(app, 'POST', self.path, b"{", JSON))[0], 400)
+        self.assertEqual(run(request(app, 'POST', self.path, json.dumps({'cmd': 'other', 'data': {}}).encode(),
+            JSON))[0], 400)
+        self.assertEqual(run(request(app, 'POST', self.path, b" " * 5000, JSON))[0], 413)
+        self.assertEqual(app.hub._last, {})
+
+    def test_has_perm(self):
+        self.client.force_login(RightsSupport.create_view_user())
+        cookie = '{}={}'.format(settings.SESSION_COOKIE_NAME, self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+        self.assertTrue(has_perm(cookie, 'accounts.view'))
+        self.assertFalse(has_perm(cookie, 'accounts.edit'))
+        self.assertFalse(has_perm(None, 'accounts.view'))
+        self.assertFalse(has_perm('{}=junk'.format(settings.SESSION_COOKIE_NAME), 'accounts.view'))
+
+    def test_wsgi(self):
+        self.client.force_login(RightsSupport.create_edit_user())
+        resp = self.client.get(self.path)
+        self.assertEqual(resp.status_code, 503)
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('live_benchmark', displays=5, messages=5, interval=0, stdout=out)
+        self.assertIn('Delivered 25 of 25 messages to 5 displays.', out.getvalue())
+        self.assertIn('Latency (ms)', out.getvalue())
@@ -440,6 +440,20 @@ class KumiteElim1BracketTestCase(TestCase):
             b.get_seed_order(1.1)
     
     
+    def test_build_queries(self):
+        """The number of queries to build a bracket shouldn't depend on its size."""
+        
+        for n in [5, 64]:
+            e = Event.objects.create(name="test event {}".format(n), format=Event.EventFormat.elim1)
+            people = [EventLink.objects.create(manual_name=str(i), event=e) for i in range(n)]
+            b = KumiteElim1Bracket.objects.create(name="asdf")
+            with self.assertNumQueries(17):
+                b.build(people)
+            self.assertEqual(b.kumitematch_set.count(), n) # n - 1 matches and the consolation match
+            self.assertEqual(KumiteMatchPerson.objects.filter(match_aka__bracket_elim1=b, is_first_match=True).count()
+                + KumiteMatchPerson.objects.filter(match_shiro__bracket_elim1=b, is_first_match=True).count(), n)
+    
+    
     def test_build(self):
         """Try building brackets of different sizes and make sure people are assigned correctly."""
         
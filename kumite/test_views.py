@@ -135,6 +135,32 @@ class TestSwap(WebTest):
         self.assertEqual(m.loser(), mp2.eventlink)
 
 
+class BracketDetailsTestCase(WebTest):
+    
+    def setUp(self):
+        self.app.set_user(RightsSupport.create_view_user())
+    
+    
+    def test_queries(self):
+        """The number of queries to show a bracket shouldn't depend on its size."""
+        
+        self.app.get(make_bracket(4).get_absolute_url()) # Warm up
+        for n in [8, 32]:
+            b = make_bracket(n)
+            
+            # Run a match so there are scores and a winner to show
+            m = b.get_next_match()
+            m.aka.points = 1
+            m.aka.save()
+            m.done = True
+            m.infer_winner()
+            m.save()
+            
+            with self.assertNumQueries(7):
+                resp = self.app.get(b.get_absolute_url())
+            self.assertEqual(len(resp.html.select('td[draggable]')), n - 2)
+
+
 @parameterized_class(common.selenium.Env(exclude="Safari").parameterized_class())
 class SlaveTestCase(common.selenium.SeleniumTestCaseHelper):
     """Tests kumite slave display
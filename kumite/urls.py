@@ -18,7 +18,9 @@ urlpatterns = [
     
     url(r'^match/manual/edit/$', views.KumiteMatchManual.as_view(), name='manual-match'),
     url(r'^match/(?P<pk>[0-9]+)/edit/$', views.KumiteMatchUpdate.as_view(), name='match'),
+    url(r'^match/(?P<pk>[0-9]+)/live/$', views.KumiteMatchLive.as_view(), name='match-live'),
+    url(r'^display/(?P<name>[\w-]+)/live/$', views.KumiteMatchLive.as_view(), name='display-live'),
     
-    url(r'^slave/$', TemplateView.as_view(template_name="kumite/slave.html"), name="slave"), 
+    url(r'^slave/$', views.KumiteSlave.as_view(), name="slave"), 
     url(r'^slave/waiting/$', TemplateView.as_view(template_name="kumite/slave_waiting.html"), name="slave-waiting"),
 ]
\ No newline at end of file
@@ -1,24 +1,36 @@
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.shortcuts import render
-from django.views.generic import DetailView
+from django.views.generic import DetailView, TemplateView, View
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.edit import CreateView, UpdateView, DeleteView, ModelFormMixin, FormView
 from django.urls import reverse, reverse_lazy
-from django.http.response import HttpResponseRedirect, HttpResponseForbidden
+from django.http.response import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_POST
 from django.contrib.admin.views.decorators import staff_member_required
 
 import math
+import re
 
-from .models import KumiteElim1Bracket, KumiteRoundRobinBracket, Kumite2PeopleBracket, KumiteMatch, KumiteMatchPerson
+from common.views import ReplicaMixin, VersionedPageMixin
+from registration.models import Division
+from .models import KumiteElim1Bracket, KumiteRoundRobinBracket, Kumite2PeopleBracket, KumiteMatch, KumiteMatchPerson, BracketSnapshot
 from .forms import KumiteMatchCombinedForm, KumiteMatchForm, KumiteMatchPersonForm, KumiteMatchPersonSwapForm
+from .live import DEFAULT_DISPLAY
 
 class BracketGrid():
+    """Lays out the matches of a bracket as table cells.
     
-    def __init__(self, bracket, consolation=False):
+    Args:
+        bracket: The bracket.
+        consolation (optional): Show the consolation match instead of the main bracket.
+        snapshot (optional): :class:`.BracketSnapshot` of the bracket. Pass one to share it between grids.
+    """
+    
+    def __init__(self, bracket, consolation=False, snapshot=None):
         self.bracket = bracket
         self.consolation = consolation
+        self.snapshot = snapshot if snapshot is not None else BracketSnapshot(bracket)
         if self.consolation:
             self.n_row = 2
             self.n_col = 2
@@ -39,11 +51,11 @@ class BracketGrid():
     
     def get_match(self, round, match_i):
         if not self.consolation:
-            return self.bracket.get_match(round, match_i)
+            return self.snapshot.get_match(round, match_i)
         else:
             if round != 0 or match_i != 0:
                 ValueError("Only one consolation match.")
-            return self.bracket.consolation_match
+            return self.snapshot.get_match(0, -1)
     
     
     def row(self, row):
@@ -75,11 +87,15 @@ class BracketGrid():
             yield None
 
 
-class BracketDetails(PermissionRequiredMixin, DetailView):
+class BracketDetails(ReplicaMixin, VersionedPageMixin, PermissionRequiredMixin, DetailView):
     model = KumiteElim1Bracket
     permission_required = 'accounts.view'
     
     
+    def get_version(self):
+        return Division.get_version(self.model, self.kwargs['pk'])
+    
+    
     def get_context_object_name(self, object):
         return 'bracket'
     
@@ -88,10 +104,12 @@ class BracketDetails(PermissionRequiredMixin, DetailView):
         
         context = super().get_context_data(**kwargs)
         object = context['object']
-        context.update({'grid': BracketGrid(object), 'consolation_grid': BracketGrid(object, consolation=True),
-            'next': object.get_next_match(), 'on_deck': object.get_on_deck_match(),
+        snapshot = BracketSnapshot(object)
+        context.update({'grid': BracketGrid(object, snapshot=snapshot),
+            'consolation_grid': BracketGrid(object, consolation=True, snapshot=snapshot),
+            'next': object.get_next_match(snapshot), 'on_deck': object.get_on_deck_match(snapshot),
             'delete_url': reverse('kumite:bracket-n-delete', args=[object.id]),
-            'swap_form': KumiteMatchPersonSwapForm(self.object)})
+            'swap_form': KumiteMatchPersonSwapForm(self.object, snapshot=snapshot)})
         return context
 
 
@@ -104,12 +122,16 @@ class BracketDelete(PermissionRequiredMixin, DeleteView):
         return self.object.division.get_absolute_url()
 
 
-class BracketRoundRobinDetails(PermissionRequiredMixin, DetailView):
+class BracketRoundRobinDetails(ReplicaMixin, VersionedPageMixin, PermissionRequiredMixin, DetailView):
     model = KumiteRoundRobinBracket
     template_name = 'kumite/kumiteelim1bracket_detail.html'
     permission_required = 'accounts.view'
     
     
+    def get_version(self):
+        return Division.get_version(self.model, self.kwargs['pk'])
+    
+    
     def get_context_object_name(self, object):
         return 'bracket'
     
@@ -117,8 +139,9 @@ class BracketRoundRobinDetails(PermissionRequiredMixin, DetailView):
     def get_context_data(self, object):
         
         context = super().get_context_data(object=object)
-        context.update({'grid': BracketGrid(object), 'consolation_grid': None,
-            'next': object.get_next_match(), 'on_deck': object.get_on_deck_match(),
+        snapshot = BracketSnapshot(object)
+        context.update({'grid': BracketGrid(object, snapshot=snapshot), 'consolation_grid': None,
+            'next': object.get_next_match(snapshot), 'on_deck': object.get_on_deck_match(snapshot),
             'delete_url': reverse('kumite:bracket-rr-delete', args=[object.id])})
         return context
 
@@ -132,12 +155,16 @@ class BracketRoundRobinDelete(PermissionRequiredMixin, DeleteView):
         return self.object.division.get_absolute_url()
 
 
-class Bracket2PeopleDetails(PermissionRequiredMixin, DetailView):
+class Bracket2PeopleDetails(ReplicaMixin, VersionedPageMixin, PermissionRequiredMixin, DetailView):
     model = Kumite2PeopleBracket
     template_name = 'kumite/kumiteelim1bracket_detail.html'
     permission_required = 'accounts.view'
     
     
+    def get_version(self):
+        return Division.get_version(self.model, self.kwargs['pk'])
+    
+    
     def get_context_object_name(self, object):
         return 'bracket'
     
@@ -145,8 +172,9 @@ class Bracket2PeopleDetails(PermissionRequiredMixin, DetailView):
     def get_context_data(self, object):
         
         context = super().get_context_data(object=object)
-        context.update({'grid': BracketGrid(object), 'consolation_grid': None,
-            'next': object.get_next_match(), 'on_deck': None,
+        snapshot = BracketSnapshot(object)
+        context.update({'grid': BracketGrid(object, snapshot=snapshot), 'consolation_grid': None,
+            'next': object.get_next_match(snapshot), 'on_deck': None,
             'delete_url': reverse('kumite:bracket-2-delete', args=[object.id])})
         return context
 
@@ -252,8 +280,47 @@ class KumiteMatchUpdate(PermissionRequiredMixin, UpdateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['is_master'] = 'slave' not in self.request.GET
+        context['live_url'] = reverse('kumite:match-live', args=[self.kwargs['pk']])
+        if context['is_master']:
+            context['display_live_url'] = reverse('kumite:display-live', args=[get_display(self.request)])
+        return context
+    
+
+
+def get_display(request):
+    """Returns the name of the display, e.g. the TV of a ring, that the device shows or scores for.
+    
+    Set with ``?display=<name>`` and remembered in the session. See :mod:`kumite.live`.
+    """
+    
+    display = request.GET.get('display')
+    if display is not None and re.match(r'^[\w-]+$', display):
+        request.session['kumite_display'] = display
+        return display
+    return request.session.get('kumite_display', DEFAULT_DISPLAY)
+
+
+class KumiteSlave(TemplateView):
+    """Audience display that shows the match the scorer opens, through ``BroadcastChannel`` and the display channel."""
+    
+    template_name = 'kumite/slave.html'
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['display_live_url'] = reverse('kumite:display-live', args=[get_display(self.request)])
         return context
+
+
+class KumiteMatchLive(View):
+    """Placeholder for the live channels of a match or a display when running under WSGI.
+    
+    The channels are served by the ASGI application in ``tournament/asgi.py``, see :mod:`kumite.live`. The scoreboard
+    still works between tabs of one browser without it.
+    """
     
+    def dispatch(self, request, *args, **kwargs):
+        return HttpResponse("The live scoreboard is served by tournament/asgi.py.", status=503,
+            content_type='text/plain')
 
 
 class KumiteMatchManual(FormView):
@@ -31,9 +31,10 @@ class RankAdmin(admin.ModelAdmin):
 
 
 class DivisionAdmin(admin.ModelAdmin):
-    list_display = ['__str__', 'num_participants', 'event', 'gender', 'start_age', 'stop_age', 'start_rank', 'stop_rank']
+    list_display = ['__str__', 'num_participants', 'state', 'event', 'gender', 'start_age', 'stop_age', 'start_rank', 'stop_rank']
     list_editable = ['event', 'gender', 'start_age', 'stop_age', 'start_rank', 'stop_rank']
-    list_filter = ['event', 'gender', 'start_age', 'start_rank']
+    list_filter = ['state', 'event', 'gender', 'start_age', 'start_rank']
+    readonly_fields = ['state']
     inlines = (PersonInline,)
     
     
@@ -1,8 +1,7 @@
 from django import forms
 from django.core.exceptions import ValidationError
 from django.urls import reverse
-from django.db.models import F, Q, Value
-from django.db.models.functions import Concat
+from django.db.models import Q
 
 from .models import Person, Rank, EventLink
 
@@ -28,6 +27,35 @@ class PersonPaidForm(forms.ModelForm):
         fields = ['paid']
 
 
+class PersonBulkStatusForm(forms.Form):
+    """Check in or mark as paid a batch of people. The ids can be typed or scanned, separated by spaces or commas."""
+    
+    ids = forms.CharField()
+    confirmed = forms.NullBooleanField(required=False)
+    paid = forms.NullBooleanField(required=False)
+    
+    max_ids = 1000
+    
+    
+    def clean_ids(self):
+        data = self.cleaned_data['ids'].replace(',', ' ').split()
+        try:
+            ids = sorted(set(int(x) for x in data))
+        except ValueError:
+            raise ValidationError('Ids must be numbers.')
+        if len(ids) == 0:
+            raise ValidationError('No ids.')
+        if len(ids) > self.max_ids:
+            raise ValidationError('At most {} ids at a time.'.format(self.max_ids))
+        return ids
+    
+    
+    def clean(self):
+        super().clean()
+        if self.cleaned_data.get('confirmed') is None and self.cleaned_data.get('paid') is None:
+            raise ValidationError('Nothing to change.')
+
+
 class ManualEventLinkForm(forms.ModelForm):
     class Meta:
         model = EventLink
@@ -130,8 +158,7 @@ class PersonFilterForm(forms.Form):
     
     def filter(self, qs):
         if len(self.cleaned_data['name']) > 0:
-            qs = qs.annotate(name=Concat(F('first_name'), Value(' '), F('last_name'))
-                ).filter(name__icontains=self.cleaned_data['name'])
+            qs = Person.search_filter(qs, self.cleaned_data['name'])
         if self.cleaned_data['confirmed'] is not None:
             qs = qs.filter(confirmed=self.cleaned_data['confirmed'])
         if self.cleaned_data['paid'] is not None:
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from registration import results
+
+class Command(BaseCommand):
+    help = 'Write the static results site for nginx to serve. See registration.results.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', type=str, help='Directory of the site. Defaults to RESULTS_ROOT in the settings.')
+
+    def handle(self, *args, **options):
+        root = options['root'] or results.get_root()
+        if root is None:
+            raise CommandError('Set RESULTS_ROOT in the settings or pass --root.')
+        n_page = results.build(root=root)
+        self.stdout.write(self.style.SUCCESS('Wrote {} pages to {}.'.format(n_page, root)))
@@ -1,3 +1,5 @@
+import time
+
 from django.core.management.base import BaseCommand, CommandError
 
 from registration.models import import_registrations
@@ -7,8 +9,14 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('file', nargs=1, type=str)
+        parser.add_argument('--chunk-size', type=int, default=500,
+            help='Number of rows written to the database at a time.')
 
     def handle(self, *args, **options):
         f = open(options['file'][0], newline='')
-        stats = import_registrations(f)
-        self.stdout.write(self.style.SUCCESS('Added {added}, skipped {skipped}.'.format(**stats)))
\ No newline at end of file
+        t_start = time.monotonic()
+        stats = import_registrations(f, chunk_size=options['chunk_size'])
+        elapsed = time.monotonic() - t_start
+        rate = (stats['added'] + stats['skipped']) / elapsed if elapsed > 0 else 0
+        self.stdout.write(self.style.SUCCESS('Added {added}, skipped {skipped}.'.format(**stats)))
+        self.stdout.write('Imported in {:.2f} s ({:.0f} rows/s).'.format(elapsed, rate))
@@ -0,0 +1,51 @@
+# Generated by Django 2.1.8 on 2026-10-18 15:22
+
+from django.db import migrations, models
+
+
+READY = '1'
+RUNNING = '4'
+DONE = '7'
+
+
+def backfill_state(apps, schema_editor):
+    """Set Division.state from the existing brackets. It wasn't maintained before."""
+
+    Division = apps.get_model('registration', 'Division')
+    KumiteMatch = apps.get_model('kumite', 'KumiteMatch')
+    KataMatch = apps.get_model('kata', 'KataMatch')
+
+    built = set()
+    for (app, model) in (('kumite', 'KumiteElim1Bracket'), ('kumite', 'KumiteRoundRobinBracket'),
+            ('kumite', 'Kumite2PeopleBracket'), ('kata', 'KataBracket')):
+        built.update(apps.get_model(app, model).objects.filter(division__isnull=False).values_list(
+            'division_id', flat=True))
+
+    running = set()
+    for field in ('bracket_elim1', 'bracket_rr', 'bracket_2people'):
+        running.update(KumiteMatch.objects.filter(done=False, **{field + '__division__isnull': False}).values_list(
+            field + '__division_id', flat=True))
+    running.update(KataMatch.objects.filter(done=False, round__bracket__division__isnull=False).values_list(
+        'round__bracket__division_id', flat=True))
+
+    Division.objects.update(state=READY)
+    Division.objects.filter(id__in=built).update(state=DONE)
+    Division.objects.filter(id__in=built & running).update(state=RUNNING)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0020_auto_20190511_1030'),
+        ('kumite', '0015_kumitematch_swap'),
+        ('kata', '0010_auto_20190512_2051'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='division',
+            name='state',
+            field=models.CharField(choices=[('1', 'ready'), ('4', 'running'), ('7', 'done')], db_index=True, default='1', max_length=1),
+        ),
+        migrations.RunPython(backfill_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.1.8 on 2026-10-18 15:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_format(apps, schema_editor):
+    """Point each division at its existing bracket."""
+
+    Division = apps.get_model('registration', 'Division')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    # Same precedence as the old Division.get_format(): the first class with a bracket wins.
+    for (app, model) in reversed((('kumite', 'KumiteElim1Bracket'), ('kumite', 'KumiteRoundRobinBracket'),
+            ('kumite', 'Kumite2PeopleBracket'), ('kata', 'KataBracket'))):
+        Bracket = apps.get_model(app, model)
+        ct = ContentType.objects.get_for_model(Bracket)
+        for (id, division_id) in Bracket.objects.filter(division__isnull=False).order_by('-id').values_list(
+                'id', 'division_id'):
+            Division.objects.filter(pk=division_id).update(format_type=ct, format_id=id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('registration', '0021_division_state_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='division',
+            name='format_id',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='division',
+            name='format_type',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='contenttypes.ContentType'),
+        ),
+        migrations.AddIndex(
+            model_name='division',
+            index=models.Index(fields=['format_type', 'format_id'], name='registratio_format__e39e09_idx'),
+        ),
+        migrations.RunPython(backfill_format, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.1.8 on 2026-10-18 15:37
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+
+def search_words(s):
+    """Copy of registration.models.search_words() when this migration was written."""
+    s = unicodedata.normalize('NFKD', s)
+    s = "".join(c for c in s if not unicodedata.combining(c)).casefold()
+    return re.findall(r'[^\W_]+', s)
+
+
+def backfill_search(apps, schema_editor):
+    """Fill in Person.search, same as Person.build_search()."""
+    Person = apps.get_model('registration', 'Person')
+    for p in Person.objects.all():
+        parts = [p.first_name, p.last_name, p.last_name, p.first_name, p.instructor, p.email, p.phone_number,
+            re.sub(r'\D', '', p.phone_number)]
+        Person.objects.filter(pk=p.pk).update(search=" ".join(w for x in parts for w in search_words(x)))
+
+
+def drop_search_index(apps, schema_editor):
+    """Drop the search index made by registration.models.create_person_indexes(), which runs after each migration."""
+
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            schema_editor.execute("DROP TRIGGER IF EXISTS registration_person_fts_" + trigger)
+        schema_editor.execute("DROP TABLE IF EXISTS registration_person_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS registration_person_search_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0022_division_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='search',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(backfill_search, migrations.RunPython.noop),
+        migrations.RunPython(migrations.RunPython.noop, drop_search_index),
+    ]
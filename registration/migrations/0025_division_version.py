@@ -0,0 +1,18 @@
+# Generated by Django 2.1.8 on 2026-10-18 15:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registration', '0024_person_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='division',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
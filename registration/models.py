@@ -11,12 +11,18 @@ event are provided by other modules.
 
 """
 
+import bisect
+import hashlib
 from datetime import date, datetime
+import re
+import unicodedata
 
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import connections, models, transaction, OperationalError
 from django.db.models import Q, F
-from django.db.models.signals import pre_delete, post_delete
+from django.db.models.signals import pre_delete, post_delete, post_migrate, post_save
 from django.db.models.aggregates import Count, Max, Min
 from django.db.models.functions import Lower
 from django.dispatch import receiver
@@ -27,6 +33,9 @@ from constance import config
 from djchoices import DjangoChoices, ChoiceItem
 import dateutil.parser
 
+from common.cache import LocalCache
+from common.models import DirtyFieldsMixin
+
 # Create your models here.
 
 class Event(models.Model):
@@ -58,6 +67,21 @@ class Event(models.Model):
         super().save(**kwargs)
     
     
+    @staticmethod
+    def get_cached(id):
+        """Returns the event with the id without querying the database. The instance is shared, don't modify it."""
+        try:
+            return _events.get()[id]
+        except KeyError:
+            raise Event.DoesNotExist("No event with id {}.".format(id))
+    
+    
+    @staticmethod
+    def get_all_cached():
+        """Returns a list of all the events without querying the database. Don't modify them."""
+        return list(_events.get().values())
+    
+    
     def get_orphan_links(self):
         return EventLink.objects.filter(event=self, division__isnull=True)
     
@@ -81,6 +105,10 @@ class Event(models.Model):
             raise Exception("Unexpected format.")
 
 
+_events = LocalCache('registration.Event', lambda: {e.id: e for e in Event.objects.all()})
+_events.connect(Event)
+
+
 class Rank(models.Model):
     """A belt rank.
     
@@ -102,26 +130,56 @@ class Rank(models.Model):
     
     @staticmethod
     def get_dan(dan):
-        return Rank.objects.get(order=dan)
+        return Rank.get_order(dan)
     
     
     @staticmethod
     def get_kyu(kyu):
-        return Rank.objects.get(order=-kyu)
+        return Rank.get_order(-kyu)
+    
+    
+    @staticmethod
+    def get_order(order):
+        """Returns a copy of the rank with the `order` without querying the database."""
+        try:
+            return _ranks.get()['order'][order]._copy()
+        except KeyError:
+            raise Rank.DoesNotExist("No rank with order {}.".format(order))
+    
+    
+    @staticmethod
+    def get_cached(id):
+        """Returns a copy of the rank with the id without querying the database."""
+        try:
+            return _ranks.get()['id'][id]._copy()
+        except KeyError:
+            raise Rank.DoesNotExist("No rank with id {}.".format(id))
+    
+    
+    def _copy(self):
+        # A new instance, as if loaded again, so callers can't change the cached one
+        fields = [f.attname for f in self._meta.concrete_fields]
+        return Rank.from_db(self._state.db, fields, [getattr(self, f) for f in fields])
     
 
     @staticmethod
     def parse(s):
         "Parse a string"
+        return Rank.get_order(Rank.parse_order(s))
+    
+    
+    @staticmethod
+    def parse_order(s):
+        """Parse a string and return the `order` of the rank without querying the database."""
         import re
-
+        
         m = re.match('.*(?:\D|^)(\d+)[a-z][a-z] kyu.*', s)
         if m is not None:
-            return Rank.get_kyu(int(m.group(1)))
+            return -int(m.group(1))
         
         m = re.match('.*(?:\D|^)(\d+)[a-z][a-z] dan.*', s)
         if m is not None:
-            return Rank.get_dan(int(m.group(1)))
+            return int(m.group(1))
         
         raise ValueError("Invalid rank string \"{}\".".format(s))
     
@@ -183,7 +241,15 @@ class Rank(models.Model):
             json.dump(data, stream, indent=4)
 
 
-class Division(models.Model):
+def _build_ranks():
+    ranks = list(Rank.objects.all())
+    return {'id': {r.id: r for r in ranks}, 'order': {r.order: r for r in ranks}}
+
+_ranks = LocalCache('registration.Rank', _build_ranks)
+_ranks.connect(Rank)
+
+
+class Division(DirtyFieldsMixin, models.Model):
     """A division is a group of people who will compete against eachother in a single event.
     
     
@@ -200,14 +266,32 @@ class Division(models.Model):
         ready = ChoiceItem("1")
         running = ChoiceItem("4")
         done = ChoiceItem("7")
-    state = models.CharField(max_length=1, choices=State.choices, default=State.ready)
+    # Kept up to date by update_state() when the bracket is built, its matches are saved or it is deleted.
+    state = models.CharField(max_length=1, choices=State.choices, default=State.ready, db_index=True)
+    
+    # The bracket. Set by bracket_created() when the bracket is first saved and cleared by bracket_deleted().
+    format_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, related_name='+', blank=True, null=True,
+        editable=False)
+    format_id = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    format = GenericForeignKey('format_type', 'format_id')
+    
+    # Increased whenever the bracket or who is in the division changes. See get_version().
+    version = models.PositiveIntegerField(default=0, editable=False)
+    
+    # Fields that decide who is in the division
+    ASSIGNMENT_FIELDS = ('event', 'gender', 'start_age', 'stop_age', 'start_rank', 'stop_rank')
+    
+    # Fields written by the bracket with queryset updates, never by save()
+    BRACKET_FIELDS = ('state', 'format_type', 'format_id', 'version')
     
     
     class Meta:
         ordering = ['event__is_team', 'start_age', 'start_rank', 'event']
+        indexes = [models.Index(fields=['format_type', 'format_id'])]
     
     def __str__(self):
-        s = str(self.event) + ": "
+        # Use the cached events and ranks. Division names are printed on most pages.
+        s = str(Event.get_cached(self.event_id)) + ": "
         if self.name:
             s = s + self.name
         else:
@@ -219,10 +303,12 @@ class Division(models.Model):
                 s = s + str(self.start_age) + "-" + str(self.stop_age)
             
             s = s + ", "
-            if self.start_rank == Rank.get_dan(1) and self.stop_rank == Rank.get_dan(10):
+            start_rank = Rank.get_cached(self.start_rank_id)
+            stop_rank = Rank.get_cached(self.stop_rank_id)
+            if start_rank.order == 1 and stop_rank.order == 10:
                 s = s + "Black Belt"
             else:
-                s = s + self.start_rank.name + " - " + self.stop_rank.name
+                s = s + start_rank.name + " - " + stop_rank.name
             
             s = s + ", " + self.get_gender_display()
         
@@ -300,12 +386,15 @@ class Division(models.Model):
         """
         
         links = self.filter_eventlinks()
+        Person.touch(eventlink__in=links.exclude(division=self))
+        Division.touch(eventlink__in=links.exclude(division=self))
         links.exclude(division=self).update(division=self)
+        Division.touch(pk=self.pk)
         
         if not self.event.is_team:
             return
         
-        teams = set((x.team.id for x in links if x.team is not None))
+        teams = set(links.filter(team__isnull=False).values_list('team_id', flat=True))
         teams = EventLink.objects.annotate(
             min_div=Min('eventlink__division__pk'), 
             max_div=Max('eventlink__division__pk'), 
@@ -321,81 +410,410 @@ class Division(models.Model):
     
     
     def save(self, *args, **kwargs):
-        super(Division, self).save(*args, **kwargs)
+        """Save the division and re-assign the people affected by the change.
+        
+        The new division of every affected :class:`.EventLink` is computed up front with the :class:`.DivisionIndex`
+        and written with a few set-based updates in a single transaction. Nobody is re-assigned if only the name
+        changed.
         
-        # Remove auto-assigned event links from division
-        links = self.eventlink_set.filter(person__isnull=False, locked=False, is_team=False)
-        link_ids = [x.id for x in links]
-        links.update(division=None)
+        The :attr:`BRACKET_FIELDS` of an existing division aren't written unless named in `update_fields`, since this
+        instance may have been loaded before its bracket changed.
+        """
         
-        # Add back in the event links that still fit. Also fixes teams.
-        self.claim()
+        if (len(args) == 0 and kwargs.get('update_fields') is None and not kwargs.get('force_insert', False)
+                and not self._state.adding):
+            kwargs['update_fields'] = [f for f in self.get_dirty_fields() if f not in Division.BRACKET_FIELDS]
         
-        # Links might belong in another division now
-        for link in EventLink.objects.filter(division=None, id__in=link_ids):
-            link.update_division()
-            if link.division is not None:
-                link.save()
+        if not self.has_changed(*Division.ASSIGNMENT_FIELDS):
+            super(Division, self).save(*args, **kwargs)
+            return
+        
+        with transaction.atomic():
+            super(Division, self).save(*args, **kwargs)
+            
+            # Auto-assigned event links that no longer fit. Work out where they belong now.
+            released = self.eventlink_set.filter(person__isnull=False, locked=False, is_team=False).exclude(
+                id__in=self.filter_eventlinks().values('id'))
+            index = DivisionIndex.get()
+            moves = {el['id']: index.find(el['event_id'], el['person__gender'], el['person__age'], el['person__rank_id'])
+                for el in released.values('id', 'event_id', 'person__gender', 'person__age', 'person__rank_id')}
+            
+            # Remove them from the division so they don't count as team members here.
+            EventLink.bulk_set_division(dict.fromkeys(moves, None))
+            
+            # Add in the event links that fit. Also fixes teams.
+            self.claim()
+            
+            EventLink.bulk_set_division({id: d for (id, d) in moves.items() if d is not None})
     
     
     @property
     def status(self):
-        b = self.get_format()
-        if b:
-            if b.get_next_match() is None:
-                return "Done"
-            else:
-                return "Started"
+        return {
+            Division.State.ready: "Ready",
+            Division.State.running: "Started",
+            Division.State.done: "Done",
+        }[self.state]
+    
+    
+    def update_state(self, fmt=None):
+        """Set :attr:`state` from the bracket of the division after the bracket changed.
+        
+        Only the state and version columns are written so the people aren't re-assigned like in :meth:`save`.
+        
+        Args:
+            fmt (optional): The bracket of the division if already known. Looked up with :meth:`get_format`
+                otherwise.
+        """
+        
+        if fmt is None:
+            fmt = self.get_format()
+        
+        if fmt is None:
+            state = Division.State.ready
+        elif fmt.is_done():
+            state = Division.State.done
         else:
-            return "Ready"
+            state = Division.State.running
+        
+        Division.objects.filter(pk=self.pk).update(state=state, version=F('version') + 1)
+        self.state = state
+        _division_progress.invalidate() # No signal from the update
+        
+        from . import results
+        results.schedule(self.pk)
     
     
     @staticmethod
     def find_eventlink_division(eventlink):
-        d = Division.objects.filter(start_age__lte=eventlink.person.age,
-            stop_age__gte=eventlink.person.age,
-            start_rank__order__lte=eventlink.person.rank.order,
-            stop_rank__order__gte=eventlink.person.rank.order,
-            event=eventlink.event,
-            gender__contains=eventlink.person.gender)
-        if len(d) == 0:
-            # clear it if it was previously set
-            d = None
-        elif len(d) == 1:
-            d = d[0]
-        else:
-            # Should really do something about multiple divisions.
-            d = d[0]
+        d = DivisionIndex.get().find_eventlink(eventlink)
+        if d is not None:
+            d = Division.objects.get(pk=d)
         return d
     
     
     def build_format(self):
+        self.refresh_from_db(fields=['format_type', 'format_id']) # Might have been built since this was loaded
         fmt = self.get_format()
         if fmt is not None:
             raise Exception("Already build.")
         
-        people = self.get_confirmed_eventlinks()
-        fmt = self.event.get_format_class(len(people))(division=self)
-        fmt.save()
-        fmt.build(people)
+        with transaction.atomic():
+            people = self.get_confirmed_eventlinks()
+            fmt = self.event.get_format_class(len(people))(division=self)
+            fmt.save() # Sets the bracket of the division, see bracket_created()
+            self.format = fmt
+            
+            fmt.build(people)
+            self.update_state(fmt)
         return fmt
     
     
-    def get_format(self):
+    @staticmethod
+    def bracket_created(fmt):
+        """Set the bracket of a division after the bracket has been saved for the first time.
+        
+        Args:
+            fmt: The bracket. Its division may be None.
+        """
+        
+        if fmt.division_id is not None:
+            Division.objects.filter(pk=fmt.division_id).update(format_type=ContentType.objects.get_for_model(fmt),
+                format_id=fmt.pk, version=F('version') + 1)
+    
+    
+    @staticmethod
+    def bracket_deleted(division_id):
+        """Clear the bracket of a division after it has been deleted.
+        
+        Args:
+            division_id: Id of the :class:`.Division`. May be None for brackets without a division.
+        """
+        
+        if division_id is not None:
+            Division.objects.filter(pk=division_id).update(state=Division.State.ready, format_type=None,
+                format_id=None, version=F('version') + 1)
+            _division_progress.invalidate()
+            
+            from . import results
+            results.schedule(division_id)
+    
+    
+    @staticmethod
+    def touch(**filters):
+        """Increase the `version` of the divisions matching the filters, with a single UPDATE.
+        
+        Call this when changing the bracket or the people in a division through a queryset update, which doesn't
+        call :meth:`update_state` or send signals.
+        """
+        Division.objects.filter(**filters).update(version=F('version') + 1)
+    
+    
+    @staticmethod
+    def get_version(model, pk):
+        """Returns a value that changes whenever the pages of a division or its bracket do, with a single query.
+        
+        Changes to the people in the division show up through :attr:`.Person.updated_at`, so checking someone in
+        doesn't have to update their divisions.
+        
+        Args:
+            model: :class:`.Division` or a bracket class.
+            pk: Id of the division or bracket.
+        
+        Returns:
+            Tuple of the division id, :attr:`version` and the last time someone in the division changed, or None if
+            there is no division.
+        """
+        
+        if model is Division:
+            divisions = Division.objects.filter(pk=pk)
+        else:
+            divisions = Division.objects.filter(format_type=ContentType.objects.get_for_model(model), format_id=pk)
+        return divisions.annotate(people=Max('eventlink__person__updated_at')).values_list('id', 'version',
+            'people').order_by().first()
+    
+    
+    @staticmethod
+    def get_format_classes():
+        """Returns the bracket classes that can be used as the format of a division."""
         
         from kumite.models import KumiteElim1Bracket, KumiteRoundRobinBracket, Kumite2PeopleBracket
         from kata.models import KataBracket
         
-        classes = [KumiteElim1Bracket, KumiteRoundRobinBracket, Kumite2PeopleBracket, KataBracket]
+        return [KumiteElim1Bracket, KumiteRoundRobinBracket, Kumite2PeopleBracket, KataBracket]
+    
+    
+    def get_format(self):
+        """Returns the bracket of the division, as of when the division was loaded, or None if it hasn't been built."""
+        
+        return self.format
+
+
+class DivisionSummary():
+    """Status of a :class:`.Division` for the divisions dashboard.
+    
+    Use :meth:`build` to summarize many divisions with a fixed number of queries. The status comes from
+    :attr:`.Division.state` and the winners are computed from the current matches, so both stay correct as matches
+    are scored.
+    
+    Attributes:
+        division: The :class:`.Division`.
+        format: The bracket of the division or None if it hasn't been built.
+        status: "Ready", "Started" or "Done" like :attr:`.Division.status`.
+        num_registered: Same as :meth:`.Division.get_num_registered`.
+        num_noshow: Number of :meth:`.Division.get_noshow_eventlinks`.
+        winners: Same as `format.get_winners()` when the status is "Done", otherwise None.
+    """
+    
+    def __init__(self, division, format=None, winners=None, num_registered=0, num_noshow=0):
+        self.division = division
+        self.format = format
+        self.winners = winners if division.state == Division.State.done else None
+        self.num_registered = num_registered
+        self.num_noshow = num_noshow
+        self.status = division.status
+    
+    
+    @staticmethod
+    def build(divisions):
+        """Summarize divisions.
+        
+        Args:
+            divisions: Iterable of :class:`.Division`. Use `select_related('event')` to avoid a query per division.
+        
+        Returns:
+            List of :class:`.DivisionSummary` in the same order as `divisions`.
+        """
+        
+        divisions = list(divisions)
+        ids = [d.id for d in divisions]
+        
+        built = [d.id for d in divisions if d.state != Division.State.ready]
+        results = {}
+        for c in Division.get_format_classes():
+            for (fmt, winners) in c.get_results(built):
+                results.setdefault(fmt.division_id, (fmt, winners))
+        
+        counts = {x['division_id']: x for x in EventLink.objects.filter(division__in=ids).values(
+            'division_id').annotate(
+                n_team=Count('id', filter=Q(is_team=True)),
+                n_non_team=Count('id', filter=Q(is_team=False)),
+                n_unassigned=Count('id', filter=Q(is_team=False, team=None)),
+                n_late=Count('id', filter=Q(person__confirmed=False)),
+            ).order_by()}
+        
+        # Load everything needed to display the winners' names.
+        winners = [el for (fmt, w) in results.values() if w is not None for (_, el) in w if el is not None]
+        models.prefetch_related_objects(winners, 'person', 'eventlink_set__person')
+        
+        summaries = []
+        for d in divisions:
+            (fmt, w) = results.get(d.id, (None, None))
+            count = counts.get(d.id)
+            if count is None:
+                (registered, noshow) = (0, 0)
+            elif d.event.is_team:
+                (registered, noshow) = (count['n_team'], count['n_unassigned'])
+            else:
+                (registered, noshow) = (count['n_non_team'], count['n_late'])
+            summaries.append(DivisionSummary(d, fmt, w, registered, noshow))
+        return summaries
+
+
+class DivisionProgress():
+    """Progress of a running :class:`.Division` for the venue dashboard.
+    
+    The progress of every running division is kept in memory and rebuilt on the first use after a match, division or
+    participant changes. Use :meth:`get_all` so polling the dashboard from many screens doesn't query the database.
+    
+    Attributes:
+        division: The :class:`.Division`.
+        name: Name of the division.
+        url: URL of the bracket.
+        current: Description of the match being run or None.
+        on_deck: Description of the match after it or None.
+        num_done: Number of matches done.
+        num_matches: Number of matches in the bracket.
+    """
+    
+    def __init__(self, division, format, pending, num_done, num_matches):
+        self.division = division
+        self.name = str(division)
+        self.url = format.get_absolute_url()
+        (self.current, self.on_deck) = ([m.get_progress_display() for m in pending] + [None, None])[:2]
+        self.num_done = num_done
+        self.num_matches = num_matches
+    
+    
+    @property
+    def percent(self):
+        """Percentage of the matches that are done, rounded down."""
+        return 100 * self.num_done // self.num_matches if self.num_matches > 0 else 0
+    
+    
+    @staticmethod
+    def build():
+        """Returns the progress of the running divisions with a fixed number of queries.
+        
+        Returns:
+            List of :class:`.DivisionProgress` in :class:`.Division` ordering.
+        """
+        
+        divisions = list(Division.objects.filter(state=Division.State.running).order_by(
+            *Division._meta.ordering + ['id']))
+        ids = [d.id for d in divisions]
+        
+        progress = {}
+        for c in Division.get_format_classes():
+            for (fmt, pending, num_done, num_matches) in c.get_progress(ids):
+                progress.setdefault(fmt.division_id, (fmt, pending, num_done, num_matches))
+        
+        return [DivisionProgress(d, *progress[d.id]) for d in divisions if d.id in progress]
+    
+    
+    @staticmethod
+    def get_all():
+        """Returns the shared progress of the running divisions.
+        
+        Returns:
+            Tuple of the list from :meth:`build` and an ETag that changes whenever the list does.
+        """
+        return _division_progress.get()
+    
+    
+    @staticmethod
+    def connect(*models):
+        """Rebuild the shared progress when an instance of one of the models is saved or deleted.
+        
+        Used by the apps with brackets for their match models.
+        """
+        _division_progress.connect(*models)
+    
+    
+    def _key(self):
+        return (self.division.id, self.name, self.url, self.current, self.on_deck, self.num_done, self.num_matches)
+
+
+def _build_division_progress():
+    progress = DivisionProgress.build()
+    etag = hashlib.sha1(repr([p._key() for p in progress]).encode()).hexdigest()
+    return (progress, etag)
+
+
+class DivisionIndex():
+    """Finds the :class:`.Division` that a person belongs in without querying the database.
+    
+    For each event and gender, the age axis is split into segments at the start and end of every division. Each
+    segment stores the divisions covering it in priority order, so a lookup is a binary search on the age followed by
+    a scan of the few candidates for the rank. When several divisions match, the first in :class:`.Division` ordering
+    wins, same as :meth:`.Division.find_eventlink_division` used to.
+    
+    Use :meth:`get` for the shared instance. It is rebuilt after a :class:`.Division`, :class:`.Rank` or
+    :class:`.Event` is saved or deleted.
+    """
+    
+    def __init__(self, divisions, ranks):
+        """
+        Args:
+            divisions: :class:`.Division` objects sorted by priority.
+            ranks: Dictionary mapping :class:`.Rank` ids to their `order`.
+        """
+        
+        self.rank_orders = dict(ranks)
+        
+        grouped = {}
+        for d in divisions:
+            for gender in ('M', 'F'):
+                if gender in d.gender:
+                    grouped.setdefault((d.event_id, gender), []).append(
+                        (d.id, d.start_age, d.stop_age, self.rank_orders[d.start_rank_id], self.rank_orders[d.stop_rank_id]))
         
-        for c in classes:
-            fmt = c.objects.filter(division=self)
-            if len(fmt) == 1:
-                return fmt[0]
-            elif len(fmt) > 1:
-                return fmt[0] # Should really do some error handeling
+        self.segments = {}
+        for (key, divs) in grouped.items():
+            starts = sorted(set([d[1] for d in divs] + [d[2] + 1 for d in divs]))
+            candidates = [[d for d in divs if d[1] <= age <= d[2]] for age in starts]
+            self.segments[key] = (starts, candidates)
+    
+    
+    @staticmethod
+    def get():
+        """Returns the shared index built from the current database contents."""
+        return _division_index.get()
+    
+    
+    @staticmethod
+    def build():
+        divisions = Division.objects.order_by(*Division._meta.ordering + ['id'])
+        return DivisionIndex(divisions, Rank.objects.values_list('id', 'order'))
+    
+    
+    def find(self, event_id, gender, age, rank_id):
+        """Returns the id of the division matching the arguments or None."""
         
+        try:
+            (starts, candidates) = self.segments[(event_id, gender)]
+        except KeyError:
+            return None
+        
+        i = bisect.bisect_right(starts, int(age)) - 1 # Unsaved people may have the age as a string
+        if i < 0:
+            return None
+        
+        rank_order = self.rank_orders[rank_id]
+        for (id, start_age, stop_age, start_order, stop_order) in candidates[i]:
+            if start_order <= rank_order <= stop_order:
+                return id
         return None
+    
+    
+    def find_eventlink(self, eventlink):
+        """Returns the id of the division for an :class:`.EventLink` with a :class:`.Person` or None."""
+        p = eventlink.person
+        return self.find(eventlink.event_id, p.gender, p.age, p.rank_id)
+
+
+_division_index = LocalCache('registration.DivisionIndex', DivisionIndex.build)
+_division_index.connect(Division, Rank, Event)
 
 
 @receiver(pre_delete, sender=Division)
@@ -404,20 +822,28 @@ def Division_pre_delete(sender, instance, **kwargs):
     # Remove manually added people and teams since we can't automatically assign them to a division.
     el = EventLink.objects.filter(division=instance, person__isnull=True)
     el.delete()
+    
+    # The remaining people are left without a division by an UPDATE that doesn't send signals.
+    Person.touch(eventlink__division=instance)
 
 
 @receiver(post_delete, sender=Division)
 def Division_post_delete(sender, instance, **kwargs):
 
-    # Call claim on the orphaned people since there could be overlapping divisions. This can't be done in the
-    # pre_delete handler because our changes would be overwritten.
-    for el in instance.filter_eventlinks().all():
-        el.update_division()
-        if el.division is not None:
-            el.save()
+    # Re-assign the orphaned people since there could be overlapping divisions. This can't be done in the
+    # pre_delete handler because our changes would be overwritten. The index has already been invalidated by the
+    # receiver connected in DivisionIndex.
+    index = DivisionIndex.get()
+    moves = {}
+    for el in instance.filter_eventlinks().values('id', 'division_id', 'event_id', 'person__gender', 'person__age',
+            'person__rank_id'):
+        division_id = index.find(el['event_id'], el['person__gender'], el['person__age'], el['person__rank_id'])
+        if division_id is not None and division_id != el['division_id']:
+            moves[el['id']] = division_id
+    EventLink.bulk_set_division(moves)
 
 
-class Person(models.Model):
+class Person(DirtyFieldsMixin, models.Model):
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     gender = models.CharField(max_length=1, choices=(('M', 'Male'), ('F', 'Female'),))
@@ -439,6 +865,13 @@ class Person(models.Model):
     
     notes = models.TextField(max_length=512, blank=True)
     
+    # Changed whenever something shown in the person list changes, including the events and divisions. See touch().
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    # Normalized words from the name, instructor, email and phone number separated by spaces. Kept up to date by
+    # save(), see build_search(). Indexed by create_person_indexes().
+    search = models.TextField(blank=True, editable=False)
+    
     class Meta:
         ordering = [Lower('last_name'), Lower('first_name')]
     
@@ -453,22 +886,241 @@ class Person(models.Model):
         return reverse('registration:detail', kwargs={'pk': self.pk})
     
     
+    @staticmethod
+    def sorted_by_name(qs=None, after=None):
+        """Sorts people like `Meta.ordering`, with the id as a final key to make the order unique.
+        
+        The sort keys are annotated as `sort_last` and `sort_first` so they can be used for keyset pagination.
+        
+        Args:
+            qs (optional): QuerySet of people. Defaults to everyone.
+            after (optional): Tuple of (sort_last, sort_first, id). Only people sorted after it are returned.
+        
+        Returns:
+            The sorted QuerySet.
+        """
+        
+        if qs is None:
+            qs = Person.objects.all()
+        qs = qs.annotate(sort_last=Lower('last_name'), sort_first=Lower('first_name')).order_by(
+            'sort_last', 'sort_first', 'id')
+        if after is not None:
+            (last, first, id) = after
+            qs = qs.filter(Q(sort_last__gt=last)
+                | Q(sort_last=last, sort_first__gt=first)
+                | Q(sort_last=last, sort_first=first, id__gt=id))
+        return qs
+    
+    
+    def build_search(self):
+        """Returns the value of the `search` field for the current field values."""
+        
+        parts = [self.first_name, self.last_name, self.last_name, self.first_name, self.instructor, self.email,
+            self.phone_number, re.sub(r'\D', '', self.phone_number)]
+        return " ".join(w for x in parts for w in search_words(x))
+    
+    
+    @staticmethod
+    def search_filter(qs, text):
+        """Filters people by words from their name, instructor, email or phone number.
+        
+        Every word in `text` must match the start of a word in the `search` field, ignoring case and accents.
+        
+        Args:
+            qs: QuerySet of people.
+            text: The search string.
+        """
+        
+        words = search_words(text)
+        if len(words) == 0:
+            return qs
+        
+        if _has_search_fts(qs.db):
+            query = " ".join('"{}"*'.format(w) for w in words)
+            # Not filter(id__in=RawSQL(...)), Django wraps it in another set of parentheses.
+            return qs.extra(where=['"registration_person"."id" IN '
+                '(SELECT rowid FROM registration_person_fts WHERE registration_person_fts MATCH %s)'], params=[query])
+        
+        for w in words:
+            qs = qs.filter(Q(search__startswith=w) | Q(search__contains=" " + w))
+        return qs
+    
+    
     def clean(self):
         if self.age < 18 and len(self.parent) == 0:
             raise ValidationError("Parent or guardian required if under 18.")
     
     
+    # Fields that decide which divisions the person is in
+    ASSIGNMENT_FIELDS = ('gender', 'age', 'rank')
+    
+    
+    @staticmethod
+    def touch(**filters):
+        """Set `updated_at` to now for the people matching the filters, with a single UPDATE.
+        
+        Call this when changing something shown with a person through a queryset update, which doesn't call
+        :meth:`save` or send signals.
+        """
+        Person.objects.filter(**filters).update(updated_at=timezone.now())
+    
+    
+    @staticmethod
+    def bulk_set_status(ids, confirmed=None, paid=None):
+        """Check in or mark as paid many people at once.
+        
+        Runs in a single transaction with one UPDATE per field. Like :meth:`save`, the payment date is set when a
+        person is marked as paid. Unknown ids are ignored.
+        
+        Args:
+            ids: Ids of the people.
+            confirmed (optional): New checked in status. Unchanged if None.
+            paid (optional): New paid status. Unchanged if None.
+        
+        Returns:
+            List of the ids of the people that changed.
+        """
+        
+        changes = Q(pk__in=[])
+        if confirmed is not None:
+            changes |= ~Q(confirmed=confirmed)
+        if paid is not None:
+            changes |= ~Q(paid=paid)
+            if paid:
+                changes |= Q(paidDate__isnull=True)
+        
+        with transaction.atomic():
+            changed = list(Person.objects.select_for_update().filter(changes, id__in=ids).values_list('id', flat=True))
+            people = Person.objects.filter(id__in=changed)
+            people.update(updated_at=timezone.now())
+            if confirmed is not None:
+                people.exclude(confirmed=confirmed).update(confirmed=confirmed)
+            if paid is not None:
+                people.exclude(paid=paid).update(paid=paid)
+                if paid:
+                    people.filter(paidDate__isnull=True).update(paidDate=date.today())
+        return changed
+    
+    
     def save(self, *args, **kwargs):
+        """Save the person. The event links are only re-assigned if a field used to pick the division changed."""
+        
         if self.paid and self.paidDate is None:
             self.paidDate = date.today()
-            
+        self.search = self.build_search()
+        
+        reassign = self.has_changed(*Person.ASSIGNMENT_FIELDS)
         super(Person, self).save(*args, **kwargs)
-        for el in self.eventlink_set.all():
-            el.update_division()
-            el.save()
+        if reassign:
+            for el in self.eventlink_set.all(): # el.person is set to self without a query
+                el.save() # Only writes if the division changed
 
 
-class EventLink(models.Model):
+def normalize_search(s):
+    """Lower case `s` and remove accents."""
+    s = unicodedata.normalize('NFKD', s)
+    return "".join(c for c in s if not unicodedata.combining(c)).casefold()
+
+
+def search_words(s):
+    """Splits `s` into normalized words, like the FTS5 tokenizer. :attr:`.Person.search` stores these words."""
+    return re.findall(r'[^\W_]+', normalize_search(s))
+
+
+_search_fts = {}
+
+def _has_search_fts(using):
+    # The FTS5 table is only created on SQLite builds that support it.
+    if using not in _search_fts:
+        _search_fts[using] = 'registration_person_fts' in connections[using].introspection.table_names()
+    return _search_fts[using]
+
+
+def create_person_indexes(connection):
+    """Create the :class:`.Person` indexes that Django can't describe. Does nothing for indexes that already exist.
+    
+    * The sort keys of :meth:`.Person.sorted_by_name` for paging through the people.
+    * :attr:`.Person.search` for word prefix searches. On SQLite, an FTS5 table is kept in sync with triggers so bulk
+      inserts and updates are indexed too. On PostgreSQL, a trigram index lets the LIKE queries of
+      :meth:`.Person.search_filter` use an index.
+    
+    SQLite drops these whenever a migration rebuilds the person table, so this runs after every migration.
+    """
+    
+    _search_fts.pop(connection.alias, None)
+    
+    with connection.cursor() as cursor:
+        if 'registration_person' not in connection.introspection.table_names(cursor):
+            return
+        
+        cursor.execute("CREATE INDEX IF NOT EXISTS registration_person_sort_name ON registration_person "
+            "(LOWER(last_name), LOWER(first_name), id)")
+        
+        if connection.vendor == 'sqlite':
+            tables = connection.introspection.table_names(cursor)
+            if 'registration_person_fts' not in tables:
+                try:
+                    cursor.execute("CREATE VIRTUAL TABLE registration_person_fts USING fts5(search, "
+                        "content='registration_person', content_rowid='id', prefix='1 2 3')")
+                except OperationalError:
+                    return # SQLite built without FTS5. Person.search_filter() falls back to LIKE.
+            
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'registration_person'")
+            triggers = set(row[0] for row in cursor.fetchall())
+            if triggers >= {'registration_person_fts_insert', 'registration_person_fts_delete',
+                    'registration_person_fts_update'}:
+                return
+            cursor.execute("DROP TRIGGER IF EXISTS registration_person_fts_insert")
+            cursor.execute("CREATE TRIGGER registration_person_fts_insert AFTER INSERT ON registration_person BEGIN "
+                "INSERT INTO registration_person_fts(rowid, search) VALUES (new.id, new.search); END")
+            cursor.execute("DROP TRIGGER IF EXISTS registration_person_fts_delete")
+            cursor.execute("CREATE TRIGGER registration_person_fts_delete AFTER DELETE ON registration_person BEGIN "
+                "INSERT INTO registration_person_fts(registration_person_fts, rowid, search) "
+                "VALUES ('delete', old.id, old.search); END")
+            cursor.execute("DROP TRIGGER IF EXISTS registration_person_fts_update")
+            cursor.execute("CREATE TRIGGER registration_person_fts_update AFTER UPDATE OF search "
+                "ON registration_person BEGIN "
+                "INSERT INTO registration_person_fts(registration_person_fts, rowid, search) "
+                "VALUES ('delete', old.id, old.search); "
+                "INSERT INTO registration_person_fts(rowid, search) VALUES (new.id, new.search); END")
+            # Changes made while the triggers were missing weren't indexed.
+            cursor.execute("INSERT INTO registration_person_fts(registration_person_fts) VALUES ('rebuild')")
+        elif connection.vendor == 'postgresql':
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute("CREATE INDEX IF NOT EXISTS registration_person_search_trgm ON registration_person "
+                "USING gin (search gin_trgm_ops)")
+
+
+@receiver(post_migrate)
+def Person_post_migrate(sender, using, **kwargs):
+    if sender.name == 'registration':
+        create_person_indexes(connections[using])
+
+
+@receiver(post_save, sender=Rank)
+def Rank_post_save(sender, instance, raw=False, **kwargs):
+    # Shown for each person and in division names. Ranks are hardly ever edited.
+    if not raw: # Fixtures may be loaded before the person table is up to date
+        Person.touch()
+        Division.touch()
+
+
+@receiver(post_save, sender=Event)
+def Event_post_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Person.touch(eventlink__event=instance)
+        Division.touch(event=instance)
+
+
+@receiver(post_save, sender=Division)
+def Division_post_save(sender, instance, raw=False, **kwargs):
+    # The division name is shown for the people in it
+    if not raw:
+        Person.touch(eventlink__division=instance)
+        Division.touch(pk=instance.pk)
+
+
+class EventLink(DirtyFieldsMixin, models.Model):
     """A person participating in a :class:`.Division`.
     
     If a person participates in multiple divisions, there will be multiple EventLinks.
@@ -517,17 +1169,51 @@ class EventLink(models.Model):
     
     def update_division(self):
         if self.person is not None and not self.locked:
-            self.division = Division.find_eventlink_division(self)
+            division_id = DivisionIndex.get().find_eventlink(self)
+            if division_id != self.division_id:
+                self.division_id = division_id
+                # Setting the id doesn't clear the cached Division.
+                field = self._meta.get_field('division')
+                if field.is_cached(self):
+                    field.delete_cached_value(self)
+    
+    
+    @staticmethod
+    def bulk_set_division(divisions):
+        """Move event links to other divisions with one UPDATE per destination division.
+        
+        Args:
+            divisions: Dictionary mapping :class:`.EventLink` ids to :class:`.Division` ids or None.
+        """
+        
+        by_division = {}
+        for (id, division_id) in divisions.items():
+            by_division.setdefault(division_id, []).append(id)
+        
+        batch = 500 # Stay below the SQLite limit on the number of query parameters
+        for (division_id, ids) in by_division.items():
+            for i in range(0, len(ids), batch):
+                Division.touch(eventlink__id__in=ids[i:i+batch])
+                EventLink.objects.filter(id__in=ids[i:i+batch]).update(division_id=division_id)
+                Person.touch(eventlink__id__in=ids[i:i+batch])
+            Division.touch(pk=division_id)
     
     
     @staticmethod
     def get_disqualified_singleton(event):
-        signature = {"event": event, "disqualified": True}
-        el = EventLink.objects.filter(**signature)
-        if len(el) > 0:
-            el = el[0]
-        else:
-            el = EventLink(**signature, manual_name="DISQUALIFIED", locked=True)
+        """Returns the placeholder used in brackets for a disqualified competitor, creating it if needed.
+        
+        The placeholders are cached so this usually doesn't query the database. The instance is shared, don't modify
+        it.
+        
+        Args:
+            event: The :class:`.Event` or its id.
+        """
+        
+        event_id = event.id if isinstance(event, Event) else event
+        el = _disqualified.get().get(event_id)
+        if el is None:
+            el = EventLink(event_id=event_id, disqualified=True, manual_name="DISQUALIFIED", locked=True)
             el.save()
         return el
     
@@ -564,6 +1250,31 @@ class EventLink(models.Model):
             return "Unknown"
 
 
+def _build_disqualified():
+    singletons = {}
+    for el in EventLink.objects.filter(disqualified=True).order_by('-id'):
+        singletons[el.event_id] = el # Keep the first one
+    return singletons
+
+_disqualified = LocalCache('registration.EventLink.disqualified', _build_disqualified)
+_disqualified.connect(EventLink, condition=lambda el: el.disqualified)
+
+_division_progress = LocalCache('registration.DivisionProgress', _build_division_progress)
+_division_progress.connect(Division, Event, Rank, EventLink, Person)
+
+
+@receiver(post_save, sender=EventLink)
+@receiver(post_delete, sender=EventLink)
+def EventLink_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if instance.person_id is not None:
+        Person.touch(pk=instance.person_id)
+    # Both the old and the new division. The loaded values are reset after the signal.
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    Division.touch(pk__in=[x for x in (instance.division_id, loaded.get('division_id')) if x is not None])
+
+
 def create_divisions():
 
     
@@ -608,7 +1319,7 @@ def create_divisions():
 
 
 @transaction.atomic # Fail the whole import if there is a parse error
-def import_registrations(f):
+def import_registrations(f, chunk_size=500):
     """Import registration data from Google Forms csv.
     
     Usage
@@ -621,6 +1332,10 @@ def import_registrations(f):
     
     Input stream should be opened with newline='' or muti-line entries will not be parsed correctly.
     
+    The file is parsed as a stream. Ranks, events and divisions are loaded once up front and the people and their
+    :class:`.EventLink` are written with ``bulk_create`` every `chunk_size` rows. :meth:`.Person.save` and
+    :meth:`.EventLink.save` are not called.
+    
     .. todo:: Pay attention to timezones when parsing dates. See https://docs.djangoproject.com/en/1.11/topics/i18n/timezones/
     """
 
@@ -628,6 +1343,8 @@ def import_registrations(f):
     from collections import namedtuple
     import datetime
     
+    from common.db import bulk_create_with_ids
+    
     R = namedtuple('CsvMap', field_names='name')
     csv_map = {
         'tstamp'        : R('Timestamp',),
@@ -652,6 +1369,22 @@ def import_registrations(f):
         #'Address': '', 'Postal Code': 'N1R 5J8'
         #'Province': 'Ontario', 'Email': '', 'Rank': 'Purple (4th kyu)'
 
+    # Reference data used to resolve each row without querying the database.
+    ranks = _ranks.get()['order']
+    events = {e.name: e for e in Event.get_all_cached()}
+    divisions = DivisionIndex.get()
+    
+    pending = [] # (Person, [Event])
+    
+    def flush():
+        for (p, _) in pending:
+            p.search = p.build_search()
+        people = bulk_create_with_ids(Person, (p for (p, _) in pending))
+        links = [EventLink(person=p, event=e, division_id=divisions.find(e.id, p.gender, p.age, p.rank_id))
+            for (p, row_events) in pending for e in row_events]
+        EventLink.objects.bulk_create(links)
+        del pending[:]
+
     c = csv.DictReader(f)
     
     t_min = config.SIGNUP_IMPORT_LAST_TSTAMP
@@ -676,7 +1409,7 @@ def import_registrations(f):
             continue
         t_max = max(t_max, tstamp)
         p = Person()
-        events = []
+        row_events = []
         for (field,field_info) in csv_map.items():
             
             found = False
@@ -695,14 +1428,20 @@ def import_registrations(f):
                     raise ValueError('Unable to find ' + field_info.name + err_str)
             
             if field == 'rank':
-                v = Rank.parse(v)
+                order = Rank.parse_order(v)
+                if order not in ranks:
+                    raise Rank.DoesNotExist("Unknown rank {}{}".format(v, err_str))
+                v = ranks[order]
             elif field == 'events':
                 # Delimiter used to be ", ", now ":"
                 if ';' in v:
                     v = v.split(';')
                 else:
                     v = v.split(", ")
-                events = [Event.objects.get(name=e) for e in v]
+                for e in v:
+                    if e not in events:
+                        raise Event.DoesNotExist("Unknown event {}{}".format(e, err_str))
+                    row_events.append(events[e])
                 continue
             elif field == 'reg_date':
                 v = tstamp
@@ -717,40 +1456,61 @@ def import_registrations(f):
                 pass
             setattr(p, field, v)
         try:
-            p.full_clean()
+            p.full_clean(exclude=['rank']) # Rank came from the database already. Skip the lookup.
         except ValidationError as e:
             raise ValueError("Validation error{}:\n{}".format(err_str, e))
-        p.save()
-        for e in events:
-            el = EventLink(person=p,event=e)
-            el.update_division()
-            el.save()
+        pending.append((p, row_events))
+        if len(pending) >= chunk_size:
+            flush()
         added += 1
+    flush()
     config.SIGNUP_IMPORT_LAST_TSTAMP = t_max
     
     return {"added": added, "skipped": skipped}
 
 
+def iter_registrations(chunk_size=500):
+    """Yields the header and then one row per :class:`.Person` for :func:`export_registrations`.
+    
+    People are read in pages of `chunk_size` using keyset pagination on their name, and the events of a page with
+    one more query. Each page is a short query so memory use doesn't grow with the number of registrations and the
+    database isn't held while a slow client consumes the rows.
+    """
+    
+    fields = ("first_name", "last_name", 'gender', 'age', 'rank', 'instructor', 'phone_number', 'email', 'parent', 'events', 'reg_date', 'notes')
+    columns = ['rank__name' if f == 'rank' else f for f in fields if f != 'events']
+    i_events = fields.index('events')
+    
+    yield fields
+    
+    after = None
+    while True:
+        people = list(Person.sorted_by_name(after=after).values_list(
+            'sort_last', 'sort_first', 'id', *columns)[:chunk_size])
+        if len(people) == 0:
+            return
+        
+        events = {}
+        links = EventLink.objects.filter(person_id__in=[p[2] for p in people]).order_by('event__name')
+        for (person_id, name) in links.values_list('person_id', 'event__name'):
+            events.setdefault(person_id, []).append(name)
+        
+        for p in people:
+            row = list(p[3:])
+            row.insert(i_events, ", ".join(events.get(p[2], ())))
+            yield row
+        
+        after = people[-1][:3]
+
+
 def export_registrations(f):
     """Export registration data as a csv file.
     
     Usage:
-        with open("filename.csv", "w", newline='''') as f:
+        with open("filename.csv", "w", newline='') as f:
             export_registrations(f)
     """
     
     from csv import writer
     csv = writer(f)
-    
-    fields = ("first_name", "last_name", 'gender', 'age', 'rank', 'instructor', 'phone_number', 'email', 'parent', 'events', 'reg_date', 'notes')
-    
-    def process_field(p, f):
-        if f == 'events':
-            return ", ".join((el.event.name for el in p.eventlink_set.all()))
-        else:
-            return getattr(p, f)
-    
-    csv.writerow(fields)
-    for p in Person.objects.all():
-        csv.writerow((process_field(p, f) for f in fields))
-    
+    csv.writerows(iter_registrations())
@@ -0,0 +1,175 @@
+"""Static HTML copy of the results for spectators.
+
+Spectators checking results compete with the scorers for the app servers. Instead, the results index and a page for
+each :class:`.Division` with a bracket are written to ``RESULTS_ROOT`` for nginx to serve::
+
+    results/index.html
+    results/division/<division id>.html
+
+Build the whole site with ``./manage.py build_results``. Once ``RESULTS_ROOT`` is set, the page of a division and the
+index are rewritten after each change to the bracket of the division, i.e. whenever
+:meth:`.Division.update_state` or :meth:`.Division.bracket_deleted` runs, once the transaction commits. Other changes,
+e.g. fixing a name, show up the next time the division changes or the site is rebuilt.
+
+The rows of the index are cached by division id and :attr:`.Division.version`, so rewriting the index after a change
+only summarizes the divisions that changed.
+
+Files are written to a temporary file and renamed so nginx never serves a partially written page.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from common.cache import LRUCache
+from .models import Division, DivisionSummary
+
+
+_pending = threading.local()
+_index_rows = LRUCache(maxsize=5000)
+
+
+def get_root():
+    """Returns the directory of the results site or None if it is disabled."""
+    return getattr(settings, 'RESULTS_ROOT', None)
+
+
+def build(division_ids=None, root=None):
+    """Write the index and the pages of divisions.
+
+    Args:
+        division_ids (optional): Ids of the divisions whose pages are written. Every division by default, which also
+            removes the pages of divisions that no longer have a bracket.
+        root (optional): Directory of the site. Defaults to :func:`get_root`.
+
+    Returns:
+        Number of pages written.
+    """
+
+    root = root if root is not None else get_root()
+    os.makedirs(os.path.join(root, 'division'), exist_ok=True)
+    now = timezone.now()
+
+    divisions = list(Division.objects.select_related('event', 'start_rank', 'stop_rank'))
+    summaries = DivisionSummary.build([d for d in divisions if division_ids is None or d.id in division_ids])
+    write_file(os.path.join(root, 'index.html'), render_to_string('registration/results/index.html',
+        {'rows': render_index_rows(divisions, summaries), 'now': now}))
+    n_page = 1
+
+    keep = set()
+    for summary in summaries:
+        if summary.format is None:
+            continue
+        keep.add(division_path(root, summary.division.id))
+        write_file(division_path(root, summary.division.id), render_division(summary, now))
+        n_page += 1
+
+    if division_ids is None:
+        for name in os.listdir(os.path.join(root, 'division')):
+            path = os.path.join(root, 'division', name)
+            if path not in keep:
+                os.remove(path)
+
+    return n_page
+
+
+def render_index_rows(divisions, summaries=()):
+    """Returns the row of each division in the index, rendered by ``results/index_row.html``.
+
+    Rows are cached by division id and :attr:`.Division.version`, so only the divisions without a cached row are
+    summarized.
+
+    Args:
+        divisions: List of :class:`.Division`. Use `select_related('event')` to avoid a query per division.
+        summaries (optional): Current :class:`.DivisionSummary` of some of the divisions, whose rows are rendered
+            again.
+    """
+
+    summaries = {s.division.id: s for s in summaries}
+    keys = [(d.id, d.version) for d in divisions]
+    rows = [None if d.id in summaries else _index_rows.get(key) for (d, key) in zip(divisions, keys)]
+
+    missing = [i for (i, row) in enumerate(rows) if row is None]
+    uncached = [divisions[i] for i in missing if divisions[i].id not in summaries]
+    if len(uncached) > 0:
+        summaries.update((s.division.id, s) for s in DivisionSummary.build(uncached))
+    for i in missing:
+        rows[i] = render_to_string('registration/results/index_row.html', {'summary': summaries[divisions[i].id]})
+        _index_rows.set(keys[i], rows[i])
+    return rows
+
+
+def render_division(summary, now=None):
+    """Returns the page of a division.
+
+    Args:
+        summary: :class:`.DivisionSummary` of a division with a bracket.
+        now (optional): Time shown as the last update.
+    """
+
+    from kata.models import KataBracket, KataBracketSnapshot
+    from kumite.models import KumiteElim1Bracket
+    from kumite.views import BracketGrid
+
+    fmt = summary.format
+    context = {'summary': summary, 'now': now if now is not None else timezone.now()}
+    if isinstance(fmt, KataBracket):
+        context['rounds'] = KataBracketSnapshot(fmt).rounds
+    else:
+        context['grid'] = BracketGrid(fmt)
+        if isinstance(fmt, KumiteElim1Bracket):
+            context['consolation_grid'] = BracketGrid(fmt, consolation=True, snapshot=context['grid'].snapshot)
+    return render_to_string('registration/results/division.html', context)
+
+
+def division_path(root, division_id):
+    return os.path.join(root, 'division', '{}.html'.format(division_id))
+
+
+def write_file(path, content):
+    """Replace the file at `path` with `content` in a single step."""
+
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.chmod(tmp, 0o644) # mkstemp only lets the owner read the file
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def schedule(division_id):
+    """Rewrite the page of the division and the index after the current transaction commits.
+
+    Divisions changed in the same transaction are written together. Does nothing if the site is disabled.
+    """
+
+    if get_root() is None or division_id is None:
+        return
+
+    # A hook for every call, the first one to run writes all the pending divisions. If the transaction is rolled back,
+    # its divisions are only written again with the next commit.
+    if getattr(_pending, 'ids', None) is None:
+        _pending.ids = set()
+    _pending.ids.add(division_id)
+    transaction.on_commit(_flush)
+
+
+def _flush():
+    ids = _pending.ids
+    _pending.ids = None
+    if not ids:
+        return
+    try:
+        build(ids)
+    except Exception:
+        # Scoring must go on if the results can't be written
+        logging.getLogger(__name__).exception("Failed to write the results of divisions %s.", sorted(ids))
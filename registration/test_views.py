@@ -1,8 +1,15 @@
 import os
+import shutil
+import tempfile
 import time
+from unittest import mock
 
+from django.core.management import call_command
+from django.db import connection
+from django.template.loader import render_to_string
 from django.urls import reverse
-from django.test import LiveServerTestCase, TestCase
+from django.test import LiveServerTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 
 from django_webtest import WebTest
@@ -14,10 +21,14 @@ from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.action_chains import ActionChains
 
-from .models import Event, Division, Person, Rank, EventLink
+from . import results, views
+from .models import Event, Division, DivisionSummary, Person, Rank, EventLink
 from .views import IndexView
 from accounts.models import RightsSupport
+from common import replica
 import common.selenium
+from common.views import CSRF_PLACEHOLDER
+from kata.models import KataMatch
 
 class PersonListTestCase(WebTest):
     
@@ -62,7 +73,7 @@ class PersonListTestCase(WebTest):
         self.assertEqual(p.paid, True)
         self.assertEqual(p.confirmed, False) # No change
         self.assertNotIn('form_paid_' + str(p.id), resp.forms)
-        self.assertEqual(resp.context['object_list'].count(), 4)
+        self.assertEqual(len(resp.context['object_list']), 4)
     
     
     def test_person_paid_inline(self):
@@ -103,7 +114,7 @@ class PersonListTestCase(WebTest):
         self.assertEqual(p.paid, False) # No change
         self.assertEqual(p.confirmed, True)
         self.assertNotIn('form_confirmed_' + str(p.id), resp.forms)
-        self.assertEqual(resp.context['object_list'].count(), 4)
+        self.assertEqual(len(resp.context['object_list']), 4)
     
     
     def test_person_confirmed_inline(self):
@@ -127,6 +138,37 @@ class PersonListTestCase(WebTest):
         self.assertNotIn('form_confirmed_' + str(p.id), resp.forms)
     
     
+    def test_person_bulk_status(self):
+        url = reverse('registration:person-bulk-status')
+        self.client.force_login(get_user_model().objects.get(username="temporary"))
+        
+        a = Person.objects.get(first_name="aaa")
+        b = Person.objects.get(first_name="bbb")
+        c = Person.objects.get(first_name="ccc")
+        
+        # b is already checked in and 0 doesn't exist
+        resp = self.client.post(url, {'ids': "{}, {} {} 0".format(a.id, b.id, c.id), 'confirmed': 'True'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(set(p.id for p in resp.context['object_list']), {a.id, c.id})
+        self.assertContains(resp, 'id="person_{}"'.format(a.id))
+        self.assertNotContains(resp, 'form_confirmed_' + str(a.id))
+        for p in (a, b, c):
+            p.refresh_from_db()
+            self.assertTrue(p.confirmed)
+        self.assertFalse(a.paid) # No change
+        
+        resp = self.client.post(url, {'ids': "{} {}".format(a.id, c.id), 'paid': 'True'})
+        self.assertEqual([p.id for p in resp.context['object_list']], [a.id])
+        a.refresh_from_db()
+        self.assertTrue(a.paid)
+        self.assertIsNotNone(a.paidDate)
+        
+        resp = self.client.post(url, {'ids': "{}".format(a.id)})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(url, {'ids': "asdf", 'paid': 'True'})
+        self.assertEqual(resp.status_code, 400)
+    
+    
     def test_person_filter(self):
         url = reverse('registration:index')
         resp = self.app.get(url)
@@ -158,7 +200,393 @@ class PersonListTestCase(WebTest):
         resp = form.submit()
         
         self.assertEqual(names_summary(resp), ["ccc"])
+    
+    
+    def test_person_pages(self):
+        def names_summary(resp):
+            return [x.first_name for x in resp.context['object_list']]
+        
+        with mock.patch.object(IndexView, 'page_size', 3):
+            resp = self.app.get(reverse('registration:index'))
+            self.assertEqual(names_summary(resp), ["ccc", "eee", "aaa"])
+            self.assertEqual(resp.context['num_people'], 4)
+            self.assertIn('id="person_table_more"', resp.text)
+            
+            resp = self.app.get(reverse('registration:index-table-page'),
+                params={'after': resp.context['next_after']})
+            self.assertEqual(names_summary(resp), ["bbb"])
+            self.assertNotIn('next_after', resp.context)
+            self.assertTrue(resp.text.strip().startswith('<tr id="person_'))
+            
+            # Filters apply to the following pages
+            with mock.patch.object(IndexView, 'page_size', 1):
+                resp = self.app.get(reverse('registration:index-table'), params={'name': "last1"})
+                self.assertEqual(names_summary(resp), ["aaa"])
+                resp = self.app.get(reverse('registration:index-table-page'),
+                    params={'name': "last1", 'after': resp.context['next_after']})
+                self.assertEqual(names_summary(resp), ["bbb"])
+                self.assertNotIn('next_after', resp.context)
+    
+    
+    def test_row_cache(self):
+        url = reverse('registration:index-table')
+        views._person_rows.clear()
+        self.app.get(url)
+        
+        with mock.patch('registration.views.render_to_string', wraps=render_to_string) as render:
+            resp = self.app.get(url)
+            self.assertEqual(render.call_count, 0)
+            self.assertNotIn(CSRF_PLACEHOLDER, resp.text)
+            self.assertIn('csrfmiddlewaretoken', resp.text)
+            
+            p = Person.objects.get(first_name="aaa")
+            p.confirmed = True
+            p.save()
+            resp = self.app.get(url)
+            self.assertEqual(render.call_count, 1)
+            self.assertNotIn('form_confirmed_' + str(p.id), resp.text)
+            
+            # Shown in three rows
+            e = Event.objects.get(name="Kumite")
+            e.name = "Sparring"
+            e.save()
+            resp = self.app.get(url)
+            self.assertEqual(render.call_count, 4)
+            self.assertIn("Sparring", resp.text)
+        
+        # Rows are cached separately for users that can't edit
+        resp = self.app.get(url, user=RightsSupport.create_view_user().username)
+        self.assertNotIn('form_paid_', resp.text)
+    
+    
+    def test_export(self):
+        url = reverse('registration:export')
+        resp = self.app.get(url)
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertIn('attachment', resp['Content-Disposition'])
+        
+        rows = resp.text.splitlines()
+        self.assertEqual(rows[0], "first_name,last_name,gender,age,rank,instructor,phone_number,email,parent,events,reg_date,notes")
+        self.assertEqual([r.split(',')[0] for r in rows[1:]], ["ccc", "eee", "aaa", "bbb"])
+        self.assertTrue(rows[2].startswith('eee,fff,M,30,{},asdf,,,,"Kumite, Team kata",'.format(Rank.get_kyu(8))))
         
+        # Admin rights required
+        self.app.get(url, user=RightsSupport.create_edit_user().username, status=403)
+        
+    
+class DivisionListTestCase(WebTest):
+    
+    def setUp(self):
+        self.kumite = Event.objects.create(name="Test kumite", format=Event.EventFormat.elim1)
+        self.kata = Event.objects.create(name="Test kata", format=Event.EventFormat.kata)
+    
+    
+    def make_division(self, event, n, age, build=True, n_match=None):
+        """Create a division of n people and optionally build it and run the first n_match matches.
+        
+        The person whose name comes first in the alphabet always wins.
+        """
+        
+        d = Division.objects.create(event=event, gender='MF', start_age=age, stop_age=age,
+            start_rank=Rank.get_kyu(9), stop_rank=Rank.get_dan(10))
+        for i in range(n):
+            EventLink.objects.create(manual_name=chr(ord("a") + i), event=event, division=d)
+        if not build:
+            return d
+        
+        fmt = d.build_format()
+        i = 0
+        while n_match is None or i < n_match:
+            m = fmt.get_next_match()
+            if m is None:
+                break
+            if event == self.kata:
+                m.scores = [9 - ord(m.eventlink.name) + ord("a")] * 5
+                m.save()
+            else:
+                winner = m.aka if m.aka.name < m.shiro.name else m.shiro
+                winner.points = 1
+                winner.save()
+                m.done = True
+                m.infer_winner()
+                m.save()
+            i += 1
+        return d
+    
+    
+    def make_divisions(self, age):
+        return [
+            self.make_division(self.kumite, 4, age), # Elimination
+            self.make_division(self.kumite, 3, age + 1, n_match=1), # Round robin
+            self.make_division(self.kumite, 2, age + 2), # 2 people
+            self.make_division(self.kata, 4, age + 3),
+            self.make_division(self.kata, 2, age + 4, build=False),
+        ]
+    
+    
+    def test_summary(self):
+        divisions = self.make_divisions(1)
+        
+        url = reverse('registration:divisions')
+        resp = self.app.get(url)
+        summaries = {s.division: s for s in resp.context['summaries']}
+        for d in divisions:
+            s = summaries[d]
+            self.assertEqual(s.status, d.status)
+            self.assertEqual(s.num_registered, d.get_num_registered())
+            self.assertEqual(s.num_noshow, len(d.get_noshow_eventlinks()))
+            self.assertEqual(s.format, d.get_format())
+            if s.status == "Done":
+                self.assertEqual(list(s.winners), list(d.get_format().get_winners()))
+            else:
+                self.assertIsNone(s.winners)
+        self.assertEqual([summaries[d].status for d in divisions], ["Done", "Started", "Done", "Done", "Ready"])
+        self.assertIn("1. a", resp.text)
+        
+        # Number of queries doesn't depend on the number of divisions
+        with CaptureQueriesContext(connection) as queries:
+            self.app.get(url)
+        n_query = len(queries)
+        
+        self.make_divisions(11)
+        with self.assertNumQueries(n_query):
+            self.app.get(url)
+    
+    
+    def test_filter_state(self):
+        divisions = self.make_divisions(1)
+        url = reverse('registration:divisions')
+        
+        resp = self.app.get(url, params={'state': Division.State.done})
+        self.assertEqual([s.division for s in resp.context['summaries']], [divisions[i] for i in (0, 2, 3)])
+        
+        resp = self.app.get(url, params={'state': Division.State.ready})
+        self.assertEqual([s.division for s in resp.context['summaries']][-1], divisions[4])
+        self.assertNotIn(divisions[1], [s.division for s in resp.context['summaries']])
+        
+        # The kumite bracket delete view makes the division ready again
+        bracket = divisions[1].get_format()
+        resp = self.app.get(bracket.get_absolute_url(), user=RightsSupport.create_admin_user().username)
+        form = [f for f in resp.forms.values() if f.action.endswith('/delete/')][0]
+        form.submit().follow()
+        self.assertEqual(Division.objects.get(pk=divisions[1].pk).state, Division.State.ready)
+    
+    
+    def test_dashboard_new_division(self):
+        url = reverse('registration:division-dashboard-table')
+        d = self.make_division(self.kumite, 5, 1, build=False)
+        self.assertEqual(self.app.get(url).context['progress'], [])
+        
+        # Starting and deleting a bracket only update the division with a queryset
+        fmt = d.build_format()
+        self.assertEqual([p.division for p in self.app.get(url).context['progress']], [d])
+        fmt.delete()
+        self.assertEqual(self.app.get(url).context['progress'], [])
+    
+    
+    def test_dashboard(self):
+        elim = self.make_division(self.kumite, 4, 1, n_match=1)
+        rr = self.make_division(self.kumite, 3, 2, n_match=1)
+        kata = self.make_division(self.kata, 4, 3, n_match=2)
+        self.make_division(self.kumite, 2, 4) # Done
+        self.make_division(self.kata, 2, 5, build=False) # Ready
+        
+        resp = self.app.get(reverse('registration:division-dashboard'))
+        self.assertEqual([p.division for p in resp.context['progress']], [elim, rr, kata])
+        
+        url = reverse('registration:division-dashboard-table')
+        resp = self.app.get(url)
+        progress = resp.context['progress']
+        self.assertEqual([p.division for p in progress], [elim, rr, kata])
+        for (p, d, n_done, n_matches) in zip(progress, (elim, rr, kata), (1, 1, 2), (4, 3, 4)):
+            fmt = d.get_format()
+            self.assertEqual(p.url, fmt.get_absolute_url())
+            self.assertEqual((p.num_done, p.num_matches), (n_done, n_matches))
+            self.assertEqual(p.current, fmt.get_next_match().get_progress_display())
+            self.assertIn(p.current, resp.text)
+        self.assertEqual(progress[0].on_deck, elim.get_format().get_on_deck_match().get_progress_display())
+        self.assertEqual(progress[0].current, "Semi-finals, Match 2: b vs c")
+        self.assertEqual(progress[0].on_deck, "Consolation Final: d vs TBD")
+        self.assertEqual(progress[1].percent, 33)
+        self.assertEqual(progress[2].on_deck, "d")
+        
+        # Polling is free until something changes
+        etag = resp.headers['ETag']
+        with self.assertNumQueries(0):
+            resp = self.app.get(url, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(resp.body, b"")
+        
+        m = kata.get_format().get_next_match()
+        m.scores = [5] * 5
+        m.save()
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.context['progress'][2].num_done, 3)
+    
+    
+    def test_versioned_pages(self):
+        user = RightsSupport.create_edit_user().username
+        kumite = self.make_division(self.kumite, 4, 1, n_match=1)
+        kata = self.make_division(self.kata, 4, 2, n_match=1)
+        ready = self.make_division(self.kumite, 2, 3, build=False)
+        
+        def check_changed(url, change):
+            resp = self.app.get(url, user=user)
+            etag = resp.headers['ETag']
+            self.app.get(url, user=user, headers={'If-None-Match': etag}, status=304)
+            change()
+            resp = self.app.get(url, user=user, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+            return resp
+        
+        def run_kumite():
+            m = kumite.get_format().get_next_match()
+            m.aka.points = 1
+            m.aka.save()
+            m.done = True
+            m.infer_winner()
+            m.save()
+        
+        def score_kata():
+            m = kata.get_format().get_next_match()
+            m.scores = [5] * 5
+            m.save()
+        
+        def judge_kata():
+            m = kata.get_format().get_next_match()
+            self.assertFalse(KataMatch.set_judge_score(m.id, 1, 7))
+        
+        def check_in():
+            p = Person.objects.create(first_name="late", last_name="comer", gender='M', age=3, rank=Rank.get_kyu(9),
+                instructor="asdf")
+            el = EventLink.objects.create(person=p, event=self.kumite)
+            self.assertEqual(el.division, ready)
+            Person.bulk_set_status([p.id], confirmed=True)
+        
+        def remove():
+            EventLink.objects.filter(division=ready, manual_name="a").delete()
+        
+        check_changed(kumite.get_format().get_absolute_url(), run_kumite)
+        check_changed(kata.get_format().get_absolute_url(), score_kata)
+        resp = check_changed(kata.get_format().get_absolute_url(), judge_kata)
+        self.assertIn("7.0", resp.text)
+        check_changed(ready.get_absolute_url(), check_in)
+        resp = check_changed(ready.get_absolute_url(), remove)
+        self.assertNotIn(">a<", resp.text)
+        
+        # The page is only rendered once for each version. The CSRF token of the request is filled in.
+        url = ready.get_absolute_url()
+        self.app.get(url, user=user)
+        with self.assertNumQueries(5): # Session, user, permissions of the user and groups, version
+            resp = self.app.get(url, user=user)
+        self.assertNotIn(CSRF_PLACEHOLDER, resp.text)
+        resp.forms['add_form']['manual_name'] = "new"
+        resp.forms['add_form'].submit().follow()
+        self.assertIn("new", self.app.get(url, user=user).text)
+        
+        # Each user has their own copy
+        self.assertNotIn("Logout view", resp.text)
+        self.assertIn("Logout view", self.app.get(url, user=RightsSupport.create_view_user().username).text)
+    
+    
+    def test_replica(self):
+        kumite = self.make_division(self.kumite, 4, 1, n_match=1)
+        viewer = RightsSupport.create_view_user().username
+        editor = RightsSupport.create_edit_user().username
+        
+        # Spectators read the replica, scorers the live database. The test database has no snapshot to read.
+        with mock.patch.object(replica, 'reading', wraps=replica.reading) as reading:
+            self.app.get(reverse('registration:divisions'))
+            self.app.get(kumite.get_absolute_url(), user=viewer)
+            self.app.get(kumite.get_format().get_absolute_url(), user=viewer)
+            self.assertEqual(reading.call_count, 3)
+            
+            self.app.get(kumite.get_absolute_url(), user=editor)
+            self.app.get(kumite.get_format().get_absolute_url(), user=editor)
+            self.assertEqual(reading.call_count, 3)
+    
+    
+    def test_results(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.addCleanup(results._index_rows.clear)
+        kumite = self.make_division(self.kumite, 4, 1)
+        kata = self.make_division(self.kata, 4, 2, n_match=1)
+        ready = self.make_division(self.kumite, 2, 3, build=False)
+        
+        os.mkdir(os.path.join(root, 'division'))
+        with open(results.division_path(root, 999), 'w') as f:
+            f.write("Deleted division")
+        call_command('build_results', root=root, stdout=open(os.devnull, 'w'))
+        self.assertEqual(sorted(os.listdir(os.path.join(root, 'division'))),
+            sorted(["{}.html".format(kumite.id), "{}.html".format(kata.id)]))
+        
+        with open(os.path.join(root, 'index.html')) as f:
+            index = f.read()
+        self.assertIn('href="division/{}.html"'.format(kumite.id), index)
+        self.assertIn(str(ready), index)
+        self.assertIn("1. a", index)
+        with open(results.division_path(root, kumite.id)) as f:
+            self.assertIn("Points: 1", f.read())
+        self.assertEqual(os.stat(results.division_path(root, kumite.id)).st_mode & 0o777, 0o644)
+        
+        # Scoring only rewrites the page of the division and the index after the transaction commits
+        with open(results.division_path(root, kumite.id), 'w') as f:
+            f.write("Untouched")
+        with override_settings(RESULTS_ROOT=root):
+            m = kata.get_format().get_next_match()
+            m.scores = [7.5] * 5
+            m.save()
+            self.assertEqual(results._pending.ids, set([kata.id]))
+            results._flush()
+        with open(results.division_path(root, kata.id)) as f:
+            self.assertIn("22.5", f.read())
+        with open(results.division_path(root, kumite.id)) as f:
+            self.assertEqual(f.read(), "Untouched")
+        self.assertEqual([f for f in os.listdir(os.path.join(root, 'division')) if f.startswith(".")], [])
+        
+        # Disabled by default
+        m = kata.get_format().get_next_match()
+        m.scores = [5] * 5
+        m.save()
+        self.assertIsNone(results._pending.ids)
+    
+    
+    def test_results_queries(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.addCleanup(results._index_rows.clear)
+        divisions = [self.make_division(self.kata, 4, 1, n_match=1)]
+        
+        # Rewriting the results after a match costs the same however many divisions there are
+        with override_settings(RESULTS_ROOT=root):
+            results.build()
+            with CaptureQueriesContext(connection) as queries:
+                results.schedule(divisions[0].id)
+                results._flush()
+        
+        for age in range(2, 12):
+            divisions.append(self.make_division(self.kata, 4, age, n_match=1))
+        with override_settings(RESULTS_ROOT=root):
+            results.build()
+            with self.assertNumQueries(len(queries)):
+                results.schedule(divisions[0].id)
+                results._flush()
+            
+            # Only the changed division is summarized, the other rows come from the cache
+            m = divisions[0].get_format().get_next_match()
+            m.scores = [7.5] * 5
+            m.save()
+            with mock.patch.object(DivisionSummary, 'build', wraps=DivisionSummary.build) as summarize:
+                results._flush()
+            summarize.assert_called_once_with([divisions[0]])
+        
+        with open(os.path.join(root, 'index.html')) as f:
+            index = f.read()
+        for d in divisions:
+            self.assertIn('href="division/{}.html"'.format(d.id), index)
+    
     
 class DivisionDetailTestCase(WebTest):
     
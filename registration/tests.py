@@ -2,10 +2,15 @@ from datetime import datetime
 from io import StringIO
 
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import connection
 from django.db.models import Q
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-from .models import Person, Rank, EventLink, Division, Event, import_registrations, export_registrations
+from kata.models import KataBracket
+from . import models
+from .models import Person, Rank, EventLink, Division, DivisionIndex, Event, import_registrations, export_registrations, \
+    iter_registrations
 
 # Create your tests here.
 class EventTestCase(TestCase):
@@ -70,11 +75,86 @@ class RankTestCase(TestCase):
         
         with self.assertRaises(ValueError):
             Rank.parse("asdflaksjdf")
+    
+    
+    def test_cached(self):
+        e = Event(name="event", format=Event.EventFormat.kata)
+        e.save()
+        d = Division(event=e, gender='MF', start_age=5, stop_age=10, start_rank=Rank.get_kyu(9),
+            stop_rank=Rank.get_dan(1))
+        d.save()
+        d = Division.objects.get(pk=d.pk)
+        str(d)
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(Rank.get_dan(2).name[:5], "Nidan")
+            self.assertEqual(Rank.parse(str(Rank.get_kyu(8))).order, -8)
+            self.assertTrue(str(d).startswith("event"))
+        
+        r = Rank.get_dan(2)
+        r.name = "Second"
+        self.assertEqual(Rank.get_dan(2).name[:5], "Nidan") # Only the copy changed
+        r.save()
+        self.assertEqual(Rank.get_dan(2).name, "Second")
 
 
 class DivisionTestCase(TestCase):
     
     
+    def test_state(self):
+        e = Event.objects.create(name="event", format=Event.EventFormat.kata)
+        d = Division.objects.create(event=e, gender='MF', start_age=1, stop_age=99, start_rank=Rank.get_kyu(9),
+            stop_rank=Rank.get_dan(9))
+        for name in ("a", "b"):
+            EventLink.objects.create(manual_name=name, event=e, division=d)
+        
+        def state():
+            return Division.objects.get(pk=d.pk).state
+        
+        self.assertEqual(state(), Division.State.ready)
+        
+        fmt = Division.objects.get(pk=d.pk).build_format()
+        self.assertEqual(state(), Division.State.running)
+        with self.assertNumQueries(2):
+            self.assertEqual(Division.objects.get(pk=d.pk).get_format(), fmt)
+        
+        m1 = fmt.get_next_match()
+        m1.scores = (5, 6, 7, 8, 9)
+        m1.save()
+        self.assertEqual(state(), Division.State.running)
+        
+        m2 = fmt.get_next_match()
+        m2.scores = (6, 7, 8, 9, 10)
+        m2.save()
+        self.assertEqual(state(), Division.State.done)
+        self.assertEqual(Division.objects.get(pk=d.pk).status, "Done")
+        
+        # Clearing a score reopens the division
+        m2.scores = (None,) * 5
+        m2.save()
+        self.assertEqual(state(), Division.State.running)
+        
+        # An instance loaded before the bracket changed doesn't write it back
+        stale = Division.objects.get(pk=d.pk)
+        fmt.delete()
+        self.assertEqual(state(), Division.State.ready)
+        self.assertIsNone(Division.objects.get(pk=d.pk).get_format())
+        stale.name = "Renamed"
+        stale.save()
+        self.assertIsNone(Division.objects.get(pk=d.pk).get_format())
+        self.assertEqual(state(), Division.State.ready)
+        
+        other = Division.objects.get(pk=d.pk)
+        fmt = stale.build_format()
+        with self.assertRaisesMessage(Exception, "Already build."):
+            other.build_format()
+        
+        # Brackets created directly point their division to them too
+        fmt.delete()
+        fmt = KataBracket.objects.create(division=d)
+        self.assertEqual(Division.objects.get(pk=d.pk).get_format(), fmt)
+    
+    
     def test_get_eventlinks(self):
         e = Event(name="event", format=Event.EventFormat.kata)
         e.save()
@@ -378,6 +458,90 @@ class DivisionTestCase(TestCase):
         self.assertEqual(div_summary(), ([["c", "Team a and b"]], ["d"]))
 
 
+    def test_save_queries(self):
+        """Re-assigning people when a division changes takes the same number of queries for any number of people."""
+        
+        white = Rank.get_kyu(9)
+        bb9 = Rank.get_dan(9)
+        
+        for n_people in [10, 40]:
+            e = Event.objects.create(name="event{}".format(n_people), format=Event.EventFormat.kata)
+            d_young = Division.objects.create(event=e, gender='MF', start_age=1, stop_age=17, start_rank=white, stop_rank=bb9)
+            d_old = Division.objects.create(event=e, gender='MF', start_age=18, stop_age=99, start_rank=white, stop_rank=bb9)
+            for i in range(n_people):
+                p = Person.objects.create(first_name=str(i), last_name="", gender='MF'[i % 2], age=10 + i % 10,
+                    rank=white, instructor="asdf")
+                EventLink.objects.create(person=p, event=e)
+            self.assertEqual(d_young.eventlink_set.count(), n_people * 8 // 10)
+            
+            with self.assertNumQueries(28):
+                d_young.stop_age = 15
+                d_young.save()
+                d_old.start_age = 16
+                d_old.save()
+            self.assertEqual(d_young.eventlink_set.count(), n_people * 6 // 10)
+            self.assertEqual(d_old.eventlink_set.count(), n_people - n_people * 6 // 10)
+            
+            with self.assertNumQueries(12):
+                d_young.delete()
+            self.assertEqual(d_old.eventlink_set.count(), n_people - n_people * 6 // 10)
+            self.assertEqual(e.get_orphan_links().count(), n_people * 6 // 10)
+
+
+class DivisionIndexTestCase(TestCase):
+    
+    def test_find(self):
+        e = Event.objects.create(name="event", format=Event.EventFormat.kata)
+        e2 = Event.objects.create(name="other", format=Event.EventFormat.kata)
+        white = Rank.get_kyu(9)
+        brown = Rank.get_kyu(1)
+        bb1 = Rank.get_dan(1)
+        bb9 = Rank.get_dan(9)
+        
+        d_young = Division(event=e, gender='MF', start_age=1, stop_age=12, start_rank=white, stop_rank=bb9)
+        d_young.save()
+        d_m = Division(event=e, gender='M', start_age=13, stop_age=99, start_rank=white, stop_rank=brown)
+        d_m.save()
+        d_bb = Division(event=e, gender='MF', start_age=13, stop_age=99, start_rank=bb1, stop_rank=bb9)
+        d_bb.save()
+        d_overlap = Division(event=e, gender='F', start_age=10, stop_age=20, start_rank=white, stop_rank=brown)
+        d_overlap.save()
+        d_empty = Division(event=e, gender='F', start_age=100, stop_age=99, start_rank=white, stop_rank=bb9)
+        d_empty.save()
+        Division(event=e2, gender='MF', start_age=1, stop_age=99, start_rank=white, stop_rank=bb9).save()
+        
+        index = DivisionIndex.get()
+        def find(gender, age, rank):
+            return index.find(e.id, gender, age, rank.id)
+        
+        self.assertEqual(find('M', 5, brown), d_young.id)
+        self.assertEqual(find('F', 12, brown), d_young.id) # Youngest division wins when overlapping
+        self.assertEqual(find('F', 13, brown), d_overlap.id)
+        self.assertEqual(find('F', 21, brown), None)
+        self.assertEqual(find('M', 50, brown), d_m.id)
+        self.assertEqual(find('M', 50, bb1), d_bb.id)
+        self.assertEqual(find('F', 99, bb9), d_bb.id)
+        self.assertEqual(find('F', 100, bb9), None)
+        self.assertEqual(find('M', 0, brown), None)
+        self.assertEqual(index.find(-1, 'M', 5, brown.id), None)
+        
+        # Matches the database query
+        for gender in ('M', 'F'):
+            for age in (0, 1, 9, 12, 13, 20, 21, 99, 100):
+                for rank in Rank.objects.all():
+                    expected = Division.objects.filter(start_age__lte=age, stop_age__gte=age,
+                        start_rank__order__lte=rank.order, stop_rank__order__gte=rank.order,
+                        event=e, gender__contains=gender).first()
+                    self.assertEqual(find(gender, age, rank), expected.id if expected else None)
+        
+        # Index is rebuilt when a division changes
+        d_m.stop_age = 49
+        d_m.save()
+        self.assertEqual(DivisionIndex.get().find(e.id, 'M', 50, brown.id), None)
+        d_m.delete()
+        self.assertEqual(DivisionIndex.get().find(e.id, 'M', 20, brown.id), None)
+
+
 class PersonTestCase(TestCase):
     
     def test_required_parent(self):
@@ -406,10 +570,115 @@ class PersonTestCase(TestCase):
         p.age = 18
         p.parent = "asdf"
         p.full_clean() # okay
+    
+    
+    def test_save_changed_fields(self):
+        e = Event.objects.create(name="event", format=Event.EventFormat.kata)
+        d_young = Division.objects.create(event=e, gender='MF', start_age=1, stop_age=17, start_rank=Rank.get_kyu(9),
+            stop_rank=Rank.get_dan(9))
+        d_old = Division.objects.create(event=e, gender='MF', start_age=18, stop_age=99, start_rank=Rank.get_kyu(9),
+            stop_rank=Rank.get_dan(9))
+        p = Person.objects.create(first_name="asdf", last_name="qwerty", gender='M', age=10, rank=Rank.get_kyu(9),
+            instructor="Mr. Instructor", parent="asdf")
+        EventLink.objects.create(person=p, event=e)
+        Rank.get_kyu(9) # Warm the caches
+        
+        p = Person.objects.get(pk=p.pk)
+        with self.assertNumQueries(0):
+            p.save()
+        
+        # Check in is a single update
+        p.confirmed = True
+        with self.assertNumQueries(1):
+            p.save()
+        
+        p.paid = True
+        p.phone_number = "555-1234"
+        p.save()
+        p = Person.objects.get(pk=p.pk)
+        self.assertTrue(p.confirmed)
+        self.assertTrue(p.paid)
+        self.assertIsNotNone(p.paidDate)
+        self.assertEqual(p.phone_number, "555-1234")
+        self.assertEqual(p.eventlink_set.get().division, d_young)
+        
+        p.age = 20
+        p.save()
+        self.assertEqual(p.eventlink_set.get().division, d_old)
+        
+        # Renaming a division doesn't re-assign people. They are only touched since the division name is shown with
+        # them, and the version of the division is increased.
+        d_old = Division.objects.get(pk=d_old.pk)
+        d_old.name = "Adults"
+        with self.assertNumQueries(3):
+            d_old.save()
+        self.assertEqual(Division.objects.get(pk=d_old.pk).name, "Adults")
+        
+        # Deferred fields are saved once assigned
+        p = Person.objects.defer('phone_number', 'notes').get(pk=p.pk)
+        p.phone_number = "555-6789"
+        self.assertEqual(p.get_dirty_fields(), ['phone_number'])
+        p.save()
+        p = Person.objects.defer('notes').get(pk=p.pk)
+        self.assertEqual(p.phone_number, "555-6789")
+        p.notes # Loaded, not changed
+        with self.assertNumQueries(0):
+            p.save()
+
+
+    def test_search_filter(self):
+        def make(first, last, **kwargs):
+            kwargs.setdefault('instructor', "Sensei Tanaka")
+            return Person.objects.create(first_name=first, last_name=last, gender='M', age=20, rank=Rank.get_kyu(9),
+                **kwargs)
+        
+        a = make("José", "Álvarez", phone_number="(519) 555-1234")
+        b = make("Joe", "Smith", email="joe.smith@example.com")
+        c = make("Ann", "Jones", instructor="Mr. Instructor")
+        
+        def search(text):
+            return set(Person.search_filter(Person.objects.all(), text))
+        
+        for fts in (True, False):
+            models._search_fts['default'] = fts
+            try:
+                self.assertEqual(search("jose"), {a})
+                self.assertEqual(search("ALVAREZ jos"), {a})
+                self.assertEqual(search("jo"), {a, b, c})
+                self.assertEqual(search("smith, joe"), {b})
+                self.assertEqual(search("joe.smith@ex"), {b})
+                self.assertEqual(search("5195551234"), {a})
+                self.assertEqual(search("555-12"), {a})
+                self.assertEqual(search("tanaka"), {a, b})
+                self.assertEqual(search("mith"), set())
+                self.assertEqual(search(" "), {a, b, c})
+            finally:
+                models._search_fts.pop('default')
+        
+        c.last_name = "Brown"
+        c.save()
+        self.assertEqual(search("jones"), set())
+        self.assertEqual(search("brown"), {c})
+        
+        c.delete()
+        self.assertEqual(search("ann"), set())
 
 
 class EventLinkTestCase(TestCase):
     
+    def test_disqualified_singleton(self):
+        e = Event(name="event", format=Event.EventFormat.kata)
+        e.save()
+        
+        el = EventLink.get_disqualified_singleton(e)
+        self.assertTrue(el.disqualified)
+        self.assertEqual(EventLink.get_disqualified_singleton(e), el) # Reloads after the create
+        with self.assertNumQueries(0):
+            self.assertEqual(EventLink.get_disqualified_singleton(e), el)
+            self.assertEqual(EventLink.get_disqualified_singleton(e.id), el)
+        self.assertEqual(EventLink.objects.filter(event=e, disqualified=True).count(), 1)
+    
+    
     def test_manual(self):
         p = Person(first_name="asdf", last_name="qwerty", gender='M', age=20,
             rank=Rank.objects.get(order=1), instructor="Mr. Instructor")
@@ -671,6 +940,59 @@ there",555 DDD,BBB,Ontario,LLL 555,I agree,ccc@icloud.com,GGG RRR,""", newline='
         self.assertEqual(len(EventLink.objects.all()), 5)
         
     
+    def test_import_registration_bulk(self):
+        """The number of queries doesn't depend on the number of rows in a chunk."""
+        
+        header = "Timestamp,First Name,Last Name,Gender,Age,Rank,Instructor,Phone number,Email Address,Events,Notes,Name of parent or guardian (competitors under 18 years)\n"
+        def rows(n, day):
+            return "".join('1/{}/2018 10:{:02d}:00,F{},L{},{},{},Purple (4th kyu),III,,,"Kata, Kumite",,PPP\n'.format(
+                day, i, i, i, 'Male' if i % 2 else 'Female', 10 + i % 5) for i in range(n))
+        
+        stats = import_registrations(StringIO(header + rows(1, 1), newline='')) # Initializes the settings table
+        self.assertEqual(stats, {"added": 1, "skipped": 0})
+        
+        with CaptureQueriesContext(connection) as small:
+            stats = import_registrations(StringIO(header + rows(1, 2), newline=''))
+        self.assertEqual(stats, {"added": 1, "skipped": 0})
+        
+        with CaptureQueriesContext(connection) as large:
+            stats = import_registrations(StringIO(header + rows(40, 3), newline=''))
+        self.assertEqual(stats, {"added": 40, "skipped": 0})
+        self.assertEqual(len(small), len(large))
+        
+        # Chunking gives the same result
+        stats = import_registrations(StringIO(header + rows(7, 4), newline=''), chunk_size=3)
+        self.assertEqual(stats, {"added": 7, "skipped": 0})
+        
+        kata = Event.objects.get(name="Kata")
+        kumite = Event.objects.get(name="Kumite")
+        self.assertEqual(Person.objects.count(), 49)
+        self.assertEqual(EventLink.objects.filter(event=kata, division__isnull=False).count(), 49)
+        self.assertEqual(EventLink.objects.filter(event=kumite, person__gender='M', division__isnull=False).count(), 23)
+        self.assertEqual(EventLink.objects.filter(event=kumite, person__gender='F', division__isnull=True).count(), 26)
+        self.assertEqual(len(set(Person.objects.values_list('id', flat=True))), 49)
+    
+    
+    def test_import_registration_deleted_id(self):
+        """Ids of deleted people aren't given to new people."""
+        
+        header = "Timestamp,First Name,Last Name,Gender,Age,Rank,Instructor,Phone number,Email Address,Events,Notes,Name of parent or guardian (competitors under 18 years)\n"
+        def rows(n, day):
+            return "".join('1/{}/2018 10:{:02d}:00,F{},L{},Male,20,Purple (4th kyu),III,,,Kata,,\n'.format(
+                day, i, i, i) for i in range(n))
+        
+        import_registrations(StringIO(header + rows(3, 1), newline=''))
+        last = Person.objects.latest('id')
+        last_id = last.id
+        last.delete()
+        
+        stats = import_registrations(StringIO(header + rows(2, 2), newline=''))
+        self.assertEqual(stats, {"added": 2, "skipped": 0})
+        self.assertFalse(Person.objects.filter(id=last_id).exists())
+        self.assertEqual(Person.objects.filter(id__gt=last_id).count(), 2)
+        self.assertEqual(EventLink.objects.filter(person__id__gt=last_id).count(), 2)
+    
+    
     def test_export_registration(self):
         
         kata = Event.objects.get(name="Kata")
@@ -700,11 +1022,30 @@ note"
 """)
     
     
+    def test_iter_registrations_chunks(self):
+        """Pages must not drop or repeat people with the same name and the query count must not grow."""
+        
+        kata = Event.objects.get(name="Kata")
+        for i in range(7):
+            p = Person.objects.create(first_name="First" if i % 2 else "first", last_name="Same", gender='M',
+                age=20, rank=Rank.get_dan(1), instructor="asdf", reg_date=datetime(2018, 1, 30, 13, 12, i))
+            EventLink.objects.create(event=kata, person=p)
+        
+        expected = list(iter_registrations(chunk_size=100))
+        self.assertEqual(len(expected), 8)
+        
+        rows = list(iter_registrations(chunk_size=2))
+        self.assertEqual(rows, expected)
+        
+        with self.assertNumQueries(2 * 4 + 1):
+            list(iter_registrations(chunk_size=2))
+    
+    
     def test_export_registration_fields(self):
         """Look for any new fields that might need to be added."""
         
         export_fields = ("first_name", "last_name", 'gender', 'age', 'rank', 'instructor', 'phone_number', 'email', 'parent', 'events', 'teammates', 'reg_date', 'notes')
-        unused_fields = ('eventlink', 'paidDate', 'confirmed', 'id', 'paid')
+        unused_fields = ('eventlink', 'paidDate', 'confirmed', 'id', 'paid', 'search', 'updated_at')
         okay_fields = export_fields + unused_fields
         
         model_fields = Person._meta.get_fields()
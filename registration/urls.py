@@ -6,6 +6,7 @@ app_name = 'registration'
 urlpatterns = [
     url(r'^$', views.IndexView.as_view(), name='index'),
     url(r'^table/$', views.IndexViewTable.as_view(), name='index-table'),
+    url(r'^table/page/$', views.IndexViewTablePage.as_view(), name='index-table-page'),
     url(r'^table/(?P<pk>[0-9]+)/$', views.IndexViewTableRow.as_view(), name='index-table-row'),
     url(r'^person/add/$', views.PersonCreate.as_view(), name='create'),
     url(r'^person/(?P<pk>[0-9]+)/$', views.DetailView.as_view(), name='detail'),
@@ -13,7 +14,11 @@ urlpatterns = [
     url(r'^person/(?P<pk>[0-9]+)/delete/$', views.PersonDelete.as_view(), name='delete'),
     url(r'^person/(?P<pk>[0-9]+)/checkin/$', views.PersonCheckin.as_view(), name='person-checkin'),
     url(r'^person/(?P<pk>[0-9]+)/paid/$', views.PersonPaid.as_view(), name='person-paid'),
+    url(r'^person/status/$', views.PersonBulkStatus.as_view(), name='person-bulk-status'),
+    url(r'^export/$', views.RegistrationExport.as_view(), name='export'),
     url(r'^division/$', views.DivisionList.as_view(), name='divisions'),
+    url(r'^division/dashboard/$', views.DivisionDashboard.as_view(), name='division-dashboard'),
+    url(r'^division/dashboard/table/$', views.DivisionDashboardTable.as_view(), name='division-dashboard-table'),
     url(r'^division/(?P<pk>[0-9]+)/$', views.DivisionInfo.as_view(), name='division-detail'),
     url(r'^division/(?P<pk>[0-9]+)/addPerson/$', views.DivisionAddManualPerson.as_view(), name='division-add-person'),
     url(r'^division/(?P<pk>[0-9]+)/assignTeam/$', views.TeamAssignView.as_view(), name='division-team-assign'),
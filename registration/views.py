@@ -1,5 +1,15 @@
+import json
+
 from django.contrib.auth.mixins import PermissionRequiredMixin
-from django.http.response import HttpResponseRedirect, HttpResponseForbidden
+from django.http.response import HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, \
+    StreamingHttpResponse
+from django.db.models import prefetch_related_objects
+from django.middleware.csrf import get_token
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.utils.safestring import mark_safe
 from django.urls import reverse_lazy, reverse
 from django.core.exceptions import PermissionDenied
 from django.contrib import messages
@@ -10,8 +20,11 @@ from django.views.generic.edit import CreateView, UpdateView, DeleteView, FormVi
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_POST
 
-from .models import Person, Rank, EventLink, Division
-from .forms import PersonForm, ManualEventLinkForm, PersonFilterForm, PersonCheckinForm, PersonPaidForm, TeamAssignForm
+from common.cache import LRUCache
+from common.views import CSRF_PLACEHOLDER, ReplicaMixin, VersionedPageMixin
+from .models import Person, Rank, EventLink, Division, DivisionSummary, DivisionProgress, iter_registrations
+from .forms import PersonForm, ManualEventLinkForm, PersonFilterForm, PersonCheckinForm, PersonPaidForm, TeamAssignForm, \
+    PersonBulkStatusForm
 
 # Create your views here.
 
@@ -21,11 +34,16 @@ class IndexView(PermissionRequiredMixin, generic.ListView, generic.edit.FormMixi
     Related to :class:`.IndexViewTable` and :class:`.IndexViewTableRow` which are used to redraw parts of this view
     dynamically. Views :class:`PersonPaid` and :class:`PersonCheckin` are called by clicking buttons in this view.
 
+    Only the first `page_size` people are shown. :class:`.IndexViewTablePage` loads the following pages, starting
+    after the sort keys given in the `after` parameter.
+
     """
 
     model = Person
     form_class = PersonFilterForm
     permission_required = 'accounts.view'
+    page_size = 100
+    count_people = True
     
     
     def __init__(self, *args, **kwargs):
@@ -62,17 +80,74 @@ class IndexView(PermissionRequiredMixin, generic.ListView, generic.edit.FormMixi
         if self.form.is_valid():
             qs = self.form.filter(qs)
         
-        return qs
+        qs = Person.sorted_by_name(qs, after=self.get_after())
+        return qs.select_related('rank')
+    
+    
+    def get_after(self):
+        """Returns the sort keys from the `after` parameter or None for the first page."""
+        try:
+            (last, first, id) = json.loads(self.request.GET['after'])
+            return (str(last), str(first), int(id))
+        except (KeyError, ValueError, TypeError):
+            return None
+    
+    
+    def get_context_data(self, **kwargs):
+        people = list(self.object_list[:self.page_size + 1])
+        kwargs['object_list'] = people[:self.page_size]
+        kwargs['rows'] = list(zip(kwargs['object_list'], render_person_rows(self.request, kwargs['object_list'])))
+        if len(people) > self.page_size:
+            last = people[self.page_size - 1]
+            kwargs['next_after'] = json.dumps([last.sort_last, last.sort_first, last.id])
+        if self.count_people:
+            kwargs['num_people'] = self.object_list.count()
+        return super().get_context_data(**kwargs)
 
 
 class IndexViewTable(IndexView):
     template_name = "registration/person_list_table.html"
+    count_people = False
+
+
+class IndexViewTablePage(IndexView):
+    """The rows of the next page of :class:`.IndexView`, followed by the button to load the page after."""
+    template_name = "registration/person_list_table_page.html"
+    count_people = False
 
 
 class IndexViewTableRow(PermissionRequiredMixin, generic.DetailView):
     model = Person
-    template_name = "registration/person_list_table_row.html"
+    template_name = "registration/person_list_table_row_cached.html"
     permission_required = 'accounts.view'
+    
+    def get_context_data(self, **kwargs):
+        kwargs['row'] = render_person_rows(self.request, [self.object])[0]
+        return super().get_context_data(**kwargs)
+
+
+_person_rows = LRUCache(maxsize=5000)
+
+def render_person_rows(request, people):
+    """Returns the cells of the person list row of each person, rendered by ``person_list_table_row.html``.
+    
+    Rendered rows are cached by person id, `updated_at` and whether the user can edit, so usually only rows that
+    changed are rendered. The CSRF token is inserted after the row is retrieved from the cache.
+    """
+    
+    can_edit = request.user.has_perm('accounts.edit')
+    keys = [(p.id, p.updated_at, can_edit) for p in people]
+    rows = [_person_rows.get(key) for key in keys]
+    
+    missing = [i for (i, row) in enumerate(rows) if row is None]
+    prefetch_related_objects([people[i] for i in missing], 'eventlink_set__event', 'eventlink_set__division')
+    for i in missing:
+        rows[i] = render_to_string('registration/person_list_table_row.html',
+            {'object': people[i], 'can_edit': can_edit, 'csrf_token': CSRF_PLACEHOLDER})
+        _person_rows.set(keys[i], rows[i])
+    
+    token = get_token(request)
+    return [mark_safe(row.replace(CSRF_PLACEHOLDER, token)) for row in rows]
 
 
 class DetailView(PermissionRequiredMixin, generic.DetailView):
@@ -158,18 +233,91 @@ class PersonPaid(PermissionRequiredMixin, UpdateView):
             return reverse('registration:index')
 
 
-class DivisionList(generic.ListView):
+class PersonBulkStatus(PermissionRequiredMixin, generic.View):
+    """Check in or mark as paid a batch of people with :meth:`.Person.bulk_set_status`.
+    
+    Meant for a check-in desk that queues scans and sends them every few seconds. Responds with the updated
+    :class:`IndexViewTable` rows of the people that changed.
+    """
+    
+    permission_required = 'accounts.edit'
+    
+    
+    def post(self, request, *args, **kwargs):
+        
+        form = PersonBulkStatusForm(data=request.POST)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_text())
+        
+        changed = Person.bulk_set_status(form.cleaned_data['ids'], confirmed=form.cleaned_data['confirmed'],
+            paid=form.cleaned_data['paid'])
+        people = list(Person.objects.filter(id__in=changed).select_related('rank'))
+        return render(request, 'registration/person_list_table_rows.html',
+            {'object_list': people, 'rows': zip(people, render_person_rows(request, people))})
+
+
+class DivisionList(ReplicaMixin, generic.ListView):
+    """Dashboard of all the divisions.
+    
+    The status, participant counts and winners come from :class:`.DivisionSummary` so the number of queries doesn't
+    depend on the number of divisions.
+    """
+    
     model = Division
     orderby = ('event', 'start_age', 'start_rank__order',)
     
+    def get_queryset(self):
+        qs = Division.objects.select_related('event', 'start_rank', 'stop_rank')
+        state = self.request.GET.get('state')
+        if state in Division.State.values:
+            qs = qs.filter(state=state)
+        return qs
+    
     def get_context_data(self, **kwargs):
         context = super(DivisionList, self).get_context_data(**kwargs)
-        context['no_division_eventlist'] = EventLink.no_division_eventlinks()
+        context['states'] = Division.State.choices
+        context['state'] = self.request.GET.get('state')
+        context['no_division_eventlist'] = EventLink.no_division_eventlinks().select_related('person__rank', 'event')
+        context['summaries'] = DivisionSummary.build(context['object_list'])
         return context
 
 
+class DivisionDashboard(generic.TemplateView):
+    """Venue dashboard with the current match, the match on deck and the progress of every running division.
+    
+    The table is reloaded from :class:`DivisionDashboardTable` every few seconds.
+    """
+    
+    template_name = 'registration/division_dashboard.html'
+    
+    def get_context_data(self, **kwargs):
+        context = super(DivisionDashboard, self).get_context_data(**kwargs)
+        (context['progress'], _) = DivisionProgress.get_all()
+        return context
+
+
+class DivisionDashboardTable(generic.TemplateView):
+    """The table of :class:`DivisionDashboard`.
+    
+    The progress is kept in memory by :class:`.DivisionProgress` and the response has an ETag, so polling from many
+    screens doesn't query the database and gets an empty 304 response until something changes.
+    """
+    
+    template_name = 'registration/division_dashboard_table.html'
+    
+    def get(self, request, *args, **kwargs):
+        (progress, etag) = DivisionProgress.get_all()
+        etag = quote_etag(etag)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = self.render_to_response(self.get_context_data(progress=progress))
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True) # Browsers revalidate with If-None-Match on every poll
+        return response
+
+
 def add_division_info_context_data(view, context, **kwargs):
-    context['locked'] = view.object.get_format() is not None
+    context['locked'] = view.object.state != Division.State.ready
     context['confirmed_eventlinks'] = view.object.get_confirmed_eventlinks()
     context['noshow_eventlinks'] = view.object.get_noshow_eventlinks()
     if 'add_form' not in context:
@@ -180,10 +328,13 @@ def add_division_info_context_data(view, context, **kwargs):
     return context
 
 
-class DivisionInfo(PermissionRequiredMixin, generic.DetailView):
+class DivisionInfo(ReplicaMixin, VersionedPageMixin, PermissionRequiredMixin, generic.DetailView):
     model = Division
     permission_required = 'accounts.view'
     
+    def get_version(self):
+        return Division.get_version(Division, self.kwargs['pk'])
+    
     def get_template_names(self):
         if self.object.event.is_team:
             return ['registration/division_team_detail.html']
@@ -331,6 +482,32 @@ class DivisionBuild(PermissionRequiredMixin, generic.detail.SingleObjectMixin, g
         return HttpResponseRedirect(fmt.get_absolute_url())
 
 
+class RegistrationExport(PermissionRequiredMixin, generic.View):
+    """Download the registrations as a csv file in the same format as :func:`.export_registrations`.
+    
+    The response is streamed so memory use doesn't depend on the number of registrations.
+    """
+    
+    permission_required = 'accounts.admin'
+    
+    
+    class Echo():
+        """Pseudo-buffer for `csv.writer` that returns the written row instead of storing it."""
+        
+        def write(self, value):
+            return value
+    
+    
+    def get(self, request, *args, **kwargs):
+        import csv
+        
+        writer = csv.writer(self.Echo())
+        rows = (writer.writerow(row) for row in iter_registrations())
+        response = StreamingHttpResponse(rows, content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="registrations.csv"'
+        return response
+
+
 class MessageDemoView(PermissionRequiredMixin, generic.TemplateView):
     template_name = 'registration/message_demo.html'
     permission_required = 'accounts.view'
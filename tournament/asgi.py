@@ -0,0 +1,31 @@
+"""
+ASGI config for tournament project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. It serves the live kumite scoreboard
+channels of :mod:`kumite.live`, which need many long lived connections. Run it with a single worker of any ASGI
+server, e.g.::
+
+    uvicorn tournament.asgi:application --host 0.0.0.0 --port 8001
+
+If asgiref is installed, the rest of the site is served too through the WSGI application. Otherwise, keep serving the
+site with ``tournament/wsgi.py`` and route ``/kumite/match/<pk>/live/`` to this server.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tournament.settings")
+django.setup()
+
+from kumite.live import LiveApplication
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    fallback = None
+else:
+    from django.core.wsgi import get_wsgi_application
+    fallback = WsgiToAsgi(get_wsgi_application())
+
+application = LiveApplication(fallback)
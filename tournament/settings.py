@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import sys
 import datetime
 
 from django.contrib.messages import constants as messages
@@ -104,7 +105,13 @@ DATABASES = {
    'default': {
        'ENGINE': 'django.db.backends.sqlite3',
        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-   }
+   },
+   # Copy of the default database for spectators written by ./manage.py snapshot_db. See common.replica.
+   'replica': {
+       'ENGINE': 'django.db.backends.sqlite3',
+       'NAME': os.path.join(BASE_DIR, 'db-replica.sqlite3'),
+       'TEST': {'MIRROR': 'default'},
+   },
     # 'default': {
     #     'ENGINE': 'django.db.backends.postgresql_psycopg2',
     #     'NAME': 'tournament',
@@ -115,6 +122,26 @@ DATABASES = {
     # }
 }
 
+DATABASE_ROUTERS = ['common.replica.ReplicaRouter']
+
+# Seconds a snapshot of the replica database may be read for. Older snapshots are ignored.
+REPLICA_MAX_AGE = 10
+
+
+# Cache
+# The gunicorn workers must share the cache so they see each other's invalidations of common.cache.LocalCache.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
+
+if 'test' in sys.argv:
+    # Keep the tests out of the cache directory
+    CACHES['default'] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -174,6 +201,10 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "node_modules"),
 ]
 
+# Directory of the static results site written by registration.results, e.g. os.path.join(BASE_DIR, 'results').
+# Must match the location in nginx.conf. The site isn't written if None.
+RESULTS_ROOT = None
+
 CONSTANCE_BACKEND = 'constance.backends.database.DatabaseBackend'
 CONSTANCE_CONFIG = {
     'KUMITE_DURATION_S': (120, 'Duration of kumite match in seconds'),